@@ -0,0 +1,95 @@
+import sys
+import json
+import logging
+import argparse
+import platform
+import time
+import numpy as np
+import torch
+from crowd_nav.benchmarks.suite import results_version, policy_variants, benchmark_simulation, benchmark_inference, \
+    benchmark_training, benchmark_episodes
+
+
+def compare(results, baseline, tolerance):
+    """
+    Compare results with a baseline, a benchmark regresses when it is worse than the baseline by more than the
+    tolerance
+
+    :return: list of names of regressed benchmarks
+    """
+    regressions = []
+    logging.info('%-45s %12s %12s %8s', 'Benchmark', 'Baseline', 'Current', 'Ratio')
+    for name, result in sorted(results.items()):
+        if name not in baseline:
+            continue
+        ratio = result['value'] / baseline[name]['value']
+        regressed = ratio < 1 - tolerance if result['higher_is_better'] else ratio > 1 + tolerance
+        if regressed:
+            regressions.append(name)
+        logging.info('%-45s %12.3f %12.3f %8.2f %s%s', name, baseline[name]['value'], result['value'], ratio,
+                     result['unit'], ' REGRESSION' if regressed else '')
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser('Benchmark simulation, inference and training')
+    parser.add_argument('--env_config', type=str, default='configs/env.config')
+    parser.add_argument('--policy_config', type=str, default='configs/policy.config')
+    parser.add_argument('--suites', type=str, nargs='+', default=['simulation', 'inference', 'training', 'episodes'])
+    parser.add_argument('--human_nums', type=int, nargs='+', default=[5, 10, 20, 50, 100, 200])
+    parser.add_argument('--policies', type=str, nargs='+', default=list(policy_variants))
+    parser.add_argument('--human_num', type=int, default=5)
+    parser.add_argument('--steps', type=int, default=200)
+    parser.add_argument('--batches', type=int, default=50)
+    parser.add_argument('--batch_size', type=int, default=100)
+    parser.add_argument('--episodes', type=int, default=10)
+    parser.add_argument('--gpu', default=False, action='store_true')
+    parser.add_argument('--output', type=str, default=None)
+    parser.add_argument('--baseline', type=str, default=None)
+    parser.add_argument('--tolerance', type=float, default=0.1)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s, %(levelname)s: %(message)s',
+                        datefmt="%Y-%m-%d %H:%M:%S")
+    device = torch.device("cuda:0" if torch.cuda.is_available() and args.gpu else "cpu")
+    np.random.seed(0)
+
+    results = {}
+    if 'simulation' in args.suites:
+        results.update(benchmark_simulation(args.env_config, args.policy_config, args.human_nums, args.steps))
+    if 'inference' in args.suites:
+        results.update(benchmark_inference(args.env_config, args.policy_config, args.policies, args.human_num,
+                                           args.steps, device))
+    if 'training' in args.suites:
+        results.update(benchmark_training(args.env_config, args.policy_config, args.policies, args.human_num,
+                                          args.batches, args.batch_size, device))
+    if 'episodes' in args.suites:
+        results.update(benchmark_episodes(args.env_config, args.policy_config, args.policies, args.human_num,
+                                          args.episodes, device))
+
+    if args.output is not None:
+        machine = {'platform': platform.platform(), 'processor': platform.processor(), 'python': sys.version,
+                   'numpy': np.__version__, 'torch': torch.__version__, 'device': str(device),
+                   'threads': torch.get_num_threads(), 'time': time.strftime('%Y-%m-%d %H:%M:%S')}
+        with open(args.output, 'w') as f:
+            json.dump({'version': results_version, 'machine': machine, 'results': results}, f, indent=2,
+                      sort_keys=True)
+        logging.info('Results written to %s', args.output)
+
+    if args.baseline is not None:
+        with open(args.baseline, 'r') as f:
+            baseline = json.load(f)
+        # files written before versioning have version 1
+        if baseline.get('version', 1) != results_version:
+            logging.error('Baseline %s has results of version %d, which are not comparable with version %d, '
+                          'regenerate it with --output', args.baseline, baseline.get('version', 1), results_version)
+            sys.exit(1)
+        baseline = baseline['results']
+        regressions = compare(results, baseline, args.tolerance)
+        if regressions:
+            logging.info('%d benchmarks regressed by more than %d%%', len(regressions), args.tolerance * 100)
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,191 @@
+import time
+import logging
+import configparser
+import numpy as np
+import torch
+import gym
+from crowd_sim.envs.utils.robot import Robot
+from crowd_sim.envs.utils.action import ActionXY
+from crowd_sim.envs.utils.state import JointState
+from crowd_nav.policy.policy_factory import policy_factory
+from crowd_nav.utils.explorer import Explorer
+from crowd_nav.utils.memory import ReplayMemory, TransitionMemory
+from crowd_nav.utils.trainer import Trainer
+
+
+# version of what the benchmarks measure, results of different versions are not comparable
+results_version = 2
+
+# policies of the inference and training benchmarks, OM variants are configured with occupancy maps
+policy_variants = {
+    'orca': ('orca', False),
+    'cadrl': ('cadrl', False),
+    'lstm_rl': ('lstm_rl', False),
+    'sarl': ('sarl', False),
+    'om_lstm_rl': ('lstm_rl', True),
+    'om_sarl': ('sarl', True),
+}
+
+
+def build_env(env_config_file, human_num):
+    """
+    Configure an environment and a robot for a crowd of the given size.
+    Humans are placed on a circle whose radius grows with their number, so large crowds keep the spacing of the
+    default scenario and can be generated.
+
+    """
+    env_config = configparser.RawConfigParser()
+    env_config.read(env_config_file)
+    env_config.set('sim', 'human_num', str(human_num))
+    env = gym.make('CrowdSim-v0')
+    env.configure(env_config)
+    env.circle_radius *= max(1, human_num / 5)
+    robot = Robot(env_config, 'robot')
+    env.set_robot(robot)
+    return env, robot
+
+
+def build_policy(policy_config_file, name, device):
+    policy_name, with_om = policy_variants[name]
+    policy_config = configparser.RawConfigParser()
+    policy_config.read(policy_config_file)
+    for section in ['lstm_rl', 'sarl']:
+        policy_config.set(section, 'with_om', str(with_om).lower())
+    policy = policy_factory[policy_name]()
+    # weights don't affect the speed, but random initializations are seeded to compare the same models
+    torch.manual_seed(0)
+    policy.configure(policy_config)
+    if policy.trainable:
+        policy.set_device(device)
+    policy.set_phase('test')
+    return policy
+
+
+def measure(function):
+    """
+    :return: result of the function and the duration of the call in seconds
+    """
+    start = time.perf_counter()
+    result = function()
+    return result, time.perf_counter() - start
+
+
+def benchmark_simulation(env_config_file, policy_config_file, human_nums, steps):
+    """
+    Steps per second of CrowdSim.step, onestep_lookahead and onestep_lookahead_batch for crowds of different sizes.
+    The robot walks straight to its goal, episodes are reset when they end and resets aren't timed. The actions of
+    the humans are cached by the environment until it is updated, so the cache is cleared before every timed call
+    and each of them computes the human actions.
+
+    """
+    results = {}
+    for human_num in human_nums:
+        env, robot = build_env(env_config_file, human_num)
+        robot.set_policy(policy_factory['orca']())
+        action = ActionXY(0, robot.v_pref)
+        # the action space of the value-based policies, evaluated at once by the batched lookahead
+        value_policy = build_policy(policy_config_file, 'cadrl', torch.device('cpu'))
+        value_policy.build_action_space(robot.v_pref)
+        actions = value_policy.action_space
+        durations = {'step': [], 'onestep_lookahead': [], 'onestep_lookahead_batch': []}
+        env.reset('test', 0)
+        done = False
+        for _ in range(steps):
+            if done:
+                env.reset('test', 0)
+            env.human_actions = None
+            durations['onestep_lookahead'].append(measure(lambda: env.onestep_lookahead(action))[1])
+            env.human_actions = None
+            durations['onestep_lookahead_batch'].append(measure(lambda: env.onestep_lookahead_batch(actions))[1])
+            env.human_actions = None
+            (_, _, done, _), duration = measure(lambda: env.step(action))
+            durations['step'].append(duration)
+        for name, values in durations.items():
+            results['simulation/{}/humans={}'.format(name, human_num)] = \
+                {'value': len(values) / sum(values), 'unit': 'steps/s', 'higher_is_better': True}
+        logging.info('Simulation with %d humans: %.0f steps/s', human_num, len(durations['step']) /
+                     sum(durations['step']))
+    return results
+
+
+def benchmark_inference(env_config_file, policy_config_file, policies, human_num, steps, device):
+    """
+    Latency of robot.act, which transforms the observation and calls predict, following the actions of the policy
+
+    """
+    results = {}
+    for name in policies:
+        env, robot = build_env(env_config_file, human_num)
+        policy = build_policy(policy_config_file, name, device)
+        robot.set_policy(policy)
+        policy.set_env(env)
+        ob = env.reset('test', 0)
+        latencies = []
+        for _ in range(steps):
+            action, latency = measure(lambda: robot.act(ob))
+            latencies.append(latency)
+            ob, _, done, _ = env.step(action)
+            if done:
+                ob = env.reset('test', 0)
+        results['inference/{}/humans={}'.format(name, human_num)] = \
+            {'value': float(np.mean(latencies)) * 1000, 'unit': 'ms', 'higher_is_better': False}
+        logging.info('%s predicts in %.3f ms', name, np.mean(latencies) * 1000)
+    return results
+
+
+def benchmark_training(env_config_file, policy_config_file, policies, human_num, batches, batch_size, device):
+    """
+    Samples per second of Trainer.optimize_batch on a memory filled with transformed states of the policy, with
+    values stored in the memory, with targets computed from transitions of 50 steps when they are sampled and with
+    prioritized replay of the stored values
+
+    """
+    results = {}
+    for name in policies:
+        env, robot = build_env(env_config_file, human_num)
+        policy = build_policy(policy_config_file, name, device)
+        if not policy.trainable:
+            continue
+        robot.set_policy(policy)
+        ob = env.reset('test', 0)
+        # CADRL is trained on states with one human
+        human_states = ob[:1] if policy.name == 'CADRL' else ob
+        state = policy.transform(JointState(robot.get_full_state(), human_states))
+        memories = {'training': ReplayMemory(batch_size * 10), 'training_prioritized': ReplayMemory(batch_size * 10)}
+        for memory in memories.values():
+            for i in range(memory.capacity):
+                memory.push((state, torch.Tensor([i / memory.capacity]).to(device)))
+        memories['training_lazy'] = TransitionMemory(batch_size * 10)
+        for i in range(batch_size * 10):
+            memories['training_lazy'].push((state, i / (batch_size * 10), i % 50 == 49, 0.25))
+        for key, memory in memories.items():
+            trainer = Trainer(policy.get_model(), memory, device, batch_size, gamma=0.9)
+            trainer.update_target_model(policy.get_model())
+            if key == 'training_prioritized':
+                trainer.set_prioritized_replay(0.6, 0.4, 0.01, None)
+            trainer.set_learning_rate(0.001)
+            trainer.optimize_batch(1)
+            duration = measure(lambda: trainer.optimize_batch(batches))[1]
+            results['{}/{}/humans={}'.format(key, name, human_num)] = \
+                {'value': batches * batch_size / duration, 'unit': 'samples/s', 'higher_is_better': True}
+            logging.info('%s trains on %.0f samples/s in %s', name, batches * batch_size / duration, key)
+    return results
+
+
+def benchmark_episodes(env_config_file, policy_config_file, policies, human_num, episodes, device):
+    """
+    Episodes per second of Explorer.run_k_episodes on the test cases
+
+    """
+    results = {}
+    for name in policies:
+        env, robot = build_env(env_config_file, human_num)
+        policy = build_policy(policy_config_file, name, device)
+        robot.set_policy(policy)
+        policy.set_env(env)
+        explorer = Explorer(env, robot, device, gamma=0.9)
+        duration = measure(lambda: explorer.run_k_episodes(episodes, 'test'))[1]
+        results['episodes/{}/humans={}'.format(name, human_num)] = \
+            {'value': episodes / duration, 'unit': 'episodes/s', 'higher_is_better': True}
+        logging.info('%s plays %.2f episodes/s', name, episodes / duration)
+    return results
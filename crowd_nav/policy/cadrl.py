@@ -2,10 +2,13 @@ import torch
 import torch.nn as nn
 import numpy as np
 import itertools
+import io
 import logging
 from crowd_sim.envs.policy.policy import Policy
 from crowd_sim.envs.utils.action import ActionRot, ActionXY
-from crowd_sim.envs.utils.state import ObservableState, FullState
+from crowd_sim.envs.utils.state import ObservableState, FullState, observable_state_array
+from crowd_sim.envs.utils.profiler import profiler
+from crowd_nav.policy.value_graph import ValueGraph
 
 
 def mlp(input_dim, mlp_dims, last_relu=False):
@@ -24,11 +27,16 @@ class ValueNetwork(nn.Module):
         super().__init__()
         self.value_network = mlp(input_dim, mlp_dims)
 
-    def forward(self, state):
+    def forward(self, state, lengths=None):
+        # states of CADRL always contain one human, lengths is accepted for a uniform interface with the trainer
         value = self.value_network(state)
         return value
 
 
+# action spaces shared by all policies, see CADRL.build_action_space
+action_lattices = dict()
+
+
 class CADRL(Policy):
     def __init__(self):
         super().__init__()
@@ -43,6 +51,7 @@ class CADRL(Policy):
         self.rotation_samples = None
         self.query_env = None
         self.action_space = None
+        self.action_array = None
         self.speeds = None
         self.rotations = None
         self.action_values = None
@@ -50,6 +59,10 @@ class CADRL(Policy):
         self.cell_num = None
         self.cell_size = None
         self.om_channel_size = None
+        # traced value graph used instead of the model for inference, see value_graph.py
+        self.value_graph = None
+        # states of training episodes are kept raw and transformed by transform_batch when batches are sampled
+        self.raw_states = False
         self.self_state_dim = 6
         self.human_state_dim = 7
         self.joint_state_dim = self.self_state_dim + self.human_state_dim
@@ -76,30 +89,72 @@ class CADRL(Policy):
         self.device = device
         self.model.to(device)
 
+    def set_value_graph(self, value_graph):
+        self.value_graph = value_graph
+
+    def build_value_graph(self, with_attention=False):
+        return ValueGraph(self.model, self.rotate, reduce_humans=True)
+
+    def quantize(self):
+        """
+        Replace the model with a copy whose linear and LSTM layers run with int8 weights, dynamic quantization only
+        runs on cpu and the quantized model is only used for inference
+
+        """
+        if self.device is not None and self.device.type != 'cpu':
+            raise ValueError('Quantized models can only run on cpu')
+        self.model = torch.quantization.quantize_dynamic(self.model, {nn.Linear, nn.LSTM}, dtype=torch.qint8)
+        self.value_graph = None
+
+    def get_value_graph(self):
+        if self.value_graph is not None:
+            return self.value_graph
+        return self.build_value_graph(with_attention=hasattr(self.model, 'forward_with_attention'))
+
+    def __getstate__(self):
+        # traced graphs can't be pickled, they are stored in their serialized form
+        state = self.__dict__.copy()
+        if isinstance(self.value_graph, torch.jit.ScriptModule):
+            buffer = io.BytesIO()
+            torch.jit.save(self.value_graph, buffer)
+            state['value_graph'] = buffer.getvalue()
+        return state
+
+    def __setstate__(self, state):
+        if isinstance(state['value_graph'], bytes):
+            state['value_graph'] = torch.jit.load(io.BytesIO(state['value_graph']), map_location=state['device'])
+        self.__dict__.update(state)
+
     def set_epsilon(self, epsilon):
         self.epsilon = epsilon
 
     def build_action_space(self, v_pref):
         """
         Action space consists of 25 uniformly sampled actions in permitted range and 25 randomly sampled actions.
+        Action spaces are cached by (kinematics, v_pref, speed_samples, rotation_samples) together with an array of
+        shape (# actions, 2) holding vx and vy for holonomic or v and r for unicycle kinematics.
         """
-        holonomic = True if self.kinematics == 'holonomic' else False
-        speeds = [(np.exp((i + 1) / self.speed_samples) - 1) / (np.e - 1) * v_pref for i in range(self.speed_samples)]
-        if holonomic:
-            rotations = np.linspace(0, 2 * np.pi, self.rotation_samples, endpoint=False)
-        else:
-            rotations = np.linspace(-np.pi / 4, np.pi / 4, self.rotation_samples)
-
-        action_space = [ActionXY(0, 0) if holonomic else ActionRot(0, 0)]
-        for rotation, speed in itertools.product(rotations, speeds):
+        key = (self.kinematics, v_pref, self.speed_samples, self.rotation_samples)
+        if key not in action_lattices:
+            holonomic = True if self.kinematics == 'holonomic' else False
+            speeds = [(np.exp((i + 1) / self.speed_samples) - 1) / (np.e - 1) * v_pref
+                      for i in range(self.speed_samples)]
             if holonomic:
-                action_space.append(ActionXY(speed * np.cos(rotation), speed * np.sin(rotation)))
+                rotations = np.linspace(0, 2 * np.pi, self.rotation_samples, endpoint=False)
             else:
-                action_space.append(ActionRot(speed, rotation))
+                rotations = np.linspace(-np.pi / 4, np.pi / 4, self.rotation_samples)
+
+            action_space = [ActionXY(0, 0) if holonomic else ActionRot(0, 0)]
+            for rotation, speed in itertools.product(rotations, speeds):
+                if holonomic:
+                    action_space.append(ActionXY(speed * np.cos(rotation), speed * np.sin(rotation)))
+                else:
+                    action_space.append(ActionRot(speed, rotation))
+            action_array = np.array(action_space, dtype=np.float64)
+            action_array.flags.writeable = False
+            action_lattices[key] = speeds, rotations, action_space, action_array
 
-        self.speeds = speeds
-        self.rotations = rotations
-        self.action_space = action_space
+        self.speeds, self.rotations, self.action_space, self.action_array = action_lattices[key]
 
     def propagate(self, state, action):
         if isinstance(state, ObservableState):
@@ -128,6 +183,25 @@ class CADRL(Policy):
 
         return next_state
 
+    def propagate_actions(self, self_state):
+        """
+        Propagate the self state by all actions of the action space in one array operation
+
+        :param self_state: array of shape (9,) with the full state of current agent
+        :return: array of shape (# actions, 9) with the next full states
+        """
+        next_states = np.repeat(self_state[np.newaxis], len(self.action_array), axis=0)
+        if self.kinematics == 'holonomic':
+            next_states[:, 2:4] = self.action_array
+        else:
+            next_theta = self_state[8] + self.action_array[:, 1]
+            next_states[:, 2] = self.action_array[:, 0] * np.cos(next_theta)
+            next_states[:, 3] = self.action_array[:, 0] * np.sin(next_theta)
+            next_states[:, 8] = next_theta
+        next_states[:, 0] += next_states[:, 2] * self.time_step
+        next_states[:, 1] += next_states[:, 3] * self.time_step
+        return next_states
+
     def predict(self, state):
         """
         Input state is the joint state of robot concatenated by the observable state of other agents
@@ -143,35 +217,43 @@ class CADRL(Policy):
 
         if self.reach_destination(state):
             return ActionXY(0, 0) if self.kinematics == 'holonomic' else ActionRot(0, 0)
-        if self.action_space is None:
-            self.build_action_space(state.self_state.v_pref)
+        self.build_action_space(state.self_state.v_pref)
 
         probability = np.random.random()
         if self.phase == 'train' and probability < self.epsilon:
             max_action = self.action_space[np.random.choice(len(self.action_space))]
         else:
-            self.action_values = list()
-            max_min_value = float('-inf')
-            max_action = None
-            for action in self.action_space:
-                next_self_state = self.propagate(state.self_state, action)
-                ob, reward, done, info = self.env.onestep_lookahead(action)
-                batch_next_states = torch.cat([torch.Tensor([next_self_state + next_human_state]).to(self.device)
-                                              for next_human_state in ob], dim=0)
-                # VALUE UPDATE
-                outputs = self.model(self.rotate(batch_next_states))
-                min_output, min_index = torch.min(outputs, 0)
-                min_value = reward + pow(self.gamma, self.time_step * state.self_state.v_pref) * min_output.data.item()
-                self.action_values.append(min_value)
-                if min_value > max_min_value:
-                    max_min_value = min_value
-                    max_action = action
+            with profiler.section('lookahead'):
+                ob, rewards, _, _ = self.env.onestep_lookahead_batch(self.action_space)
+                next_self_states = self.propagate_actions(state.self_state_array())
+
+            # evaluate all actions in one forward pass and take the minimum value over humans for each action
+            with profiler.section('value_network'), torch.no_grad():
+                batch_next_states = self.build_joint_states(next_self_states, observable_state_array(ob))
+                min_outputs = self.get_value_graph()(batch_next_states).cpu().numpy().astype(np.float64)
+            # VALUE UPDATE
+            min_values = rewards + pow(self.gamma, self.time_step * state.self_state.v_pref) * min_outputs
+            self.action_values = min_values.tolist()
+            max_action = self.action_space[int(np.argmax(min_values))]
 
         if self.phase == 'train':
-            self.last_state = self.transform(state)
+            self.last_state = self.get_memory_state(state)
 
         return max_action
 
+    def build_joint_states(self, self_states, human_states):
+        """
+        Pair every self state with every human state
+
+        :param self_states: array of shape (# self states, 9)
+        :param human_states: array of shape (# humans, 5)
+        :return: tensor of shape (# self states, # humans, 14)
+        """
+        shape = (self_states.shape[0], human_states.shape[0])
+        joint_states = np.concatenate([np.broadcast_to(self_states[:, np.newaxis, :], shape + (9,)),
+                                       np.broadcast_to(human_states[np.newaxis, :, :], shape + (5,))], axis=2)
+        return torch.from_numpy(joint_states).float().to(self.device)
+
     def transform(self, state):
         """
         Take the state passed from agent and transform it to tensor for batch training
@@ -184,6 +266,34 @@ class CADRL(Policy):
         state = self.rotate(state.unsqueeze(0)).squeeze(dim=0)
         return state
 
+    def raw_state(self, state):
+        """
+        Concatenate the self state and the human states of a joint state in the world frame
+
+        :return: tensor of shape (9 + 5 * # humans, )
+        """
+        return torch.from_numpy(np.concatenate([state.self_state_array(), state.human_states_array().ravel()])).\
+            float().to(self.device)
+
+    def get_memory_state(self, state):
+        """
+        State stored in the replay memory, the raw state or the input of the value network
+
+        """
+        if self.raw_states:
+            return self.raw_state(state)
+        return self.transform(state)
+
+    def transform_batch(self, states, lengths=None):
+        """
+        Transform a batch of raw states into inputs of the value network as transform does for one state
+
+        :param states: tensor of shape (batch_size, 14), states of CADRL contain one human
+        :param lengths: ignored, lengths are accepted for a uniform interface with the trainer
+        :return: tensor of shape (batch_size, len(state))
+        """
+        return self.rotate(states.float())
+
     def rotate(self, state):
         """
         Transform the coordinate to agent-centric.
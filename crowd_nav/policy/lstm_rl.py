@@ -1,9 +1,21 @@
 import torch
 import torch.nn as nn
+from torch.nn.utils.rnn import pack_padded_sequence
 import numpy as np
 import logging
 from crowd_nav.policy.cadrl import mlp
 from crowd_nav.policy.multi_human_rl import MultiHumanRL
+from crowd_sim.envs.utils.state import ObservableStateList
+
+
+def pack(sequence, lengths):
+    """
+    Pack padded sequences of humans so that the LSTM stops at the last real human of each state
+
+    """
+    if lengths is None:
+        return sequence
+    return pack_padded_sequence(sequence, lengths.cpu(), batch_first=True, enforce_sorted=False)
 
 
 class ValueNetwork1(nn.Module):
@@ -14,19 +26,20 @@ class ValueNetwork1(nn.Module):
         self.mlp = mlp(self_state_dim + lstm_hidden_dim, mlp_dims)
         self.lstm = nn.LSTM(input_dim, lstm_hidden_dim, batch_first=True)
 
-    def forward(self, state):
+    def forward(self, state, lengths=None):
         """
         First transform the world coordinates to self-centric coordinates and then do forward computation
 
         :param state: tensor of shape (batch_size, # of humans, length of a joint state)
+        :param lengths: optional tensor of shape (batch_size,) with the number of humans in each padded state
         :return:
         """
         size = state.shape
         self_state = state[:, 0, :self.self_state_dim]
         # human_state = state[:, :, self.self_state_dim:]
-        h0 = torch.zeros(1, size[0], self.lstm_hidden_dim)
-        c0 = torch.zeros(1, size[0], self.lstm_hidden_dim)
-        output, (hn, cn) = self.lstm(state, (h0, c0))
+        h0 = torch.zeros(1, size[0], self.lstm_hidden_dim, device=state.device)
+        c0 = torch.zeros(1, size[0], self.lstm_hidden_dim, device=state.device)
+        output, (hn, cn) = self.lstm(pack(state, lengths), (h0, c0))
         hn = hn.squeeze(0)
         joint_state = torch.cat([self_state, hn], dim=1)
         value = self.mlp(joint_state)
@@ -42,11 +55,12 @@ class ValueNetwork2(nn.Module):
         self.mlp = mlp(self_state_dim + lstm_hidden_dim, mlp_dims)
         self.lstm = nn.LSTM(mlp1_dims[-1], lstm_hidden_dim, batch_first=True)
 
-    def forward(self, state):
+    def forward(self, state, lengths=None):
         """
         First transform the world coordinates to self-centric coordinates and then do forward computation
 
         :param state: tensor of shape (batch_size, # of humans, length of a joint state)
+        :param lengths: optional tensor of shape (batch_size,) with the number of humans in each padded state
         :return:
         """
         size = state.shape
@@ -56,9 +70,9 @@ class ValueNetwork2(nn.Module):
         mlp1_output = self.mlp1(state)
         mlp1_output = torch.reshape(mlp1_output, (size[0], size[1], -1))
 
-        h0 = torch.zeros(1, size[0], self.lstm_hidden_dim)
-        c0 = torch.zeros(1, size[0], self.lstm_hidden_dim)
-        output, (hn, cn) = self.lstm(mlp1_output, (h0, c0))
+        h0 = torch.zeros(1, size[0], self.lstm_hidden_dim, device=state.device)
+        c0 = torch.zeros(1, size[0], self.lstm_hidden_dim, device=state.device)
+        output, (hn, cn) = self.lstm(pack(mlp1_output, lengths), (h0, c0))
         hn = hn.squeeze(0)
         joint_state = torch.cat([self_state, hn], dim=1)
         value = self.mlp(joint_state)
@@ -96,10 +110,19 @@ class LstmRL(MultiHumanRL):
 
         """
 
-        def dist(human):
-            # sort human order by decreasing distance to the robot
-            return np.linalg.norm(np.array(human.position) - np.array(state.self_state.position))
-
-        state.human_states = sorted(state.human_states, key=dist, reverse=True)
+        self.sort_humans(state)
         return super().predict(state)
 
+    def predict_batch(self, states):
+        for state in states:
+            if state is not None:
+                self.sort_humans(state)
+        return super().predict_batch(states)
+
+    @staticmethod
+    def sort_humans(state):
+        # sort human order by decreasing distance to the robot
+        human_states = state.human_states_array()
+        dist = np.linalg.norm(human_states[:, :2] - np.array(state.self_state.position), axis=1)
+        state.human_states = ObservableStateList(human_states[np.argsort(-dist, kind='stable')])
+
@@ -1,12 +1,18 @@
 import torch
 import numpy as np
 from crowd_sim.envs.utils.action import ActionRot, ActionXY
+from crowd_sim.envs.utils.state import FullState, observable_state_array
+from crowd_sim.envs.utils.profiler import profiler
 from crowd_nav.policy.cadrl import CADRL
+from crowd_nav.policy.value_graph import ValueGraph
 
 
 class MultiHumanRL(CADRL):
     def __init__(self):
         super().__init__()
+        self.max_action_index = None
+        # attention weights of all states of the last value graph evaluation, if the graph outputs them
+        self.batch_attention_weights = None
 
     def predict(self, state):
         """
@@ -21,47 +27,125 @@ class MultiHumanRL(CADRL):
 
         if self.reach_destination(state):
             return ActionXY(0, 0) if self.kinematics == 'holonomic' else ActionRot(0, 0)
-        if self.action_space is None:
-            self.build_action_space(state.self_state.v_pref)
+        self.build_action_space(state.self_state.v_pref)
 
-        occupancy_maps = None
         probability = np.random.random()
         if self.phase == 'train' and probability < self.epsilon:
             max_action = self.action_space[np.random.choice(len(self.action_space))]
         else:
-            self.action_values = list()
-            max_value = float('-inf')
-            max_action = None
-            for action in self.action_space:
-                next_self_state = self.propagate(state.self_state, action)
+            with profiler.section('lookahead'):
+                next_self_states = self.propagate_actions(state.self_state_array())
                 if self.query_env:
-                    next_human_states, reward, done, info = self.env.onestep_lookahead(action)
+                    next_human_states, rewards, _, _ = self.env.onestep_lookahead_batch(self.action_space)
                 else:
                     next_human_states = [self.propagate(human_state, ActionXY(human_state.vx, human_state.vy))
-                                       for human_state in state.human_states]
-                    reward = self.compute_reward(next_self_state, next_human_states)
-                batch_next_states = torch.cat([torch.Tensor([next_self_state + next_human_state]).to(self.device)
-                                              for next_human_state in next_human_states], dim=0)
-                rotated_batch_input = self.rotate(batch_next_states).unsqueeze(0)
-                if self.with_om:
-                    if occupancy_maps is None:
-                        occupancy_maps = self.build_occupancy_maps(next_human_states).unsqueeze(0)
-                    rotated_batch_input = torch.cat([rotated_batch_input, occupancy_maps], dim=2)
-                # VALUE UPDATE
-                next_state_value = self.model(rotated_batch_input).data.item()
-                value = reward + pow(self.gamma, self.time_step * state.self_state.v_pref) * next_state_value
-                self.action_values.append(value)
-                if value > max_value:
-                    max_value = value
-                    max_action = action
-            if max_action is None:
+                                         for human_state in state.human_states]
+                    rewards = [self.compute_reward(FullState(*next_self_state), next_human_states)
+                               for next_self_state in next_self_states.tolist()]
+
+            values = self.compute_action_values([state], [next_self_states], [next_human_states],
+                                                np.asarray(rewards)[np.newaxis])[0]
+            self.action_values = values.tolist()
+            self.max_action_index = int(np.argmax(values))
+            if not values[self.max_action_index] > float('-inf'):
                 raise ValueError('Value network is not well trained. ')
+            max_action = self.action_space[self.max_action_index]
 
         if self.phase == 'train':
-            self.last_state = self.transform(state)
+            self.last_state = self.get_memory_state(state)
 
         return max_action
 
+    def predict_batch(self, states):
+        """
+        Predict actions for a batch of environments stepping in lock-step, self.env is then a VecCrowdSim.
+        The candidate actions of all environments are evaluated in one forward pass of the value network.
+
+        :param states: list of joint states, None for idle environments
+        :return: list of actions, None for idle environments
+        """
+        if self.phase is None or self.device is None:
+            raise AttributeError('Phase, device attributes have to be set!')
+        if self.phase == 'train' and self.epsilon is None:
+            raise AttributeError('Epsilon attribute has to be set in training phase')
+
+        actions = [None] * len(states)
+        self.last_states = [None] * len(states)
+        evaluated = []
+        for i, state in enumerate(states):
+            if state is None:
+                continue
+            if self.reach_destination(state):
+                actions[i] = ActionXY(0, 0) if self.kinematics == 'holonomic' else ActionRot(0, 0)
+                continue
+            self.build_action_space(state.self_state.v_pref)
+            probability = np.random.random()
+            if self.phase == 'train' and probability < self.epsilon:
+                actions[i] = self.action_space[np.random.choice(len(self.action_space))]
+            else:
+                evaluated.append(i)
+            if self.phase == 'train':
+                self.last_states[i] = self.get_memory_state(state)
+
+        if evaluated:
+            batch_states = [states[i] for i in evaluated]
+            with profiler.section('lookahead'):
+                next_self_states = [self.propagate_actions(state.self_state_array()) for state in batch_states]
+                if self.query_env:
+                    next_human_states, rewards = self.env.onestep_lookahead_batch(self.action_space, evaluated)
+                    next_human_states = [next_human_states[i] for i in evaluated]
+                    rewards = rewards[evaluated]
+                else:
+                    next_human_states = [[self.propagate(human_state, ActionXY(human_state.vx, human_state.vy))
+                                          for human_state in state.human_states] for state in batch_states]
+                    rewards = np.array([[self.compute_reward(FullState(*next_self_state), humans)
+                                         for next_self_state in self_states.tolist()]
+                                        for self_states, humans in zip(next_self_states, next_human_states)])
+            values = self.compute_action_values(batch_states, next_self_states, next_human_states, rewards)
+            max_action_indices = np.argmax(values, axis=1)
+            for i, max_action_index, max_value in zip(evaluated, max_action_indices, np.max(values, axis=1)):
+                if not max_value > float('-inf'):
+                    raise ValueError('Value network is not well trained. ')
+                actions[i] = self.action_space[max_action_index]
+
+        return actions
+
+    def compute_action_values(self, states, next_self_states, next_human_states, rewards):
+        """
+        Evaluate the candidate actions of several states in one forward pass of the value network,
+        the input is of shape (# states * # actions, # humans, joint state length)
+
+        :param states: list of joint states
+        :param next_self_states: list of arrays of shape (# actions, 9) with the propagated self states
+        :param next_human_states: list of propagated human states, all states have the same number of humans
+        :param rewards: array of shape (# states, # actions)
+        :return: array of action values of shape (# states, # actions)
+        """
+        batch_next_states = torch.cat([self.build_joint_states(self_states, observable_state_array(human_states))
+                                       for self_states, human_states in zip(next_self_states, next_human_states)])
+        action_num = batch_next_states.shape[0] // len(states)
+        inputs = [batch_next_states]
+        if self.with_om:
+            # human states are propagated independently of the robot action, so their maps are shared
+            with profiler.section('occupancy_maps'):
+                inputs.append(torch.cat([self.build_occupancy_maps(human_states).to(self.device).unsqueeze(0).
+                                         expand(action_num, -1, -1) for human_states in next_human_states]))
+        # VALUE UPDATE
+        profiler.count('value_network_inputs', batch_next_states.shape[0])
+        with profiler.section('value_network'), torch.no_grad():
+            outputs = self.get_value_graph()(*inputs)
+        if isinstance(outputs, tuple):
+            outputs, attention_weights = outputs
+            self.batch_attention_weights = attention_weights.cpu().numpy()
+        else:
+            self.batch_attention_weights = None
+        next_state_values = outputs.cpu().numpy().astype(np.float64)
+        gamma_bar = np.array([pow(self.gamma, self.time_step * state.self_state.v_pref) for state in states])
+        return np.asarray(rewards) + gamma_bar[:, np.newaxis] * next_state_values.reshape(len(states), action_num)
+
+    def build_value_graph(self, with_attention=False):
+        return ValueGraph(self.model, self.rotate, with_attention=with_attention)
+
     def compute_reward(self, nav, humans):
         # collision detection
         dmin = float('inf')
@@ -94,8 +178,7 @@ class MultiHumanRL(CADRL):
         :param state:
         :return: tensor of shape (# of humans, len(state))
         """
-        state_tensor = torch.cat([torch.Tensor([state.self_state + human_state]).to(self.device)
-                                  for human_state in state.human_states], dim=0)
+        state_tensor = self.build_joint_states(state.self_state_array()[np.newaxis], state.human_states_array())[0]
         if self.with_om:
             occupancy_maps = self.build_occupancy_maps(state.human_states)
             state_tensor = torch.cat([self.rotate(state_tensor), occupancy_maps], dim=1)
@@ -103,62 +186,142 @@ class MultiHumanRL(CADRL):
             state_tensor = self.rotate(state_tensor)
         return state_tensor
 
+    def transform_batch(self, states, lengths=None):
+        """
+        Transform a batch of raw states into inputs of the value network as transform does for one state
+
+        :param states: tensor of shape (batch_size, 9 + 5 * # humans) with states padded by zero humans
+        :param lengths: optional tensor of shape (batch_size,) with the number of humans in each state
+        :return: tensor of shape (batch_size, # humans, len(state))
+        """
+        batch = states.shape[0]
+        human_states = states[:, 9:].reshape(batch, -1, 5)
+        human_num = human_states.shape[1]
+        joint_states = torch.cat([states[:, :9].unsqueeze(1).expand(-1, human_num, -1), human_states], dim=2).float()
+        state_tensor = self.rotate(joint_states.reshape(batch * human_num, -1)).reshape(batch, human_num, -1)
+        if self.with_om:
+            occupancy_maps = self.build_occupancy_maps_batch(human_states.double(), lengths)
+            state_tensor = torch.cat([state_tensor, occupancy_maps.float()], dim=2)
+        return state_tensor
+
     def input_dim(self):
         return self.joint_state_dim + (self.cell_num ** 2 * self.om_channel_size if self.with_om else 0)
 
     def build_occupancy_maps(self, human_states):
         """
+        Build the maps of all humans at once, the map of a human is a grid around it aligned with its velocity
+        and cells store the occupancy and/or the average relative velocity of the other humans in them
 
         :param human_states:
-        :return: tensor of shape (# human - 1, self.cell_num ** 2)
+        :return: tensor of shape (# human, self.cell_num ** 2 * self.om_channel_size)
         """
-        occupancy_maps = []
-        for human in human_states:
-            other_humans = np.concatenate([np.array([(other_human.px, other_human.py, other_human.vx, other_human.vy)])
-                                         for other_human in human_states if other_human != human], axis=0)
-            other_px = other_humans[:, 0] - human.px
-            other_py = other_humans[:, 1] - human.py
-            # new x-axis is in the direction of human's velocity
-            human_velocity_angle = np.arctan2(human.vy, human.vx)
-            other_human_orientation = np.arctan2(other_py, other_px)
-            rotation = other_human_orientation - human_velocity_angle
-            distance = np.linalg.norm([other_px, other_py], axis=0)
-            other_px = np.cos(rotation) * distance
-            other_py = np.sin(rotation) * distance
-
-            # compute indices of humans in the grid
-            other_x_index = np.floor(other_px / self.cell_size + self.cell_num / 2)
-            other_y_index = np.floor(other_py / self.cell_size + self.cell_num / 2)
-            other_x_index[other_x_index < 0] = float('-inf')
-            other_x_index[other_x_index >= self.cell_num] = float('-inf')
-            other_y_index[other_y_index < 0] = float('-inf')
-            other_y_index[other_y_index >= self.cell_num] = float('-inf')
-            grid_indices = self.cell_num * other_y_index + other_x_index
-            occupancy_map = np.isin(range(self.cell_num ** 2), grid_indices)
-            if self.om_channel_size == 1:
-                occupancy_maps.append([occupancy_map.astype(int)])
-            else:
-                # calculate relative velocity for other agents
-                other_human_velocity_angles = np.arctan2(other_humans[:, 3], other_humans[:, 2])
-                rotation = other_human_velocity_angles - human_velocity_angle
-                speed = np.linalg.norm(other_humans[:, 2:4], axis=1)
-                other_vx = np.cos(rotation) * speed
-                other_vy = np.sin(rotation) * speed
-                dm = [list() for _ in range(self.cell_num ** 2 * self.om_channel_size)]
-                for i, index in np.ndenumerate(grid_indices):
-                    if index in range(self.cell_num ** 2):
-                        if self.om_channel_size == 2:
-                            dm[2 * int(index)].append(other_vx[i])
-                            dm[2 * int(index) + 1].append(other_vy[i])
-                        elif self.om_channel_size == 3:
-                            dm[2 * int(index)].append(1)
-                            dm[2 * int(index) + 1].append(other_vx[i])
-                            dm[2 * int(index) + 2].append(other_vy[i])
-                        else:
-                            raise NotImplementedError
-                for i, cell in enumerate(dm):
-                    dm[i] = sum(dm[i]) / len(dm[i]) if len(dm[i]) != 0 else 0
-                occupancy_maps.append([dm])
-
-        return torch.from_numpy(np.concatenate(occupancy_maps, axis=0)).float()
+        states = observable_state_array(human_states)
+        human_num = len(states)
+        cell_count = self.cell_num ** 2
+        # states of the other humans of each human, of shape (# humans, # humans - 1, 5)
+        other_indices = np.nonzero(~np.eye(human_num, dtype=bool))[1].reshape(human_num, human_num - 1)
+        other_humans = states[other_indices]
+        other_px = other_humans[:, :, 0] - states[:, 0:1]
+        other_py = other_humans[:, :, 1] - states[:, 1:2]
+        # new x-axis is in the direction of human's velocity
+        human_velocity_angle = np.arctan2(states[:, 3:4], states[:, 2:3])
+        other_human_orientation = np.arctan2(other_py, other_px)
+        rotation = other_human_orientation - human_velocity_angle
+        distance = np.linalg.norm(np.stack([other_px, other_py]), axis=0)
+        other_px = np.cos(rotation) * distance
+        other_py = np.sin(rotation) * distance
+
+        # compute indices of humans in the grid
+        other_x_index = np.floor(other_px / self.cell_size + self.cell_num / 2)
+        other_y_index = np.floor(other_py / self.cell_size + self.cell_num / 2)
+        in_grid = (other_x_index >= 0) & (other_x_index < self.cell_num) & \
+            (other_y_index >= 0) & (other_y_index < self.cell_num)
+        human_index, other_index = np.nonzero(in_grid)
+        grid_indices = (self.cell_num * other_y_index + other_x_index)[in_grid].astype(int)
+        if self.om_channel_size == 1:
+            occupancy_maps = np.zeros((human_num, cell_count))
+            occupancy_maps[human_index, grid_indices] = 1
+            return torch.from_numpy(occupancy_maps).float()
+
+        # calculate relative velocity for other agents
+        other_human_velocity_angles = np.arctan2(other_humans[:, :, 3], other_humans[:, :, 2])
+        rotation = other_human_velocity_angles - human_velocity_angle
+        speed = np.linalg.norm(other_humans[:, :, 2:4], axis=2)
+        other_vx = (np.cos(rotation) * speed)[in_grid]
+        other_vy = (np.sin(rotation) * speed)[in_grid]
+        if self.om_channel_size == 2:
+            values = np.stack([other_vx, other_vy], axis=1)
+        elif self.om_channel_size == 3:
+            values = np.stack([np.ones_like(other_vx), other_vx, other_vy], axis=1)
+        else:
+            raise NotImplementedError
+        # a cell takes 2 slots for any channel size, so with 3 channels the last slot of a cell is shared with the
+        # first slot of the next one. Values are accumulated in the order of the other humans as sum() does
+        slots = 2 * grid_indices[:, np.newaxis] + np.arange(values.shape[1])
+        slots = (human_index[:, np.newaxis] * cell_count * self.om_channel_size + slots).ravel()
+        sums = np.zeros(human_num * cell_count * self.om_channel_size)
+        counts = np.zeros_like(sums)
+        np.add.at(sums, slots, values.ravel())
+        np.add.at(counts, slots, 1)
+        occupancy_maps = np.divide(sums, counts, out=np.zeros_like(sums), where=counts != 0)
+
+        return torch.from_numpy(occupancy_maps.reshape(human_num, -1)).float()
+
+    def build_occupancy_maps_batch(self, human_states, lengths=None):
+        """
+        Build the maps of a batch of padded human states at once as build_occupancy_maps does for one state
+
+        :param human_states: tensor of shape (batch_size, # humans, 5)
+        :param lengths: optional tensor of shape (batch_size,) with the number of humans in each state
+        :return: tensor of shape (batch_size, # humans, self.cell_num ** 2 * self.om_channel_size)
+        """
+        batch, human_num = human_states.shape[:2]
+        device = human_states.device
+        cell_count = self.cell_num ** 2
+        valid = torch.ones((batch, human_num), dtype=torch.bool, device=device) if lengths is None else \
+            torch.arange(human_num, device=device).unsqueeze(0) < lengths.unsqueeze(1)
+        # pairs of a human (dim 1) and another human (dim 2) of the same state
+        pairs = valid.unsqueeze(2) & valid.unsqueeze(1) & ~torch.eye(human_num, dtype=torch.bool, device=device)
+        px, py, vx, vy = (human_states[:, :, i] for i in range(4))
+        other_px = px.unsqueeze(1) - px.unsqueeze(2)
+        other_py = py.unsqueeze(1) - py.unsqueeze(2)
+        # new x-axis is in the direction of human's velocity
+        human_velocity_angle = torch.atan2(vy, vx).unsqueeze(2)
+        rotation = torch.atan2(other_py, other_px) - human_velocity_angle
+        distance = torch.sqrt(other_px ** 2 + other_py ** 2)
+        other_px = torch.cos(rotation) * distance
+        other_py = torch.sin(rotation) * distance
+
+        # compute indices of humans in the grid
+        other_x_index = torch.floor(other_px / self.cell_size + self.cell_num / 2)
+        other_y_index = torch.floor(other_py / self.cell_size + self.cell_num / 2)
+        in_grid = pairs & (other_x_index >= 0) & (other_x_index < self.cell_num) & \
+            (other_y_index >= 0) & (other_y_index < self.cell_num)
+        state_index, human_index, _ = torch.nonzero(in_grid, as_tuple=True)
+        grid_indices = (self.cell_num * other_y_index + other_x_index)[in_grid].long()
+        if self.om_channel_size == 1:
+            occupancy_maps = human_states.new_zeros((batch, human_num, cell_count))
+            occupancy_maps[state_index, human_index, grid_indices] = 1
+            return occupancy_maps
+
+        # calculate relative velocity for other agents
+        rotation = torch.atan2(vy, vx).unsqueeze(1) - human_velocity_angle
+        speed = torch.sqrt(vx ** 2 + vy ** 2).unsqueeze(1)
+        other_vx = (torch.cos(rotation) * speed)[in_grid]
+        other_vy = (torch.sin(rotation) * speed)[in_grid]
+        if self.om_channel_size == 2:
+            values = torch.stack([other_vx, other_vy], dim=1)
+        elif self.om_channel_size == 3:
+            values = torch.stack([torch.ones_like(other_vx), other_vx, other_vy], dim=1)
+        else:
+            raise NotImplementedError
+        # slots of the cells are laid out as in build_occupancy_maps
+        slots = 2 * grid_indices.unsqueeze(1) + torch.arange(values.shape[1], device=device)
+        slots = ((state_index * human_num + human_index) * cell_count * self.om_channel_size).unsqueeze(1) + slots
+        sums = human_states.new_zeros(batch * human_num * cell_count * self.om_channel_size)
+        counts = torch.zeros_like(sums)
+        sums.index_add_(0, slots.reshape(-1), values.reshape(-1))
+        counts.index_add_(0, slots.reshape(-1), torch.ones_like(values).reshape(-1))
+        occupancy_maps = torch.where(counts != 0, sums / counts.clamp(min=1), torch.zeros_like(sums))
 
+        return occupancy_maps.reshape(batch, human_num, -1)
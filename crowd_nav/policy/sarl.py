@@ -23,23 +23,32 @@ class ValueNetwork(nn.Module):
         self.cell_num = cell_num
         mlp3_input_dim = mlp2_dims[-1] + self.self_state_dim
         self.mlp3 = mlp(mlp3_input_dim, mlp3_dims)
-        self.attention_weights = None
 
-    def forward(self, state):
+    def forward(self, state, lengths=None):
+        return self.forward_with_attention(state, lengths)[0]
+
+    def forward_with_attention(self, state, lengths=None):
         """
         First transform the world coordinates to self-centric coordinates and then do forward computation
 
         :param state: tensor of shape (batch_size, # of humans, length of a rotated state)
-        :return:
+        :param lengths: optional tensor of shape (batch_size,) with the number of humans in each padded state
+        :return: values of shape (batch_size, 1) and attention weights of shape (batch_size, # of humans)
         """
         size = state.shape
         self_state = state[:, 0, :self.self_state_dim]
         mlp1_output = self.mlp1(state.view((-1, size[2])))
         mlp2_output = self.mlp2(mlp1_output)
+        if lengths is not None:
+            mask = (torch.arange(size[1], device=state.device).unsqueeze(0) < lengths.unsqueeze(1)).float()
 
         if self.with_global_state:
             # compute attention scores
-            global_state = torch.mean(mlp1_output.view(size[0], size[1], -1), 1, keepdim=True)
+            if lengths is None:
+                global_state = torch.mean(mlp1_output.view(size[0], size[1], -1), 1, keepdim=True)
+            else:
+                global_state = torch.sum(mlp1_output.view(size[0], size[1], -1) * mask.unsqueeze(2), 1, keepdim=True)
+                global_state = global_state / lengths.view(-1, 1, 1).float()
             global_state = global_state.expand((size[0], size[1], self.global_state_dim)).\
                 contiguous().view(-1, self.global_state_dim)
             attention_input = torch.cat([mlp1_output, global_state], dim=1)
@@ -49,26 +58,24 @@ class ValueNetwork(nn.Module):
 
         # masked softmax
         # weights = softmax(scores, dim=1).unsqueeze(2)
-        scores_exp = torch.exp(scores) * (scores != 0).float()
+        scores_exp = torch.exp(scores) * ((scores != 0).float() if lengths is None else mask)
         weights = (scores_exp / torch.sum(scores_exp, dim=1, keepdim=True)).unsqueeze(2)
-        self.attention_weights = weights[0, :, 0].data.cpu().numpy()
 
         # output feature is a linear combination of input features
         features = mlp2_output.view(size[0], size[1], -1)
-        # for converting to onnx
-        # expanded_weights = torch.cat([torch.zeros(weights.size()).copy_(weights) for _ in range(50)], dim=2)
         weighted_feature = torch.sum(torch.mul(weights, features), dim=1)
 
         # concatenate agent's state with global weighted humans' state
         joint_state = torch.cat([self_state, weighted_feature], dim=1)
         value = self.mlp3(joint_state)
-        return value
+        return value, weights[:, :, 0]
 
 
 class SARL(MultiHumanRL):
     def __init__(self):
         super().__init__()
         self.name = 'SARL'
+        self.attention_weights = None
 
     def configure(self, config):
         self.set_common_parameters(config)
@@ -85,5 +92,14 @@ class SARL(MultiHumanRL):
             self.name = 'OM-SARL'
         logging.info('Policy: {} {} global state'.format(self.name, 'w/' if with_global_state else 'w/o'))
 
+    def predict(self, state):
+        self.max_action_index = None
+        action = super().predict(state)
+        if self.max_action_index is not None:
+            # the model is evaluated on all actions at once, keep the weights of the chosen one
+            self.attention_weights = None if self.batch_attention_weights is None else \
+                self.batch_attention_weights[self.max_action_index]
+        return action
+
     def get_attention_weights(self):
-        return self.model.attention_weights
+        return self.attention_weights
@@ -0,0 +1,61 @@
+import torch
+import torch.nn as nn
+
+
+class ValueGraph(nn.Module):
+    def __init__(self, model, rotate, reduce_humans=False, with_attention=False):
+        """
+        Rotation of joint states followed by the value network of a policy as one module, so that inference
+        can be traced into a single graph and run without the policy code.
+
+        Input are unrotated joint states of shape (batch_size, # humans, 14), followed for policies with occupancy
+        maps by the maps of shape (batch_size, # humans, map size).
+        Output are values of shape (batch_size,) and, with attention, weights of shape (batch_size, # humans).
+
+        :param model: value network
+        :param rotate: function transforming joint states of shape (batch_size, 14) to agent-centric coordinates
+        :param reduce_humans: the value of a state is the minimum value over the humans, the model takes one human
+        :param with_attention: model has forward_with_attention and its weights are returned
+        """
+        super().__init__()
+        self.model = model
+        self.rotate = rotate
+        self.reduce_humans = reduce_humans
+        self.with_attention = with_attention
+
+    def forward(self, joint_states, occupancy_maps=None):
+        batch_size, human_num, _ = joint_states.shape
+        rotated_states = self.rotate(joint_states.reshape(batch_size * human_num, -1))
+        if self.reduce_humans:
+            return torch.min(self.model(rotated_states).view(batch_size, human_num), 1)[0]
+
+        rotated_states = rotated_states.view(batch_size, human_num, -1)
+        if occupancy_maps is not None:
+            rotated_states = torch.cat([rotated_states, occupancy_maps], dim=2)
+        if self.with_attention:
+            values, attention_weights = self.model.forward_with_attention(rotated_states)
+            return values[:, 0], attention_weights
+        return self.model(rotated_states)[:, 0]
+
+
+def export_value_graph(policy, output_file, with_attention=False, human_num=5):
+    """
+    Trace the value graph of a policy and save it as TorchScript
+
+    :param policy: trainable policy with a configured model on its device
+    :param output_file:
+    :param with_attention: also output attention weights, for models that compute them
+    :param human_num: number of humans in the example input, the traced graph accepts any number
+    """
+    value_graph = policy.build_value_graph(with_attention)
+    example_inputs = [torch.rand(2, human_num, 14, device=policy.device)]
+    if policy.with_om:
+        example_inputs.append(torch.rand(2, human_num, policy.cell_num ** 2 * policy.om_channel_size,
+                                         device=policy.device))
+    with torch.no_grad():
+        traced_graph = torch.jit.trace(value_graph, tuple(example_inputs))
+    torch.jit.save(traced_graph, output_file)
+
+
+def load_value_graph(input_file, device):
+    return torch.jit.load(input_file, map_location=device)
@@ -5,10 +5,15 @@ import os
 import torch
 import numpy as np
 import gym
-from crowd_nav.utils.explorer import Explorer
+from crowd_nav.utils.explorer import ParallelExplorer, VecExplorer
 from crowd_nav.policy.policy_factory import policy_factory
+from crowd_nav.policy.value_graph import load_value_graph
 from crowd_sim.envs.utils.robot import Robot
+from crowd_sim.envs.utils.profiler import profiler
 from crowd_sim.envs.policy.orca import ORCA
+from crowd_sim.envs import VecCrowdSim
+from crowd_sim.envs.utils.trajectory import TrajectoryArchive
+from crowd_sim.envs.utils.render import render_episodes
 
 
 def main():
@@ -26,7 +31,22 @@ def main():
     parser.add_argument('--circle', default=False, action='store_true')
     parser.add_argument('--video_file', type=str, default=None)
     parser.add_argument('--traj', default=False, action='store_true')
+    parser.add_argument('--num_workers', type=int, default=1)
+    parser.add_argument('--num_envs', type=int, default=1)
+    parser.add_argument('--value_graph', type=str, default=None)
+    parser.add_argument('--quantize', default=False, action='store_true')
+    parser.add_argument('--trajectory_file', type=str, default=None)
+    parser.add_argument('--trajectory_dir', type=str, default=None)
+    parser.add_argument('--render_failures', type=str, default=None)
+    parser.add_argument('--render_frames', default=False, action='store_true')
+    parser.add_argument('--profile', default=False, action='store_true')
+    parser.add_argument('--trace_file', type=str, default=None)
+    parser.add_argument('--scenario_dir', type=str, default=None)
     args = parser.parse_args()
+    if args.render_failures is not None and args.trajectory_dir is None:
+        parser.error('Failure cases are rendered from the trajectories recorded with --trajectory_dir')
+    if args.trajectory_dir is not None and args.num_envs > 1:
+        parser.error('Trajectories are not recorded in lock-step environments')
 
     if args.model_dir is not None:
         env_config_file = os.path.join(args.model_dir, os.path.basename(args.env_config))
@@ -47,16 +67,24 @@ def main():
                         datefmt="%Y-%m-%d %H:%M:%S")
     device = torch.device("cuda:0" if torch.cuda.is_available() and args.gpu else "cpu")
     logging.info('Using device: %s', device)
+    if args.profile or args.trace_file is not None:
+        profiler.enable(trace=args.trace_file is not None)
 
     # configure policy
     policy = policy_factory[args.policy]()
     policy_config = configparser.RawConfigParser()
     policy_config.read(policy_config_file)
     policy.configure(policy_config)
+    if args.quantize and (not policy.trainable or args.value_graph is not None or device.type != 'cpu'):
+        parser.error('Quantization requires the model weights of a trainable policy and runs on cpu')
     if policy.trainable:
         if args.model_dir is None:
             parser.error('Trainable policy must be specified with a model weights directory')
-        policy.get_model().load_state_dict(torch.load(model_weights))
+        if args.value_graph is not None:
+            # the traced graph holds the weights, the model of the policy is not used
+            policy.set_value_graph(load_value_graph(args.value_graph, device))
+        else:
+            policy.get_model().load_state_dict(torch.load(model_weights))
 
     # configure environment
     env_config = configparser.RawConfigParser()
@@ -70,7 +98,9 @@ def main():
     robot = Robot(env_config, 'robot')
     robot.set_policy(policy)
     env.set_robot(robot)
-    explorer = Explorer(env, robot, device, gamma=0.9)
+    if args.scenario_dir is not None:
+        env.load_scenario_bank(args.scenario_dir)
+    explorer = ParallelExplorer(env, robot, device, gamma=0.9, num_workers=args.num_workers)
 
     policy.set_phase(args.phase)
     policy.set_device(device)
@@ -85,15 +115,22 @@ def main():
     policy.set_env(env)
     robot.print_info()
     if args.visualize:
+        if args.quantize:
+            policy.quantize()
+        env.record_trajectory = True
         ob = env.reset(args.phase, args.test_case)
         done = False
         last_pos = np.array(robot.get_position())
         while not done:
-            action = robot.act(ob)
-            ob, _, done, info = env.step(action)
+            with profiler.section('act'):
+                action = robot.act(ob)
+            with profiler.section('step'):
+                ob, _, done, info = env.step(action)
             current_pos = np.array(robot.get_position())
             logging.debug('Speed: %.2f', np.linalg.norm(current_pos - last_pos) / robot.time_step)
             last_pos = current_pos
+        if args.trajectory_file is not None:
+            env.trajectory.save(args.trajectory_file)
         if args.traj:
             env.render('traj', args.video_file)
         else:
@@ -103,8 +140,52 @@ def main():
         if robot.visible and info == 'reach goal':
             human_times = env.get_human_times()
             logging.info('Average time for humans to reach goal: %.2f', sum(human_times) / len(human_times))
+        profiler.report(args.phase.upper())
     else:
-        explorer.run_k_episodes(env.case_size[args.phase], args.phase, print_failure=True)
+        if args.num_envs > 1:
+            envs = [env]
+            for _ in range(args.num_envs - 1):
+                vec_member = gym.make('CrowdSim-v0')
+                vec_member.configure(env_config)
+                vec_member.test_sim = env.test_sim
+                vec_member.scenario_bank = env.scenario_bank
+                vec_robot = Robot(env_config, 'robot')
+                vec_robot.set_policy(policy)
+                vec_member.set_robot(vec_robot)
+                envs.append(vec_member)
+            vec_env = VecCrowdSim(envs)
+            policy.set_env(vec_env)
+            evaluator = VecExplorer(vec_env, device, gamma=0.9)
+            case_counter = vec_env.case_counter
+        else:
+            evaluator = explorer
+            case_counter = env.case_counter
+        if args.trajectory_dir is not None:
+            env.record_trajectory = True
+            evaluator.trajectory_archive = TrajectoryArchive(args.trajectory_dir)
+            first_episode = len(evaluator.trajectory_archive)
+        first_case = case_counter[args.phase]
+        stats = evaluator.run_k_episodes(env.case_size[args.phase], args.phase, print_failure=True)
+        if args.render_failures is not None:
+            failures = sorted(stats['collision_cases'] + stats['timeout_cases'])
+            outputs = render_episodes(args.trajectory_dir, [first_episode + i for i in failures], args.render_failures,
+                                      robot.kinematics, env.time_step, args.render_frames, args.num_workers)
+            logging.info('Rendered %d failure cases to %s', len(outputs), args.render_failures)
+        if args.quantize:
+            # evaluate the quantized model on the same test cases and compare it with the full precision model
+            policy.quantize()
+            case_counter[args.phase] = first_case
+            evaluator.trajectory_archive = None
+            quantized_stats = evaluator.run_k_episodes(env.case_size[args.phase], args.phase, print_failure=True)
+            logging.info('%-16s %10s %10s', '', 'fp32', 'int8')
+            for key, label in [('success_rate', 'Success rate'), ('collision_rate', 'Collision rate'),
+                               ('nav_time', 'Nav time'), ('total_reward', 'Total reward')]:
+                logging.info('%-16s %10.4f %10.4f', label, stats[key], quantized_stats[key])
+            logging.info('%-16s %10.3f %10.3f', 'Act time (ms)', stats['act_time'] * 1000,
+                         quantized_stats['act_time'] * 1000)
+        explorer.close()
+    if args.trace_file is not None:
+        profiler.save_trace(args.trace_file)
 
 
 if __name__ == '__main__':
@@ -8,10 +8,13 @@ import torch
 import gym
 import git
 from crowd_sim.envs.utils.robot import Robot
+from crowd_sim.envs.utils.profiler import profiler
 from crowd_nav.utils.trainer import Trainer
-from crowd_nav.utils.memory import ReplayMemory
-from crowd_nav.utils.explorer import Explorer
+from crowd_nav.utils.memory import ReplayMemory, TransitionMemory
+from crowd_nav.utils.explorer import ParallelExplorer, AsyncExplorer
+from crowd_nav.utils.metrics import MetricsWriter
 from crowd_nav.policy.policy_factory import policy_factory
+from crowd_nav.policy.value_graph import export_value_graph
 
 
 def main():
@@ -25,6 +28,11 @@ def main():
     parser.add_argument('--resume', default=False, action='store_true')
     parser.add_argument('--gpu', default=False, action='store_true')
     parser.add_argument('--debug', default=False, action='store_true')
+    parser.add_argument('--num_workers', type=int, default=1)
+    parser.add_argument('--num_actors', type=int, default=0)
+    parser.add_argument('--profile', default=False, action='store_true')
+    parser.add_argument('--trace_file', type=str, default=None)
+    parser.add_argument('--scenario_dir', type=str, default=None)
     args = parser.parse_args()
 
     # configure paths
@@ -44,8 +52,10 @@ def main():
         shutil.copy(args.policy_config, args.output_dir)
         shutil.copy(args.train_config, args.output_dir)
     log_file = os.path.join(args.output_dir, 'output.log')
+    metrics_file = os.path.join(args.output_dir, 'metrics.jsonl')
     il_weight_file = os.path.join(args.output_dir, 'il_model.pth')
     rl_weight_file = os.path.join(args.output_dir, 'rl_model.pth')
+    value_graph_file = os.path.join(args.output_dir, 'value_graph.pt')
 
     # configure logging
     mode = 'a' if args.resume else 'w'
@@ -58,6 +68,8 @@ def main():
     logging.info('Current git head hash code: %s'.format(repo.head.object.hexsha))
     device = torch.device("cuda:0" if torch.cuda.is_available() and args.gpu else "cpu")
     logging.info('Using device: %s', device)
+    if args.profile or args.trace_file is not None:
+        profiler.enable(trace=args.trace_file is not None)
 
     # configure policy
     policy = policy_factory[args.policy]()
@@ -90,17 +102,40 @@ def main():
     target_update_interval = train_config.getint('train', 'target_update_interval')
     evaluation_interval = train_config.getint('train', 'evaluation_interval')
     capacity = train_config.getint('train', 'capacity')
+    lazy_targets = train_config.getboolean('train', 'lazy_targets', fallback=False)
+    raw_states = train_config.getboolean('train', 'raw_states', fallback=False)
+    raw_state_dtype = getattr(torch, train_config.get('train', 'raw_state_dtype', fallback='float32'))
     epsilon_start = train_config.getfloat('train', 'epsilon_start')
     epsilon_end = train_config.getfloat('train', 'epsilon_end')
     epsilon_decay = train_config.getfloat('train', 'epsilon_decay')
     checkpoint_interval = train_config.getint('train', 'checkpoint_interval')
 
     # configure trainer and explorer
-    memory = ReplayMemory(capacity)
+    memory_dtype = raw_state_dtype if raw_states else None
+    if lazy_targets:
+        memory = TransitionMemory(capacity, raw_states, memory_dtype)
+    else:
+        memory = ReplayMemory(capacity, raw_states, memory_dtype)
     model = policy.get_model()
     batch_size = train_config.getint('trainer', 'batch_size')
-    trainer = Trainer(model, memory, device, batch_size)
-    explorer = Explorer(env, robot, device, memory, policy.gamma, target_policy=policy)
+    trainer = Trainer(model, memory, device, batch_size, policy.gamma)
+    if raw_states:
+        # states are rotated and occupancy maps are built when batches are sampled
+        policy.raw_states = True
+        trainer.transform = policy.transform_batch
+    if train_config.getboolean('trainer', 'prioritized_replay', fallback=False):
+        trainer.set_prioritized_replay(train_config.getfloat('trainer', 'priority_alpha'),
+                                       train_config.getfloat('trainer', 'priority_beta'),
+                                       train_config.getfloat('trainer', 'priority_epsilon'), train_episodes)
+    if args.num_actors > 0:
+        explorer = AsyncExplorer(env, robot, device, memory, policy.gamma, target_policy=policy,
+                                 num_workers=args.num_workers, num_actors=args.num_actors)
+    else:
+        explorer = ParallelExplorer(env, robot, device, memory, policy.gamma, target_policy=policy,
+                                    num_workers=args.num_workers)
+    metrics = MetricsWriter(metrics_file, mode=mode)
+    trainer.metrics = metrics
+    explorer.metrics = metrics
 
     # imitation learning
     if args.resume:
@@ -128,20 +163,28 @@ def main():
         robot.set_policy(il_policy)
         explorer.run_k_episodes(il_episodes, 'train', update_memory=True, imitation_learning=True)
         trainer.optimize_epoch(il_epochs)
+        profiler.report('IL')
         torch.save(model.state_dict(), il_weight_file)
         logging.info('Finish imitation learning. Weights saved.')
         logging.info('Experience set size: %d/%d', len(memory), memory.capacity)
     explorer.update_target_model(model)
+    trainer.update_target_model(model)
 
     # reinforcement learning
     policy.set_env(env)
     robot.set_policy(policy)
     robot.print_info()
+    if args.scenario_dir is not None:
+        env.load_scenario_bank(args.scenario_dir)
     trainer.set_learning_rate(rl_learning_rate)
+    if args.num_actors > 0:
+        # training episodes are played by the actors while the learner optimizes the model
+        explorer.start(epsilon_end if args.resume else epsilon_start)
     # fill the memory pool with some RL experience
     if args.resume:
         robot.policy.set_epsilon(epsilon_end)
         explorer.run_k_episodes(100, 'train', update_memory=True, episode=0)
+        profiler.report('TRAIN')
         logging.info('Experience set size: %d/%d', len(memory), memory.capacity)
     episode = 0
     while episode < train_episodes:
@@ -153,24 +196,39 @@ def main():
             else:
                 epsilon = epsilon_end
         robot.policy.set_epsilon(epsilon)
+        if args.num_actors > 0:
+            explorer.sync_policy(epsilon)
+            explorer.collect_validations()
 
         # evaluate the model
         if episode % evaluation_interval == 0:
-            explorer.run_k_episodes(env.case_size['val'], 'val', episode=episode)
+            if args.num_actors > 0:
+                explorer.validate(episode)
+            else:
+                explorer.run_k_episodes(env.case_size['val'], 'val', episode=episode)
 
         # sample k episodes into memory and optimize over the generated memory
         explorer.run_k_episodes(sample_episodes, 'train', update_memory=True, episode=episode)
-        trainer.optimize_batch(train_batches)
+        trainer.optimize_batch(train_batches, episode)
+        profiler.report('TRAIN')
         episode += 1
 
         if episode % target_update_interval == 0:
             explorer.update_target_model(model)
+            trainer.update_target_model(model)
 
         if episode != 0 and episode % checkpoint_interval == 0:
             torch.save(model.state_dict(), rl_weight_file)
 
+    if args.num_actors > 0:
+        explorer.collect_validations(block=True)
     # final test
     explorer.run_k_episodes(env.case_size['test'], 'test', episode=episode)
+    explorer.close()
+    metrics.close()
+    if args.trace_file is not None:
+        profiler.save_trace(args.trace_file)
+    export_value_graph(policy, value_graph_file, with_attention=hasattr(model, 'forward_with_attention'))
 
 
 if __name__ == '__main__':
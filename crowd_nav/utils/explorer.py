@@ -1,7 +1,15 @@
 import logging
 import copy
+import time
+import queue
+import pickle
+import multiprocessing
+import numpy as np
 import torch
 from crowd_sim.envs.utils.info import *
+from crowd_sim.envs.utils.state import JointState
+from crowd_sim.envs.utils.profiler import profiler
+from crowd_nav.utils.memory import TransitionMemory
 
 
 class Explorer(object):
@@ -13,6 +21,10 @@ class Explorer(object):
         self.gamma = gamma
         self.target_policy = target_policy
         self.target_model = None
+        # recorded trajectories of summarized episodes are appended to it, see CrowdSim.record_trajectory
+        self.trajectory_archive = None
+        # MetricsWriter that receives the statistics of every summary
+        self.metrics = None
 
     def update_target_model(self, target_model):
         self.target_model = copy.deepcopy(target_model)
@@ -21,6 +33,41 @@ class Explorer(object):
     def run_k_episodes(self, k, phase, update_memory=False, imitation_learning=False, episode=None,
                        print_failure=False):
         self.robot.policy.set_phase(phase)
+        episodes = (self.run_episode(phase, keep_states=update_memory) for _ in range(k))
+        return self.summarize(episodes, k, phase, update_memory, imitation_learning, episode, print_failure)
+
+    def run_episode(self, phase, test_case=None, keep_states=True):
+        with profiler.section('reset'):
+            ob = self.env.reset(phase, test_case)
+        done = False
+        result = EpisodeResult()
+        while not done:
+            start = time.perf_counter()
+            with profiler.section('act'):
+                action = self.robot.act(ob)
+            result.act_times.append(time.perf_counter() - start)
+            with profiler.section('step'):
+                ob, reward, done, info = self.env.step(action)
+            if keep_states:
+                result.states.append(self.robot.policy.last_state)
+                result.actions.append(action)
+            result.rewards.append(reward)
+
+            if isinstance(info, Danger):
+                result.min_dist.append(info.min_dist)
+        result.info = info
+        result.global_time = self.env.global_time
+        result.trajectory = self.env.trajectory
+        return result
+
+    def summarize(self, episodes, k, phase, update_memory=False, imitation_learning=False, episode=None,
+                  print_failure=False):
+        """
+        Collect the statistics of k finished episodes in order and log them
+
+        :return: dict of success rate, collision rate, average navigation time, average total reward, average time
+        spent to choose one action in seconds and the indices of collision and timeout episodes
+        """
         success_times = []
         collision_times = []
         timeout_times = []
@@ -30,32 +77,24 @@ class Explorer(object):
         too_close = 0
         min_dist = []
         cumulative_rewards = []
+        act_times = []
         collision_cases = []
         timeout_cases = []
-        for i in range(k):
-            ob = self.env.reset(phase)
-            done = False
-            states = []
-            actions = []
-            rewards = []
-            while not done:
-                action = self.robot.act(ob)
-                ob, reward, done, info = self.env.step(action)
-                states.append(self.robot.policy.last_state)
-                actions.append(action)
-                rewards.append(reward)
-
-                if isinstance(info, Danger):
-                    too_close += 1
-                    min_dist.append(info.min_dist)
+        for i, result in enumerate(episodes):
+            info = result.info
+            too_close += len(result.min_dist)
+            min_dist += result.min_dist
+            act_times += result.act_times
+            if self.trajectory_archive is not None and result.trajectory is not None:
+                self.trajectory_archive.append(result.trajectory)
 
             if isinstance(info, ReachGoal):
                 success += 1
-                success_times.append(self.env.global_time)
+                success_times.append(result.global_time)
             elif isinstance(info, Collision):
                 collision += 1
                 collision_cases.append(i)
-                collision_times.append(self.env.global_time)
+                collision_times.append(result.global_time)
             elif isinstance(info, Timeout):
                 timeout += 1
                 timeout_cases.append(i)
@@ -66,10 +105,12 @@ class Explorer(object):
             if update_memory:
                 if isinstance(info, ReachGoal) or isinstance(info, Collision):
                     # only add positive(success) or negative(collision) experience in experience set
-                    self.update_memory(states, actions, rewards, imitation_learning)
+                    with profiler.section('update_memory'):
+                        self.update_memory(result.states, result.actions, result.rewards, imitation_learning)
+                    profiler.count('transitions', len(result.states))
 
             cumulative_rewards.append(sum([pow(self.gamma, t * self.robot.time_step * self.robot.v_pref)
-                                           * reward for t, reward in enumerate(rewards)]))
+                                           * reward for t, reward in enumerate(result.rewards)]))
 
         success_rate = success / k
         collision_rate = collision / k
@@ -88,42 +129,393 @@ class Explorer(object):
         if print_failure:
             logging.info('Collision cases: ' + ' '.join([str(x) for x in collision_cases]))
             logging.info('Timeout cases: ' + ' '.join([str(x) for x in timeout_cases]))
+        # episodes that fill the memory are reported by the training loop together with the optimization on them
+        if not update_memory:
+            profiler.report(phase.upper())
+
+        stats = {'success_rate': success_rate, 'collision_rate': collision_rate, 'nav_time': avg_nav_time,
+                 'total_reward': average(cumulative_rewards), 'act_time': average(act_times)}
+        if self.metrics is not None:
+            self.metrics.write('explorer', phase=phase, episode=episode, episodes=k, **stats)
+        stats.update(collision_cases=collision_cases, timeout_cases=timeout_cases)
+        return stats
 
     def update_memory(self, states, actions, rewards, imitation_learning=False):
         if self.memory is None or self.gamma is None:
             raise ValueError('Memory or gamma value is not set!')
 
-        for i, state in enumerate(states):
-            reward = rewards[i]
-
-            # VALUE UPDATE
+        dt = self.robot.time_step * self.robot.v_pref
+        gamma_bar = pow(self.gamma, dt)
+        if isinstance(self.memory, TransitionMemory):
+            # targets are computed by the trainer, IL returns are stored as terminal transitions
             if imitation_learning:
-                # define the value of states in IL as cumulative discounted rewards, which is the same in RL
-                state = self.target_policy.transform(state)
-                # value = pow(self.gamma, (len(states) - 1 - i) * self.robot.time_step * self.robot.v_pref)
-                value = sum([pow(self.gamma, max(t - i, 0) * self.robot.time_step * self.robot.v_pref) * reward
-                             * (1 if t >= i else 0) for t, reward in enumerate(rewards)])
-            else:
-                if i == len(states) - 1:
-                    # terminal state
-                    value = reward
-                else:
-                    next_state = states[i + 1]
-                    gamma_bar = pow(self.gamma, self.robot.time_step * self.robot.v_pref)
-                    value = reward + gamma_bar * self.target_model(next_state.unsqueeze(0)).data.item()
-            value = torch.Tensor([value]).to(self.device)
+                states = [self.target_policy.get_memory_state(state) for state in states]
+                rewards = self.discount_rewards(rewards, gamma_bar)
+            for i, (state, reward) in enumerate(zip(states, rewards)):
+                self.memory.push((state, reward, imitation_learning or i == len(states) - 1, dt))
+            return
 
-            # # transform state of different human_num into fixed-size tensor
-            # if len(state.size()) == 1:
-            #     human_num = 1
-            #     feature_size = state.size()[0]
-            # else:
-            #     human_num, feature_size = state.size()
-            # if human_num != 5:
-            #     padding = torch.zeros((5 - human_num, feature_size))
-            #     state = torch.cat([state, padding])
+        if imitation_learning:
+            # define the value of states in IL as cumulative discounted rewards, which is the same in RL
+            states = [self.target_policy.get_memory_state(state) for state in states]
+            values = self.discount_rewards(rewards, gamma_bar)
+        else:
+            # the target model evaluates all next states of the episode at once, the last state is terminal and
+            # the number of humans doesn't change within an episode
+            values = list(rewards)
+            if len(states) > 1:
+                next_states = torch.stack(states[1:])
+                if self.target_policy is not None and self.target_policy.raw_states:
+                    next_states = self.target_policy.transform_batch(next_states)
+                with torch.no_grad():
+                    next_values = self.target_model(next_states)
+                for i, next_value in enumerate(next_values.view(-1).tolist()):
+                    values[i] += gamma_bar * next_value
+
+        for state, value in zip(states, values):
+            value = torch.Tensor([value]).to(self.device)
+            # states of different human_num are padded by the memory and masked by the value network
             self.memory.push((state, value))
 
+    @staticmethod
+    def discount_rewards(rewards, gamma_bar):
+        """
+        :return: cumulative discounted reward from every step of an episode on
+        """
+        values = [0] * len(rewards)
+        value = 0
+        for i in reversed(range(len(rewards))):
+            value = rewards[i] + gamma_bar * value
+            values[i] = value
+        return values
+
+
+class ParallelExplorer(Explorer):
+    def __init__(self, env, robot, device, memory=None, gamma=None, target_policy=None, num_workers=None):
+        """
+        Explorer that plays the episodes of one run_k_episodes call in a pool of worker processes.
+        Each worker plays a copy of the environment and the robot on the case indices that the serial explorer
+        would have used, and the results are summarized in the original order, so the statistics are identical.
+
+        """
+        super().__init__(env, robot, device, memory, gamma, target_policy)
+        self.num_workers = num_workers if num_workers is not None else multiprocessing.cpu_count()
+        self.pool = None
+
+    def run_k_episodes(self, k, phase, update_memory=False, imitation_learning=False, episode=None,
+                       print_failure=False):
+        # workers run on cpu, debugging cases are not seeded and single episodes are not worth the overhead
+        if self.num_workers < 2 or k < 2 or self.device.type != 'cpu' or self.env.case_counter[phase] < 0:
+            return super().run_k_episodes(k, phase, update_memory, imitation_learning, episode, print_failure)
+
+        self.robot.policy.set_phase(phase)
+        # the local environment is not reset, but the time step is needed to summarize the episodes
+        self.robot.time_step = self.env.time_step
+        if self.pool is None:
+            self.pool = multiprocessing.Pool(self.num_workers, initializer=init_worker)
+        case_size = self.env.case_size[phase]
+        first_case = self.env.case_counter[phase]
+        cases = [(first_case + i) % case_size for i in range(k)]
+        self.env.case_counter[phase] = (first_case + k) % case_size
+
+        payload = pickle.dumps((self.env, self.robot))
+        chunk_size = int(np.ceil(k / (self.num_workers * 4)))
+        profile = (profiler.enabled, profiler.trace_events is not None)
+        tasks = [(payload, phase, cases[i: i + chunk_size], update_memory, profile) for i in range(0, k, chunk_size)]
+        episodes = (result for results in self.merge_profiles(self.pool.imap(run_cases, tasks)) for result in results)
+        return self.summarize(episodes, k, phase, update_memory, imitation_learning, episode, print_failure)
+
+    @staticmethod
+    def merge_profiles(outputs):
+        for results, profile in outputs:
+            profiler.merge(profile)
+            yield results
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
+
+
+class AsyncExplorer(ParallelExplorer):
+    def __init__(self, env, robot, device, memory=None, gamma=None, target_policy=None, num_workers=None,
+                 num_actors=2):
+        """
+        Explorer of the actor-learner mode of training. Actor processes keep playing training episodes with copies of
+        the policy whose weights and epsilon are refreshed by sync_policy, and a validation process plays the val
+        cases with snapshots of the weights, while the learner process optimizes the model.
+        Played episodes are summarized by the learner, so the memory, the target model and the metrics stay in it.
+        Episodes of the other phases, and all episodes before start, are played as by the parallel explorer.
+
+        """
+        super().__init__(env, robot, device, memory, gamma, target_policy, num_workers)
+        self.num_actors = num_actors
+        self.actors = []
+        self.policy_queues = []
+        self.episode_queue = None
+        self.validator = None
+        self.validation_queue = None
+        self.validation_results = None
+        self.pending_validations = 0
+
+    def start(self, epsilon):
+        """
+        Start the actors and the validation process with copies of the environment and the robot, actors start
+        playing with the current weights of the policy and the given epsilon
+
+        """
+        # workers run on cpu whatever the device of the learner is
+        env, robot = copy.deepcopy((self.env, self.robot))
+        robot.policy.set_device(torch.device('cpu'))
+        payload = pickle.dumps((env, robot))
+        # actors block when the learner falls behind, so episodes aren't played with outdated weights
+        self.episode_queue = multiprocessing.Queue(maxsize=2 * self.num_actors)
+        first_case = self.env.case_counter['train']
+        profile = (profiler.enabled, profiler.trace_events is not None)
+        for i in range(self.num_actors):
+            # actors only use the latest weights, so at most one copy waits for each of them
+            policy_queue = multiprocessing.Queue(maxsize=1)
+            # items left in the queue when an actor is terminated shouldn't block the learner from exiting
+            policy_queue.cancel_join_thread()
+            actor = multiprocessing.Process(target=run_actor, args=(payload, first_case + i, self.num_actors,
+                                                                    policy_queue, self.episode_queue, profile),
+                                            daemon=True)
+            actor.start()
+            self.actors.append(actor)
+            self.policy_queues.append(policy_queue)
+        self.validation_queue = multiprocessing.Queue()
+        self.validation_queue.cancel_join_thread()
+        self.validation_results = multiprocessing.Queue()
+        self.validator = multiprocessing.Process(target=run_validator, args=(payload, self.validation_queue,
+                                                                             self.validation_results, profile),
+                                                 daemon=True)
+        self.validator.start()
+        self.sync_policy(epsilon)
+        logging.info('Started %d actors and a validation process', self.num_actors)
+
+    def get_weights(self):
+        return {name: value.cpu() for name, value in self.robot.policy.get_model().state_dict().items()}
+
+    def sync_policy(self, epsilon):
+        """
+        Send the current weights of the policy and epsilon to the actors, they are used from their next episode on.
+        Weights an actor hasn't received yet are replaced, if they are still being sent they are kept until the
+        next call instead of blocking the learner
+
+        """
+        weights = self.get_weights()
+        for policy_queue in self.policy_queues:
+            try:
+                policy_queue.get_nowait()
+            except queue.Empty:
+                pass
+            try:
+                policy_queue.put_nowait((weights, epsilon))
+            except queue.Full:
+                pass
+
+    def run_k_episodes(self, k, phase, update_memory=False, imitation_learning=False, episode=None,
+                       print_failure=False):
+        if phase != 'train' or not self.actors:
+            return super().run_k_episodes(k, phase, update_memory, imitation_learning, episode, print_failure)
+        episodes = (self.receive_episode() for _ in range(k))
+        return self.summarize(episodes, k, phase, update_memory, imitation_learning, episode, print_failure)
+
+    def receive_episode(self):
+        result, profile = self.episode_queue.get()
+        profiler.merge(profile)
+        result.states = [state.to(self.device) for state in result.states]
+        return result
+
+    def validate(self, episode):
+        """
+        Play the val cases in the validation process with a snapshot of the current weights, the results are
+        summarized by collect_validations
+
+        """
+        self.validation_queue.put((self.get_weights(), episode))
+        self.pending_validations += 1
+
+    def collect_validations(self, block=False):
+        """
+        Summarize the finished validations in order
+
+        :param block: wait for all pending validations
+        """
+        while self.pending_validations:
+            try:
+                episode, results, profile = self.validation_results.get(block=block)
+            except queue.Empty:
+                break
+            self.pending_validations -= 1
+            profiler.merge(profile)
+            self.summarize(results, len(results), 'val', episode=episode)
+
+    def close(self):
+        for process in self.actors + ([self.validator] if self.validator is not None else []):
+            process.terminate()
+            process.join()
+        self.actors = []
+        self.policy_queues = []
+        self.validator = None
+        super().close()
+
+
+class VecExplorer(Explorer):
+    def __init__(self, vec_env, device, memory=None, gamma=None, target_policy=None):
+        """
+        Explorer that plays the episodes of one run_k_episodes call on a VecCrowdSim, all environments step in
+        lock-step and policies with predict_batch evaluate their value network once per step for all of them.
+        Episodes are played on the case indices that the serial explorer would have used and summarized in order.
+
+        """
+        super().__init__(vec_env.envs[0], vec_env.robots[0], device, memory, gamma, target_policy)
+        self.vec_env = vec_env
+
+    def run_k_episodes(self, k, phase, update_memory=False, imitation_learning=False, episode=None,
+                       print_failure=False):
+        vec_env = self.vec_env
+        policy = self.robot.policy
+        policy.set_phase(phase)
+        first_case = vec_env.case_counter[phase]
+        if first_case >= 0:
+            case_size = vec_env.case_size[phase]
+            cases = [(first_case + i) % case_size for i in range(k)]
+            vec_env.case_counter[phase] = (first_case + k) % case_size
+        else:
+            # debugging cases are not seeded and don't advance the counter
+            cases = [first_case] * k
+
+        episodes = [EpisodeResult() for _ in range(k)]
+        with profiler.section('reset'):
+            obs = vec_env.reset(phase, cases)
+        while not vec_env.done():
+            episode_indices = vec_env.episode_indices.copy()
+            start = time.perf_counter()
+            with profiler.section('act'):
+                if hasattr(policy, 'predict_batch'):
+                    actions = policy.predict_batch([None if ob is None else JointState(robot.get_full_state(), ob)
+                                                    for robot, ob in zip(vec_env.robots, obs)])
+                    last_states = policy.last_states
+                else:
+                    actions = [None] * vec_env.num_envs
+                    last_states = [None] * vec_env.num_envs
+                    for i, (env, robot, ob) in enumerate(zip(vec_env.envs, vec_env.robots, obs)):
+                        if ob is not None:
+                            policy.set_env(env)
+                            actions[i] = robot.act(ob)
+                            last_states[i] = getattr(policy, 'last_state', None)
+                    policy.set_env(vec_env)
+            # the actions of all environments are chosen together, each of them is charged an equal share
+            act_time = (time.perf_counter() - start) / np.count_nonzero(episode_indices >= 0)
+            with profiler.section('step'):
+                obs, rewards, dones, infos = vec_env.step(actions)
+
+            for i in np.flatnonzero(episode_indices >= 0):
+                result = episodes[episode_indices[i]]
+                if update_memory:
+                    result.states.append(last_states[i])
+                    result.actions.append(actions[i])
+                result.rewards.append(rewards[i])
+                result.act_times.append(act_time)
+                if isinstance(infos[i], Danger):
+                    result.min_dist.append(infos[i].min_dist)
+                if dones[i]:
+                    result.info = infos[i]
+                    result.global_time = vec_env.episode_times[i]
+
+        return self.summarize(episodes, k, phase, update_memory, imitation_learning, episode, print_failure)
+
+
+def init_worker():
+    # one process per core, so each of them should only use a single thread
+    torch.set_num_threads(1)
+
+
+def init_profiler(profile, trace):
+    # sections of a worker are timed by its own profiler and merged into the one of the main process
+    if profile:
+        profiler.enable(trace)
+        profiler.reset()
+    else:
+        profiler.disable()
+
+
+def run_cases(task):
+    payload, phase, cases, keep_states, (profile, trace) = task
+    init_profiler(profile, trace)
+    env, robot = pickle.loads(payload)
+    explorer = Explorer(env, robot, torch.device('cpu'))
+    robot.policy.set_phase(phase)
+    return [explorer.run_episode(phase, case, keep_states) for case in cases], profiler.get_state()
+
+
+def run_actor(payload, first_case, case_step, policy_queue, episode_queue, profile):
+    """
+    Play training episodes on every case_step-th case from first_case on with the latest weights and epsilon,
+    every episode is sent with the profiler state of its sections
+
+    """
+    init_worker()
+    init_profiler(*profile)
+    env, robot = pickle.loads(payload)
+    explorer = Explorer(env, robot, torch.device('cpu'))
+    policy = robot.policy
+    policy.set_phase('train')
+    update = policy_queue.get()
+    case = first_case
+    while True:
+        if update is not None:
+            weights, epsilon = update
+            policy.get_model().load_state_dict(weights)
+            policy.set_epsilon(epsilon)
+        result = explorer.run_episode('train', case)
+        episode_queue.put((result, profiler.get_state()))
+        # reset replaces the timers, so the state in the queue isn't changed
+        profiler.reset()
+        case = (case + case_step) % env.case_size['train']
+        # the queue holds at most the latest weights
+        try:
+            update = policy_queue.get_nowait()
+        except queue.Empty:
+            update = None
+
+
+def run_validator(payload, tasks, results, profile):
+    """
+    Play all val cases for every snapshot of weights and send them with the profiler state of their sections
+
+    """
+    init_worker()
+    init_profiler(*profile)
+    env, robot = pickle.loads(payload)
+    explorer = Explorer(env, robot, torch.device('cpu'))
+    policy = robot.policy
+    while True:
+        weights, episode = tasks.get()
+        policy.get_model().load_state_dict(weights)
+        policy.set_phase('val')
+        episodes = [explorer.run_episode('val', keep_states=False) for _ in range(env.case_size['val'])]
+        results.put((episode, episodes, profiler.get_state()))
+        profiler.reset()
+
+
+class EpisodeResult(object):
+    def __init__(self):
+        """
+        Everything needed from one played episode to compute the statistics and update the memory
+
+        """
+        self.states = []
+        self.actions = []
+        self.rewards = []
+        self.min_dist = []
+        self.act_times = []
+        self.info = None
+        self.global_time = None
+        self.trajectory = None
+
 
 def average(input_list):
     if input_list:
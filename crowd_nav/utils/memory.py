@@ -1,28 +1,225 @@
+import numpy as np
+import torch
 from torch.utils.data import Dataset
 
 
 class ReplayMemory(Dataset):
-    def __init__(self, capacity):
+    # widths of the self state and of a human state in raw states
+    self_state_width = 9
+    human_state_width = 5
+
+    def __init__(self, capacity, raw_states=False, dtype=None):
+        """
+        Ring buffer of (state, value) pairs backed by pre-allocated tensors.
+        States of shape (# humans, feature size) are stored in a tensor of shape (capacity, max # humans,
+        feature size) together with the number of humans of each state, the storage is allocated on the device
+        of the first pushed state and the human dimension grows when a state with more humans is pushed.
+        Raw states of shape (9 + 5 * # humans, ) in the world frame are stored in a tensor of shape (capacity,
+        9 + 5 * max # humans) and transformed into inputs of the value network when batches are sampled.
+
+        :param raw_states: whether pushed states are raw states of policy.get_memory_state
+        :param dtype: dtype of the stored states, e.g. torch.float16 for raw states, the dtype of the first pushed
+        state by default
+        """
         self.capacity = capacity
-        self.memory = list()
+        self.raw_states = raw_states
+        self.dtype = dtype
+        self.states = None
+        self.values = None
+        self.lengths = None
+        self.size = 0
         self.position = 0
+        # priorities of prioritized replay, see prioritize
+        self.sum_tree = None
+        self.max_priority = 1.0
+
+    def prioritize(self):
+        """
+        Keep a priority for every experience, new experience gets the highest priority seen so far
+
+        """
+        self.sum_tree = SumTree(self.capacity)
+        self.sum_tree.update(np.arange(self.size), np.full(self.size, self.max_priority))
 
     def push(self, item):
         # replace old experience with new experience
-        if len(self.memory) < self.position + 1:
-            self.memory.append(item)
+        state, value = item
+        if self.states is None:
+            self.allocate(state, value)
+        if self.raw_states:
+            human_num = (state.shape[0] - self.self_state_width) // self.human_state_width
+            if state.shape[0] > self.states.shape[1]:
+                self.grow(human_num)
+            self.states[self.position, :state.shape[0]] = state
+            self.states[self.position, state.shape[0]:] = 0
+            self.lengths[self.position] = human_num
+        elif state.dim() == 2:
+            if state.shape[0] > self.states.shape[1]:
+                self.grow(state.shape[0])
+            self.states[self.position, :state.shape[0]] = state
+            self.states[self.position, state.shape[0]:] = 0
+            self.lengths[self.position] = state.shape[0]
         else:
-            self.memory[self.position] = item
+            self.states[self.position] = state
+        self.values[self.position] = value
+        if self.sum_tree is not None:
+            self.sum_tree.set(self.position, self.max_priority)
+        self.size = min(self.size + 1, self.capacity)
         self.position = (self.position + 1) % self.capacity
 
+    def allocate(self, state, value):
+        dtype = self.dtype if self.dtype is not None else state.dtype
+        self.states = torch.zeros((self.capacity,) + tuple(state.shape), dtype=dtype, device=state.device)
+        self.values = torch.zeros((self.capacity,) + tuple(value.shape), dtype=value.dtype, device=value.device)
+        self.lengths = torch.ones(self.capacity, dtype=torch.long, device=state.device)
+
+    def grow(self, max_human_num):
+        if self.raw_states:
+            states = self.states.new_zeros((self.capacity, self.get_state_width(max_human_num)))
+        else:
+            states = self.states.new_zeros((self.capacity, max_human_num, self.states.shape[2]))
+        states[:, :self.states.shape[1]] = self.states
+        self.states = states
+
+    def get_state_width(self, human_num):
+        return self.self_state_width + self.human_state_width * human_num
+
+    def sample(self, batch_size):
+        """
+        Sample a random batch of experience with replacement
+
+        :return: states, values and numbers of humans of the batch
+        """
+        indices = torch.randint(self.size, (batch_size,), device=self.states.device)
+        return self.get_batch(indices)
+
+    def sample_prioritized(self, batch_size, beta):
+        """
+        Sample random indices with replacement with probabilities proportional to the priorities, one index from
+        each of batch_size equal ranges of the total priority
+
+        :param beta: exponent of the importance-sampling weights, 1 fully compensates the non-uniform probabilities
+        :return: indices and importance-sampling weights normalized by their maximum
+        """
+        total = self.sum_tree.total()
+        values = (np.arange(batch_size) + torch.rand(batch_size, dtype=torch.float64).numpy()) * total / batch_size
+        indices = self.sum_tree.find(values)
+        weights = (self.size * self.sum_tree.get(indices) / total) ** -beta
+        weights /= weights.max()
+        device = self.states.device
+        return torch.from_numpy(indices).to(device), torch.from_numpy(weights).float().to(device)
+
+    def update_priorities(self, indices, priorities):
+        priorities = priorities.cpu().numpy().astype(np.float64)
+        self.sum_tree.update(indices.cpu().numpy(), priorities)
+        self.max_priority = max(self.max_priority, float(priorities.max()))
+
+    def get_batch(self, indices):
+        return self.states[indices], self.values[indices], self.lengths[indices]
+
     def is_full(self):
-        return len(self.memory) == self.capacity
+        return self.size == self.capacity
 
     def __getitem__(self, item):
-        return self.memory[item]
+        if item < 0 or item >= self.size:
+            raise IndexError('Replay memory index out of range')
+        state = self.states[item]
+        if self.raw_states:
+            state = state[:self.get_state_width(self.lengths[item])]
+        elif state.dim() == 2:
+            state = state[:self.lengths[item]]
+        return state, self.values[item]
 
     def __len__(self):
-        return len(self.memory)
+        return self.size
 
     def clear(self):
-        self.memory = list()
+        self.size = 0
+        self.position = 0
+        if self.sum_tree is not None:
+            self.sum_tree = SumTree(self.capacity)
+            self.max_priority = 1.0
+
+
+class SumTree(object):
+    def __init__(self, capacity):
+        """
+        Binary tree whose leaves are the priorities of the slots of a replay memory and whose nodes are the sums of
+        their children, stored as an array where node i has children 2i and 2i + 1 and the root is node 1.
+        Updating priorities and finding the slots of cumulative priorities take O(log N) per slot, the slots of a
+        batch are processed together one tree level at a time.
+
+        """
+        self.leaf_num = 1 << max(capacity - 1, 0).bit_length()
+        self.tree = np.zeros(2 * self.leaf_num)
+
+    def total(self):
+        return self.tree[1]
+
+    def get(self, indices):
+        return self.tree[indices + self.leaf_num]
+
+    def set(self, index, priority):
+        node = index + self.leaf_num
+        self.tree[node] = priority
+        while node > 1:
+            node //= 2
+            self.tree[node] = self.tree[2 * node] + self.tree[2 * node + 1]
+
+    def update(self, indices, priorities):
+        if len(indices) == 0:
+            return
+        nodes = indices + self.leaf_num
+        self.tree[nodes] = priorities
+        # all leaves are at the same depth, so the parents of a level are updated together
+        while nodes[0] > 1:
+            nodes = np.unique(nodes // 2)
+            self.tree[nodes] = self.tree[2 * nodes] + self.tree[2 * nodes + 1]
+
+    def find(self, values):
+        """
+        :param values: array of cumulative priorities in [0, total)
+        :return: indices of the slots whose ranges of cumulative priority contain the values
+        """
+        nodes = np.ones(len(values), dtype=np.int64)
+        values = np.array(values, dtype=np.float64)
+        while nodes[0] < self.leaf_num:
+            left = self.tree[2 * nodes]
+            # slots without priority are never reached, even when a value is rounded up to the end of its range
+            go_right = (values >= left) & (self.tree[2 * nodes + 1] > 0)
+            values = np.where(go_right, values - left, values)
+            nodes = 2 * nodes + go_right
+        return nodes - self.leaf_num
+
+
+class TransitionMemory(ReplayMemory):
+    def __init__(self, capacity, raw_states=False, dtype=None):
+        """
+        Ring buffer of (state, reward, terminal, dt) transitions whose value targets are computed when they are
+        sampled, so the targets always come from the latest target model.
+        The next state of a non-terminal transition is the state stored in the following slot: episodes are pushed
+        as a whole and end with a terminal transition, so the next state is never overwritten before the transition.
+
+        """
+        super().__init__(capacity, raw_states, dtype)
+        self.terminals = None
+        self.dts = None
+
+    def push(self, item):
+        state, reward, terminal, dt = item
+        if self.states is None:
+            self.terminals = torch.ones(self.capacity, dtype=torch.bool, device=state.device)
+            self.dts = torch.zeros(self.capacity, device=state.device)
+        self.terminals[self.position] = terminal
+        self.dts[self.position] = dt
+        # rewards are stored in place of the values
+        super().push((state, torch.Tensor([reward]).to(state.device)))
+
+    def get_batch(self, indices):
+        """
+        :return: states, rewards, numbers of humans, next states, numbers of humans in the next states,
+        terminal flags and the time steps scaled by the preferred speed of the batch
+        """
+        next_indices = (indices + 1) % self.capacity
+        return (self.states[indices], self.values[indices], self.lengths[indices], self.states[next_indices],
+                self.lengths[next_indices], self.terminals[indices], self.dts[indices])
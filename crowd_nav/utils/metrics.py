@@ -0,0 +1,66 @@
+import json
+import time
+from collections import deque
+
+
+class MetricsWriter(object):
+    def __init__(self, output_file, mode='a'):
+        """
+        Append-only stream of metrics in JSON lines, one record per line.
+        Every record is flushed when it's written, so running experiments can be read while they are written.
+
+        """
+        self.output_file = output_file
+        self.file = open(output_file, mode)
+
+    def write(self, source, **metrics):
+        """
+        Append one record, the wall-clock time is added to it
+
+        :param source: component that produces the record, e.g. explorer or trainer
+        """
+        record = dict(source=source, time=time.time(), **metrics)
+        # numpy scalars are written as floats
+        self.file.write(json.dumps(record, default=float) + '\n')
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+
+def read_metrics(input_file, position=0):
+    """
+    Read the complete records appended to a metrics file after a position, a partially written last line is left
+    for the next read
+
+    :return: list of records and the position after the last complete line
+    """
+    with open(input_file, 'rb') as f:
+        f.seek(position)
+        data = f.read()
+    end = data.rfind(b'\n') + 1
+    records = [json.loads(line) for line in data[:end].decode().splitlines() if line]
+    return records, position + end
+
+
+class RunningMean(object):
+    def __init__(self, window_size):
+        """
+        Mean of the last window_size values of a stream, updated in constant time per value
+
+        """
+        self.window_size = window_size
+        self.window = deque()
+        self.total = 0
+
+    def push(self, value):
+        """
+        :return: mean of the window, None until the window is full
+        """
+        self.window.append(value)
+        self.total += value
+        if len(self.window) > self.window_size:
+            self.total -= self.window.popleft()
+        if len(self.window) < self.window_size:
+            return None
+        return self.total / self.window_size
@@ -1,12 +1,73 @@
 import re
+import os
 import argparse
 import matplotlib.pyplot as plt
-import numpy as np
-
-
-def running_mean(x, n):
-    cumsum = np.cumsum(np.insert(x, 0, 0))
-    return (cumsum[n:] - cumsum[:-n]) / float(n)
+from crowd_nav.utils.metrics import read_metrics, RunningMean
+
+
+log_pattern = re.compile(r"(?P<phase>TRAIN|VAL  ) in episode (?P<episode>\d+) has success rate: (?P<sr>[0-1].\d+), "
+                         r"collision rate: (?P<cr>[0-1].\d+), nav time: (?P<time>\d+.\d+), "
+                         r"total reward: (?P<reward>[-+]?\d+.\d+)")
+metric_names = ['success_rate', 'collision_rate', 'nav_time', 'total_reward']
+
+
+def read_records(input_file, position=0):
+    """
+    Read the records appended to a metrics file after a position. Output logs of runs without metrics file are
+    scanned line by line for the summaries of the explorer
+
+    :return: list of records and the position after the last complete line
+    """
+    if input_file.endswith('.jsonl'):
+        return read_metrics(input_file, position)
+    with open(input_file, 'rb') as f:
+        f.seek(position)
+        data = f.read()
+    end = data.rfind(b'\n') + 1
+    records = []
+    for line in data[:end].decode().splitlines():
+        match = log_pattern.search(line)
+        if match is not None:
+            records.append({'source': 'explorer', 'phase': match.group('phase').strip().lower(),
+                            'episode': int(match.group('episode')), 'success_rate': float(match.group('sr')),
+                            'collision_rate': float(match.group('cr')), 'nav_time': float(match.group('time')),
+                            'total_reward': float(match.group('reward'))})
+    return records, position + end
+
+
+class Curves(object):
+    def __init__(self, input_file, window_size, max_episodes):
+        """
+        Training and validation curves of one run, read incrementally from its metrics file or output log.
+        Training curves are smoothed with a running mean as the records arrive.
+
+        """
+        self.input_file = input_file
+        self.position = 0
+        self.max_episodes = max_episodes
+        self.train_episodes = 0
+        self.running_means = {name: RunningMean(window_size) for name in metric_names}
+        self.train = {name: [] for name in metric_names}
+        self.val_episode = []
+        self.val = {name: [] for name in metric_names}
+
+    def update(self):
+        records, self.position = read_records(self.input_file, self.position)
+        for record in records:
+            # summaries outside of the episode loop (imitation learning and final test) are not plotted
+            if record['source'] != 'explorer' or record['episode'] is None:
+                continue
+            if record['phase'] == 'train' and self.train_episodes < self.max_episodes:
+                self.train_episodes += 1
+                for name in metric_names:
+                    mean = self.running_means[name].push(record[name])
+                    if mean is not None:
+                        self.train[name].append(mean)
+            elif record['phase'] == 'val':
+                self.val_episode.append(record['episode'])
+                for name in metric_names:
+                    self.val[name].append(record[name])
+        return len(records) > 0
 
 
 def main():
@@ -19,128 +80,63 @@ def main():
     parser.add_argument('--plot_train', default=True, action='store_true')
     parser.add_argument('--plot_val', default=False, action='store_true')
     parser.add_argument('--window_size', type=int, default=200)
+    parser.add_argument('--follow', default=False, action='store_true')
+    parser.add_argument('--interval', type=float, default=5)
     args = parser.parse_args()
 
     # define the names of the models you want to plot and the longest episodes you want to show
     models = ['LSTM-RL', 'SARL', 'OM-SARL']
     max_episodes = 10000
 
-    ax1 = ax2 = ax3 = ax4 = None
-    ax1_legends = []
-    ax2_legends = []
-    ax3_legends = []
-    ax4_legends = []
-
-    for i, log_file in enumerate(args.log_files):
-        with open(log_file, 'r') as file:
-            log = file.read()
-
-        val_pattern = r"VAL   in episode (?P<episode>\d+) has success rate: (?P<sr>[0-1].\d+), " \
-                      r"collision rate: (?P<cr>[0-1].\d+), nav time: (?P<time>\d+.\d+), " \
-                      r"total reward: (?P<reward>[-+]?\d+.\d+)"
-        val_episode = []
-        val_sr = []
-        val_cr = []
-        val_time = []
-        val_reward = []
-        for r in re.findall(val_pattern, log):
-            val_episode.append(int(r[0]))
-            val_sr.append(float(r[1]))
-            val_cr.append(float(r[2]))
-            val_time.append(float(r[3]))
-            val_reward.append(float(r[4]))
-
-        train_pattern = r"TRAIN in episode (?P<episode>\d+) has success rate: (?P<sr>[0-1].\d+), " \
-                        r"collision rate: (?P<cr>[0-1].\d+), nav time: (?P<time>\d+.\d+), " \
-                        r"total reward: (?P<reward>[-+]?\d+.\d+)"
-        train_episode = []
-        train_sr = []
-        train_cr = []
-        train_time = []
-        train_reward = []
-        for r in re.findall(train_pattern, log):
-            train_episode.append(int(r[0]))
-            train_sr.append(float(r[1]))
-            train_cr.append(float(r[2]))
-            train_time.append(float(r[3]))
-            train_reward.append(float(r[4]))
-        train_episode = train_episode[:max_episodes]
-        train_sr = train_sr[:max_episodes]
-        train_cr = train_cr[:max_episodes]
-        train_time = train_time[:max_episodes]
-        train_reward = train_reward[:max_episodes]
-
-        # smooth training plot
-        train_sr_smooth = running_mean(train_sr, args.window_size)
-        train_cr_smooth = running_mean(train_cr, args.window_size)
-        train_time_smooth = running_mean(train_time, args.window_size)
-        train_reward_smooth = running_mean(train_reward, args.window_size)
-
-        # plot sr
-        if args.plot_sr:
-            if ax1 is None:
-                _, ax1 = plt.subplots()
-            if args.plot_train:
-                ax1.plot(range(len(train_sr_smooth)), train_sr_smooth)
-                ax1_legends.append(models[i])
-            if args.plot_val:
-                ax1.plot(val_episode, val_sr)
-                ax1_legends.append(models[i])
-
-            ax1.legend(ax1_legends)
-            ax1.set_xlabel('Episodes')
-            ax1.set_ylabel('Success Rate')
-            ax1.set_title('Success rate')
-
-        # plot time
-        if args.plot_time:
-            if ax2 is None:
-                _, ax2 = plt.subplots()
-            if args.plot_train:
-                ax2.plot(range(len(train_time_smooth)), train_time_smooth)
-                ax2_legends.append(models[i])
-            if args.plot_val:
-                ax2.plot(val_episode, val_time)
-                ax2_legends.append(models[i])
-
-            ax2.legend(ax2_legends)
-            ax2.set_xlabel('Episodes')
-            ax2.set_ylabel('Time(s)')
-            ax2.set_title("Robot's Time to Reach Goal")
-
-        # plot cr
-        if args.plot_cr:
-            if ax3 is None:
-                _, ax3 = plt.subplots()
-            if args.plot_train:
-                ax3.plot(range(len(train_cr_smooth)), train_cr_smooth)
-                ax3_legends.append(models[i])
-            if args.plot_val:
-                ax3.plot(val_episode, val_cr)
-                ax3_legends.append(models[i])
-
-            ax3.legend(ax3_legends)
-            ax3.set_xlabel('Episodes')
-            ax3.set_ylabel('Collision Rate')
-            ax3.set_title('Collision Rate')
-
-        # plot reward
-        if args.plot_reward:
-            if ax4 is None:
-                _, ax4 = plt.subplots()
+    # output directories are read from their metrics file, or from their log if they don't have one
+    input_files = []
+    for log_file in args.log_files:
+        if os.path.isdir(log_file):
+            metrics_file = os.path.join(log_file, 'metrics.jsonl')
+            log_file = metrics_file if os.path.exists(metrics_file) else os.path.join(log_file, 'output.log')
+        input_files.append(log_file)
+    runs = [Curves(input_file, args.window_size, max_episodes) for input_file in input_files]
+
+    plots = [('success_rate', args.plot_sr, 'Success Rate', 'Success rate'),
+             ('nav_time', args.plot_time, 'Time(s)', "Robot's Time to Reach Goal"),
+             ('collision_rate', args.plot_cr, 'Collision Rate', 'Collision Rate'),
+             ('total_reward', args.plot_reward, 'Reward', 'Cumulative Discounted Reward')]
+    lines = []
+    for name, enabled, ylabel, title in plots:
+        if not enabled:
+            continue
+        _, ax = plt.subplots()
+        legends = []
+        for i, run in enumerate(runs):
             if args.plot_train:
-                ax4.plot(range(len(train_reward_smooth)), train_reward_smooth)
-                ax4_legends.append(models[i])
+                lines.append((ax, run, run.train, name, ax.plot([], [])[0]))
+                legends.append(models[i])
             if args.plot_val:
-                ax4.plot(val_episode, val_reward)
-                ax4_legends.append(models[i])
-
-            ax4.legend(ax4_legends)
-            ax4.set_xlabel('Episodes')
-            ax4.set_ylabel('Reward')
-            ax4.set_title('Cumulative Discounted Reward')
-
-    plt.show()
+                lines.append((ax, run, run.val, name, ax.plot([], [])[0]))
+                legends.append(models[i])
+        ax.legend(legends)
+        ax.set_xlabel('Episodes')
+        ax.set_ylabel(ylabel)
+        ax.set_title(title)
+
+    def update():
+        updated = [run.update() for run in runs]
+        for ax, run, curves, name, line in lines:
+            values = curves[name]
+            line.set_data(range(len(values)) if curves is run.train else run.val_episode, values)
+            ax.relim()
+            ax.autoscale_view()
+        return any(updated)
+
+    update()
+    if not args.follow:
+        plt.show()
+        return
+    # redraw whenever the running experiments append new records
+    while plt.get_fignums():
+        if update():
+            plt.draw()
+        plt.pause(args.interval)
 
 
 if __name__ == '__main__':
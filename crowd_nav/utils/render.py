@@ -0,0 +1,27 @@
+import argparse
+import logging
+from crowd_sim.envs.utils.trajectory import TrajectoryArchive
+from crowd_sim.envs.utils.render import render_episodes
+
+
+def main():
+    parser = argparse.ArgumentParser('Render episodes of a trajectory archive')
+    parser.add_argument('trajectory_dir', type=str)
+    parser.add_argument('output_dir', type=str)
+    parser.add_argument('--cases', type=int, nargs='+', default=None)
+    parser.add_argument('--kinematics', type=str, default='holonomic')
+    parser.add_argument('--time_step', type=float, default=0.25)
+    parser.add_argument('--frames', default=False, action='store_true')
+    parser.add_argument('--num_workers', type=int, default=None)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s, %(levelname)s: %(message)s',
+                        datefmt="%Y-%m-%d %H:%M:%S")
+    cases = args.cases if args.cases is not None else range(len(TrajectoryArchive(args.trajectory_dir)))
+    outputs = render_episodes(args.trajectory_dir, cases, args.output_dir, args.kinematics, args.time_step,
+                              args.frames, args.num_workers)
+    logging.info('Rendered %d episodes to %s', len(outputs), args.output_dir)
+
+
+if __name__ == '__main__':
+    main()
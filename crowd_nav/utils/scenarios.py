@@ -0,0 +1,43 @@
+import argparse
+import logging
+import configparser
+import gym
+from crowd_sim.envs.utils.robot import Robot
+from crowd_sim.envs.utils.scenario_bank import build_scenario_bank
+from crowd_nav.policy.policy_factory import policy_factory
+
+
+def main():
+    parser = argparse.ArgumentParser('Generate the val and test cases of a configuration into a scenario bank')
+    parser.add_argument('--env_config', type=str, default='configs/env.config')
+    parser.add_argument('--policy', type=str, default='orca')
+    parser.add_argument('--policy_config', type=str, default='configs/policy.config')
+    parser.add_argument('--square', default=False, action='store_true')
+    parser.add_argument('--circle', default=False, action='store_true')
+    parser.add_argument('--output_dir', type=str, default='data/scenarios')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s, %(levelname)s: %(message)s',
+                        datefmt="%Y-%m-%d %H:%M:%S")
+    # the number of humans in validation cases depends on whether the policy is trained with several humans
+    policy = policy_factory[args.policy]()
+    policy_config = configparser.RawConfigParser()
+    policy_config.read(args.policy_config)
+    policy.configure(policy_config)
+
+    env_config = configparser.RawConfigParser()
+    env_config.read(args.env_config)
+    env = gym.make('CrowdSim-v0')
+    env.configure(env_config)
+    if args.square:
+        env.test_sim = 'square_crossing'
+    if args.circle:
+        env.test_sim = 'circle_crossing'
+    robot = Robot(env_config, 'robot')
+    robot.set_policy(policy)
+    env.set_robot(robot)
+    build_scenario_bank(env, args.output_dir)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,71 +1,164 @@
 import logging
+import copy
+import time
+import torch
 import torch.nn as nn
 import torch.optim as optim
 from torch.autograd import Variable
-from torch.utils.data import DataLoader
+from crowd_sim.envs.utils.profiler import profiler
+from crowd_nav.utils.memory import TransitionMemory
 
 
 class Trainer(object):
-    def __init__(self, model, memory, device, batch_size):
+    def __init__(self, model, memory, device, batch_size, gamma=None):
         """
-        Train the trainable model of a policy
+        Train the trainable model of a policy, the value targets of a TransitionMemory are computed from the
+        target model and gamma when the transitions are sampled
         """
         self.model = model
         self.device = device
         self.criterion = nn.MSELoss().to(device)
         self.memory = memory
-        self.data_loader = None
         self.batch_size = batch_size
+        self.gamma = gamma
+        self.target_model = None
+        # transforms raw states of the memory into inputs of the model, e.g. policy.transform_batch
+        self.transform = None
+        # exponents of the priorities and of the importance-sampling weights of prioritized replay
+        self.priority_alpha = None
+        self.priority_beta = None
+        self.priority_epsilon = None
+        self.beta_annealing_episodes = None
         self.optimizer = None
+        # MetricsWriter that receives the loss of every optimization
+        self.metrics = None
 
     def set_learning_rate(self, learning_rate):
         logging.info('Current learning rate: %f', learning_rate)
         self.optimizer = optim.SGD(self.model.parameters(), lr=learning_rate, momentum=0.9)
 
+    def set_prioritized_replay(self, alpha, beta, epsilon, beta_annealing_episodes):
+        """
+        Sample batches of optimize_batch with probabilities proportional to (|error| + epsilon) ^ alpha, the bias is
+        corrected by importance-sampling weights whose exponent is annealed from beta to 1
+
+        :param beta_annealing_episodes: number of training episodes after which the exponent reaches 1
+        """
+        logging.info('Prioritized replay with alpha %.2f and beta %.2f', alpha, beta)
+        self.priority_alpha = alpha
+        self.priority_beta = beta
+        self.priority_epsilon = epsilon
+        self.beta_annealing_episodes = beta_annealing_episodes
+        self.memory.prioritize()
+
+    def get_priority_beta(self, episode=None):
+        if episode is None or not self.beta_annealing_episodes:
+            return self.priority_beta
+        return min(1.0, self.priority_beta + (1 - self.priority_beta) * episode / self.beta_annealing_episodes)
+
+    def update_target_model(self, target_model):
+        self.target_model = copy.deepcopy(target_model)
+
+    def get_batch(self, indices=None):
+        """
+        Get the experience at the given indices or a random batch of the memory
+
+        :return: states, values and numbers of humans of the batch
+        """
+        batch = self.memory.get_batch(indices) if indices is not None else self.memory.sample(self.batch_size)
+        if not isinstance(self.memory, TransitionMemory):
+            states, values, lengths = batch
+            return self.transform_states(states, lengths), values, lengths
+        states, rewards, lengths, next_states, next_lengths, terminals, dts = batch
+        if self.target_model is None or self.gamma is None:
+            # imitation learning only stores terminal transitions, whose values are their rewards
+            if not terminals.all():
+                raise ValueError('Target model or gamma value is not set!')
+            return self.transform_states(states, lengths), rewards, lengths
+        # the next states of all transitions are evaluated at once, those of terminal transitions are ignored
+        with torch.no_grad():
+            next_values = self.target_model(self.transform_states(next_states, next_lengths), next_lengths)
+        discounts = torch.pow(self.gamma, dts).unsqueeze(1) * (~terminals).unsqueeze(1)
+        return self.transform_states(states, lengths), rewards + discounts * next_values, lengths
+
+    def transform_states(self, states, lengths):
+        if not self.memory.raw_states:
+            return states
+        if self.transform is None:
+            raise ValueError('Transform of raw states is not set!')
+        return self.transform(states, lengths)
+
     def optimize_epoch(self, num_epochs):
         if self.optimizer is None:
             raise ValueError('Learning rate is not set!')
-        if self.data_loader is None:
-            self.data_loader = DataLoader(self.memory, self.batch_size, shuffle=True)
+        start = time.perf_counter()
         average_epoch_loss = 0
-        for epoch in range(num_epochs):
-            epoch_loss = 0
-            for data in self.data_loader:
-                inputs, values = data
-                inputs = Variable(inputs)
-                values = Variable(values)
+        with profiler.section('optimize_epoch'):
+            for epoch in range(num_epochs):
+                epoch_loss = 0
+                permutation = torch.randperm(len(self.memory), device=self.memory.states.device)
+                for indices in permutation.split(self.batch_size):
+                    with profiler.section('sample'):
+                        inputs, values, lengths = self.get_batch(indices)
+                    inputs = Variable(inputs)
+                    values = Variable(values)
 
-                self.optimizer.zero_grad()
-                outputs = self.model(inputs)
-                loss = self.criterion(outputs, values)
-                loss.backward()
-                self.optimizer.step()
-                epoch_loss += loss.data.item()
+                    self.optimizer.zero_grad()
+                    with profiler.section('forward'):
+                        outputs = self.model(inputs, lengths)
+                        loss = self.criterion(outputs, values)
+                    with profiler.section('backward'):
+                        loss.backward()
+                        self.optimizer.step()
+                    epoch_loss += loss.data.item()
 
-            average_epoch_loss = epoch_loss / len(self.memory)
-            logging.debug('Average loss in epoch %d: %.2E', epoch, average_epoch_loss)
+                average_epoch_loss = epoch_loss / len(self.memory)
+                logging.debug('Average loss in epoch %d: %.2E', epoch, average_epoch_loss)
 
+        if self.metrics is not None:
+            self.metrics.write('trainer', epochs=num_epochs, loss=average_epoch_loss,
+                               duration=time.perf_counter() - start)
         return average_epoch_loss
 
-    def optimize_batch(self, num_batches):
+    def optimize_batch(self, num_batches, episode=None):
         if self.optimizer is None:
             raise ValueError('Learning rate is not set!')
-        if self.data_loader is None:
-            self.data_loader = DataLoader(self.memory, self.batch_size, shuffle=True)
+        start = time.perf_counter()
+        prioritized = self.memory.sum_tree is not None
+        beta = self.get_priority_beta(episode) if prioritized else None
         losses = 0
-        for _ in range(num_batches):
-            inputs, values = next(iter(self.data_loader))
-            inputs = Variable(inputs)
-            values = Variable(values)
-
-            self.optimizer.zero_grad()
-            outputs = self.model(inputs)
-            loss = self.criterion(outputs, values)
-            loss.backward()
-            self.optimizer.step()
-            losses += loss.data.item()
+        with profiler.section('optimize_batch'):
+            for _ in range(num_batches):
+                with profiler.section('sample'):
+                    if prioritized:
+                        indices, weights = self.memory.sample_prioritized(self.batch_size, beta)
+                        inputs, values, lengths = self.get_batch(indices)
+                    else:
+                        inputs, values, lengths = self.get_batch()
+                inputs = Variable(inputs)
+                values = Variable(values)
+
+                self.optimizer.zero_grad()
+                with profiler.section('forward'):
+                    outputs = self.model(inputs, lengths)
+                    if prioritized:
+                        errors = (outputs - values).view(-1)
+                        loss = (weights * errors ** 2).mean()
+                    else:
+                        loss = self.criterion(outputs, values)
+                with profiler.section('backward'):
+                    loss.backward()
+                    self.optimizer.step()
+                if prioritized:
+                    with profiler.section('update_priorities'):
+                        priorities = (errors.detach().abs() + self.priority_epsilon) ** self.priority_alpha
+                        self.memory.update_priorities(indices, priorities)
+                losses += loss.data.item()
 
         average_loss = losses / num_batches
         logging.debug('Average loss : %.2E', average_loss)
 
+        if self.metrics is not None:
+            self.metrics.write('trainer', episode=episode, batches=num_batches, loss=average_loss,
+                               duration=time.perf_counter() - start)
         return average_loss
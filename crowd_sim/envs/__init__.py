@@ -1 +1,2 @@
 from .crowd_sim import CrowdSim
+from .vec_crowd_sim import VecCrowdSim
@@ -1,3 +1,4 @@
+import os
 import logging
 import gym
 import matplotlib.lines as mlines
@@ -6,8 +7,15 @@ import rvo2
 from matplotlib import patches
 from numpy.linalg import norm
 from crowd_sim.envs.utils.human import Human
+from crowd_sim.envs.policy.centralized_orca import CentralizedORCA
+from crowd_sim.envs.utils.state import CrowdState, ObservableStateList
 from crowd_sim.envs.utils.info import *
-from crowd_sim.envs.utils.utils import point_to_segment_dist
+from crowd_sim.envs.utils.action import ActionXY
+from crowd_sim.envs.utils.utils import batch_point_to_segment_dist, find_colliding_pairs
+from crowd_sim.envs.utils.trajectory import Trajectory
+from crowd_sim.envs.utils.render import TrajectoryRenderer
+from crowd_sim.envs.utils.profiler import profiler
+from crowd_sim.envs.utils.scenario_bank import ScenarioBank
 
 
 class CrowdSim(gym.Env):
@@ -43,10 +51,24 @@ class CrowdSim(gym.Env):
         self.square_width = None
         self.circle_radius = None
         self.human_num = None
-        # for visualization
-        self.states = None
-        self.action_values = None
-        self.attention_weights = None
+        # rejection sampling of the scenarios of each phase, see sample_free_position
+        self.scenario_generator = None
+        self.generation_batch_size = 64
+        # the legacy mode rarely gives up, so it reproduces the original cases of all feasible arenas
+        self.max_generation_tries = {'legacy': 100000, 'batched': 10000}
+        # number of humans placed too close to other agents in the last generated scenario
+        self.crowded_placements = 0
+        # struct-of-arrays state of the robot (index 0) and humans (index 1 to n)
+        self.crowd_state = None
+        # human actions of the current step, shared by all lookahead queries
+        self.human_actions = None
+        # one ORCA simulator for all humans of an episode, None if humans can't be simulated together
+        self.orca_engine = None
+        # for visualization, states, action values and attention weights are only recorded when enabled
+        self.record_trajectory = False
+        self.trajectory = None
+        # pre-generated val and test cases, see load_scenario_bank
+        self.scenario_bank = None
 
     def configure(self, config):
         self.config = config
@@ -66,6 +88,9 @@ class CrowdSim(gym.Env):
             self.square_width = config.getfloat('sim', 'square_width')
             self.circle_radius = config.getfloat('sim', 'circle_radius')
             self.human_num = config.getint('sim', 'human_num')
+            # configurations without generators keep the original sampling
+            self.scenario_generator = {phase: config.get('sim', phase + '_generator', fallback='legacy')
+                                       for phase in ['train', 'val', 'test']}
         else:
             raise NotImplementedError
         self.case_counter = {'train': 0, 'test': 0, 'val': 0}
@@ -77,11 +102,49 @@ class CrowdSim(gym.Env):
             logging.info("Not randomize human's radius and preferred speed")
         logging.info('Training simulation: {}, test simulation: {}'.format(self.train_val_sim, self.test_sim))
         logging.info('Square width: {}, circle width: {}'.format(self.square_width, self.circle_radius))
+        logging.info('Scenario generators: {}'.format(', '.join('{} {}'.format(phase, generator) for phase, generator
+                                                                 in self.scenario_generator.items())))
 
     def set_robot(self, robot):
         self.robot = robot
 
-    def generate_random_human_position(self, human_num, rule):
+    def load_scenario_bank(self, directory):
+        """
+        Play val and test cases from the bank that build_scenario_bank wrote for the current configuration, the robot
+        and its policy have to be set. Cases are generated as usual if there is no bank for this configuration
+
+        :return: whether a bank was found
+        """
+        bank_file = ScenarioBank.get_file(directory, self)
+        if not os.path.exists(bank_file):
+            logging.warning('No scenario bank for this configuration in %s, cases are generated', directory)
+            self.scenario_bank = None
+            return False
+        self.scenario_bank = ScenarioBank(bank_file)
+        logging.info('Load %d val and test cases from %s', len(self.scenario_bank), bank_file)
+        return True
+
+    def set_case_humans(self, phase, human_states, human_num):
+        """
+        Create the humans of a case stored in the scenario bank. Without the mixed scenario, the number of humans of a
+        case is the current human_num, which a previously played mixed scenario may have changed, so stored cases of
+        another size are rejected and generated instead
+
+        :return: whether the humans were created
+        """
+        rule = self.test_sim if phase == 'test' else self.train_val_sim
+        if rule == 'mixed':
+            self.human_num = human_num
+        elif human_num != (self.human_num if phase == 'test' or self.robot.policy.multiagent_training else 1):
+            return False
+        self.humans = []
+        for px, py, gx, gy, radius, v_pref in human_states.tolist():
+            human = Human(self.config, 'humans')
+            human.set(px, py, gx, gy, 0, 0, 0, radius, v_pref)
+            self.humans.append(human)
+        return True
+
+    def generate_random_human_position(self, human_num, rule, mode='legacy'):
         """
         Generate human position according to certain rule
         Rule square_crossing: generate start/goal position at two sides of y-axis
@@ -89,17 +152,20 @@ class CrowdSim(gym.Env):
 
         :param human_num:
         :param rule:
+        :param mode: legacy or batched rejection sampling, see sample_free_position
         :return:
         """
+        self.crowded_placements = 0
         # initial min separation distance to avoid danger penalty at beginning
-        if rule == 'square_crossing':
+        if rule in ['square_crossing', 'circle_crossing']:
+            generate_human = self.generate_square_crossing_human if rule == 'square_crossing' else \
+                self.generate_circle_crossing_human
             self.humans = []
+            agents = self.get_agent_array()
             for i in range(human_num):
-                self.humans.append(self.generate_square_crossing_human())
-        elif rule == 'circle_crossing':
-            self.humans = []
-            for i in range(human_num):
-                self.humans.append(self.generate_circle_crossing_human())
+                human = generate_human(mode, agents)
+                self.humans.append(human)
+                agents = np.concatenate([agents, self.get_agent_array([human])])
         elif rule == 'mixed':
             # mix different raining simulation with certain distribution
             static_human_num = {0: 0.05, 1: 0.2, 2: 0.2, 3: 0.3, 4: 0.1, 5: 0.15}
@@ -122,87 +188,133 @@ class CrowdSim(gym.Env):
                     human = Human(self.config, 'humans')
                     human.set(0, -10, 0, -10, 0, 0, 0)
                     self.humans.append(human)
+                agents = self.get_agent_array()
                 for i in range(human_num):
                     human = Human(self.config, 'humans')
                     if np.random.random() > 0.5:
                         sign = -1
                     else:
                         sign = 1
-                    while True:
-                        px = np.random.random() * width * 0.5 * sign
-                        py = (np.random.random() - 0.5) * height
-                        collide = False
-                        for agent in [self.robot] + self.humans:
-                            if norm((px - agent.px, py - agent.py)) < human.radius + agent.radius + self.discomfort_dist:
-                                collide = True
-                                break
-                        if not collide:
-                            break
+                    px, py = self.sample_free_position(lambda n: self.draw_rectangle(n, width, height, sign),
+                                                       agents[:, :2], human.radius + agents[:, 4] +
+                                                       self.discomfort_dist, mode)
                     human.set(px, py, px, py, 0, 0, 0)
                     self.humans.append(human)
+                    agents = np.concatenate([agents, self.get_agent_array([human])])
             else:
                 # the first 2 two humans will be in the circle crossing scenarios
                 # the rest humans will have a random starting and end position
                 for i in range(human_num):
                     if i < 2:
-                        human = self.generate_circle_crossing_human()
+                        human = self.generate_circle_crossing_human(mode)
                     else:
-                        human = self.generate_square_crossing_human()
+                        human = self.generate_square_crossing_human(mode)
                     self.humans.append(human)
         else:
             raise ValueError("Rule doesn't exist")
+        if self.crowded_placements:
+            logging.warning('The arena is too crowded, %d start or goal positions are closer to other agents than the '
+                            'minimal separation', self.crowded_placements)
+
+    def get_agent_array(self, agents=None):
+        """
+        :param agents: list of agents, defaults to the robot and the humans
+        :return: array of shape (# agents, 5) with the positions, goals and radii of the agents
+        """
+        if agents is None:
+            agents = [self.robot] + self.humans
+        return np.array([[agent.px, agent.py, agent.gx, agent.gy, agent.radius] for agent in agents]).reshape(-1, 5)
+
+    def sample_free_position(self, draw, centers, min_dist, mode):
+        """
+        Rejection sample a position that keeps a minimal distance to some centers, the candidates are checked against
+        all centers at once. The legacy mode draws one candidate at a time and consumes the random numbers of the
+        original generation loop, the batched mode doubles the number of candidates it draws at once after every
+        rejected batch, up to generation_batch_size.
+        When no candidate is free after max_generation_tries, the arena is too crowded and the candidate with the
+        largest clearance is taken instead of sampling forever
+
+        :param draw: function of a number of candidates returning the arrays of their x and y coordinates
+        :param centers: array of shape (# centers, 2)
+        :param min_dist: array of shape (# centers, ) with the minimal distance to each center
+        :param mode: legacy or batched
+        :return: x and y coordinates
+        """
+        if mode not in ['legacy', 'batched']:
+            raise ValueError('Unknown generation mode {}'.format(mode))
+        batch_size = 1
+        best_position = None
+        best_clearance = float('-inf')
+        tries = 0
+        while tries < self.max_generation_tries[mode]:
+            x, y = draw(batch_size)
+            tries += batch_size
+            dx = x[:, np.newaxis] - centers[:, 0]
+            dy = y[:, np.newaxis] - centers[:, 1]
+            dist = np.sqrt(dx * dx + dy * dy)
+            free = (dist >= min_dist).all(axis=1)
+            if free.any():
+                i = free.argmax()
+                return x[i], y[i]
+            clearance = (dist - min_dist).min(axis=1)
+            i = clearance.argmax()
+            if clearance[i] > best_clearance:
+                best_position = (x[i], y[i])
+                best_clearance = clearance[i]
+            if mode == 'batched':
+                batch_size = min(batch_size * 2, self.generation_batch_size)
+        self.crowded_placements += 1
+        return best_position
+
+    @staticmethod
+    def draw_rectangle(n, width, height, sign):
+        """
+        Draw positions uniformly on one half of a rectangle centered at the origin, the random numbers of a position
+        are consecutive
+
+        :param sign: 1 for the half with positive x, -1 for the other one
+        """
+        samples = np.random.random((n, 2))
+        return samples[:, 0] * width * 0.5 * sign, (samples[:, 1] - 0.5) * height
 
-    def generate_circle_crossing_human(self):
+    def generate_circle_crossing_human(self, mode='legacy', agents=None):
         human = Human(self.config, 'humans')
         if self.randomize_attributes:
             human.sample_random_attributes()
-        while True:
-            angle = np.random.random() * np.pi * 2
+        if agents is None:
+            agents = self.get_agent_array()
+        v_pref = human.v_pref
+
+        def draw(n):
+            samples = np.random.random((n, 3))
+            angle = samples[:, 0] * np.pi * 2
             # add some noise to simulate all the possible cases robot could meet with human
-            px_noise = (np.random.random() - 0.5) * human.v_pref
-            py_noise = (np.random.random() - 0.5) * human.v_pref
-            px = self.circle_radius * np.cos(angle) + px_noise
-            py = self.circle_radius * np.sin(angle) + py_noise
-            collide = False
-            for agent in [self.robot] + self.humans:
-                min_dist = human.radius + agent.radius + self.discomfort_dist
-                if norm((px - agent.px, py - agent.py)) < min_dist or \
-                        norm((px - agent.gx, py - agent.gy)) < min_dist:
-                    collide = True
-                    break
-            if not collide:
-                break
+            px_noise = (samples[:, 1] - 0.5) * v_pref
+            py_noise = (samples[:, 2] - 0.5) * v_pref
+            return self.circle_radius * np.cos(angle) + px_noise, self.circle_radius * np.sin(angle) + py_noise
+
+        # the start keeps the distance to the positions and the goals of the other agents
+        min_dist = human.radius + agents[:, 4] + self.discomfort_dist
+        px, py = self.sample_free_position(draw, np.concatenate([agents[:, :2], agents[:, 2:4]]),
+                                           np.concatenate([min_dist, min_dist]), mode)
         human.set(px, py, -px, -py, 0, 0, 0)
         return human
 
-    def generate_square_crossing_human(self):
+    def generate_square_crossing_human(self, mode='legacy', agents=None):
         human = Human(self.config, 'humans')
         if self.randomize_attributes:
             human.sample_random_attributes()
+        if agents is None:
+            agents = self.get_agent_array()
         if np.random.random() > 0.5:
             sign = -1
         else:
             sign = 1
-        while True:
-            px = np.random.random() * self.square_width * 0.5 * sign
-            py = (np.random.random() - 0.5) * self.square_width
-            collide = False
-            for agent in [self.robot] + self.humans:
-                if norm((px - agent.px, py - agent.py)) < human.radius + agent.radius + self.discomfort_dist:
-                    collide = True
-                    break
-            if not collide:
-                break
-        while True:
-            gx = np.random.random() * self.square_width * 0.5 * -sign
-            gy = (np.random.random() - 0.5) * self.square_width
-            collide = False
-            for agent in [self.robot] + self.humans:
-                if norm((gx - agent.gx, gy - agent.gy)) < human.radius + agent.radius + self.discomfort_dist:
-                    collide = True
-                    break
-            if not collide:
-                break
+        min_dist = human.radius + agents[:, 4] + self.discomfort_dist
+        px, py = self.sample_free_position(lambda n: self.draw_rectangle(n, self.square_width, self.square_width,
+                                                                         sign), agents[:, :2], min_dist, mode)
+        gx, gy = self.sample_free_position(lambda n: self.draw_rectangle(n, self.square_width, self.square_width,
+                                                                         -sign), agents[:, 2:4], min_dist, mode)
         human.set(px, py, gx, gy, 0, 0, 0)
         return human
 
@@ -243,7 +355,8 @@ class CrowdSim(gym.Env):
             self.robot.set_position(sim.getAgentPosition(0))
             for i, human in enumerate(self.humans):
                 human.set_position(sim.getAgentPosition(i + 1))
-            self.states.append([self.robot.get_full_state(), [human.get_full_state() for human in self.humans]])
+            if self.trajectory is not None:
+                self.trajectory.append(self.crowd_state.data)
 
         del sim
         return self.human_times
@@ -259,10 +372,6 @@ class CrowdSim(gym.Env):
         if test_case is not None:
             self.case_counter[phase] = test_case
         self.global_time = 0
-        if phase == 'test':
-            self.human_times = [0] * self.human_num
-        else:
-            self.human_times = [0] * (self.human_num if self.robot.policy.multiagent_training else 1)
         if not self.robot.policy.multiagent_training:
             self.train_val_sim = 'circle_crossing'
 
@@ -273,12 +382,19 @@ class CrowdSim(gym.Env):
                               'val': 0, 'test': self.case_capacity['val']}
             self.robot.set(0, -self.circle_radius, 0, self.circle_radius, 0, 0, np.pi / 2)
             if self.case_counter[phase] >= 0:
-                np.random.seed(counter_offset[phase] + self.case_counter[phase])
-                if phase in ['train', 'val']:
-                    human_num = self.human_num if self.robot.policy.multiagent_training else 1
-                    self.generate_random_human_position(human_num=human_num, rule=self.train_val_sim)
-                else:
-                    self.generate_random_human_position(human_num=self.human_num, rule=self.test_sim)
+                case = None
+                if self.scenario_bank is not None:
+                    case = self.scenario_bank.get_case(phase, self.case_counter[phase])
+                # stored cases are identical to the generated ones
+                if case is None or not self.set_case_humans(phase, *case):
+                    np.random.seed(counter_offset[phase] + self.case_counter[phase])
+                    if phase in ['train', 'val']:
+                        human_num = self.human_num if self.robot.policy.multiagent_training else 1
+                        self.generate_random_human_position(human_num=human_num, rule=self.train_val_sim,
+                                                            mode=self.scenario_generator[phase])
+                    else:
+                        self.generate_random_human_position(human_num=self.human_num, rule=self.test_sim,
+                                                            mode=self.scenario_generator[phase])
                 # case_counter is always between 0 and case_size[phase]
                 self.case_counter[phase] = (self.case_counter[phase] + 1) % self.case_size[phase]
             else:
@@ -293,133 +409,278 @@ class CrowdSim(gym.Env):
                 else:
                     raise NotImplementedError
 
+        # the mixed scenario draws its own number of humans
+        self.human_times = [0] * len(self.humans)
+        self.set_crowd_state(CrowdState(len(self.humans) + 1))
         for agent in [self.robot] + self.humans:
             agent.time_step = self.time_step
             agent.policy.time_step = self.time_step
+        self.human_actions = None
+        human_policies = [human.policy for human in self.humans]
+        self.orca_engine = CentralizedORCA(human_policies[0]) if CentralizedORCA.can_simulate(human_policies) else None
 
-        self.states = list()
-        if hasattr(self.robot.policy, 'action_values'):
-            self.action_values = list()
-        if hasattr(self.robot.policy, 'get_attention_weights'):
-            self.attention_weights = list()
+        if self.record_trajectory:
+            self.trajectory = Trajectory(len(self.humans) + 1, int(np.ceil(self.time_limit / self.time_step)) + 1)
+        else:
+            self.trajectory = None
 
         # get current observation
         if self.robot.sensor == 'coordinates':
-            ob = [human.get_observable_state() for human in self.humans]
+            ob = self.crowd_state.get_observable_states(slice(1, None))
         elif self.robot.sensor == 'RGB':
             raise NotImplementedError
 
         return ob
 
+    def set_crowd_state(self, crowd_state):
+        """
+        Move the states of the robot and humans into the given store, robot at index 0 and humans after it
+
+        """
+        self.crowd_state = crowd_state
+        for i, agent in enumerate([self.robot] + self.humans):
+            agent.bind(crowd_state, i)
+
     def onestep_lookahead(self, action):
         return self.step(action, update=False)
 
+    def onestep_lookahead_batch(self, actions):
+        """
+        Evaluate all candidate robot actions at once without updating the environment.
+        Human actions don't depend on the robot action, so they are computed once per step and
+        only the collision, discomfort and goal checks are done for every action.
+
+        :param actions: list of robot actions
+        :return: next observation shared by all actions, arrays of rewards and dones, list of infos
+        """
+        human_actions = self.get_human_actions()
+        if self.robot.kinematics == 'holonomic':
+            robot_vx = np.array([action.vx for action in actions])
+            robot_vy = np.array([action.vy for action in actions])
+            end_px = self.robot.px + robot_vx * self.time_step
+            end_py = self.robot.py + robot_vy * self.time_step
+        else:
+            robot_v = np.array([action.v for action in actions])
+            robot_theta = np.array([action.r for action in actions]) + self.robot.theta
+            robot_vx = robot_v * np.cos(robot_theta)
+            robot_vy = robot_v * np.sin(robot_theta)
+            end_px = self.robot.px + np.cos(robot_theta) * robot_v * self.time_step
+            end_py = self.robot.py + np.sin(robot_theta) * robot_v * self.time_step
+
+        with profiler.section('check'):
+            # collision detection, arrays are of shape (# actions, # humans)
+            closest_dist = self.compute_closest_dist(robot_vx[:, None], robot_vy[:, None])
+            collision = np.any(closest_dist < 0, axis=1)
+            dmin = np.min(closest_dist, axis=1, initial=float('inf'))
+
+            # check if reaching the goal
+            reaching_goal = np.hypot(end_px - self.robot.gx, end_py - self.robot.gy) < self.robot.radius
+
+            timeout = np.full(len(actions), self.global_time >= self.time_limit - 1)
+            rewards, dones = self.compute_rewards(timeout, collision, reaching_goal, dmin)
+            infos = self.get_infos(timeout, collision, reaching_goal, dmin)
+
+        if self.robot.sensor == 'coordinates':
+            ob = self.get_next_human_observation(human_actions)
+        elif self.robot.sensor == 'RGB':
+            raise NotImplementedError
+
+        return ob, rewards, dones, infos
+
+    def compute_rewards(self, timeout, collision, reaching_goal, dmin):
+        """
+        Reward function applied element-wise to arrays of check results
+
+        :return: arrays of rewards and dones
+        """
+        danger = dmin < self.discomfort_dist
+        rewards = np.select([timeout, collision, reaching_goal, danger],
+                            [0, self.collision_penalty, self.success_reward,
+                             (dmin - self.discomfort_dist) * self.discomfort_penalty_factor * self.time_step], 0)
+        dones = timeout | collision | reaching_goal
+        return rewards, dones
+
+    def get_infos(self, timeout, collision, reaching_goal, dmin):
+        return [Timeout() if timeout[i] else Collision() if collision[i] else ReachGoal() if reaching_goal[i]
+                else Danger(dmin[i]) if dmin[i] < self.discomfort_dist else Nothing() for i in range(len(dmin))]
+
+    def compute_closest_dist(self, robot_vx, robot_vy, data=None):
+        """
+        Swept-circle collision kernel. In the frame of the robot, each human moves along a segment during one
+        time step and the closest distance between the boundaries of the robot and the human is computed for
+        all humans in one call.
+
+        :param robot_vx: robot velocity, broadcast against the arrays of humans
+        :param robot_vy:
+        :param data: crowd state arrays of shape (..., 9, # humans + 1), defaults to the ones of this environment
+        :return: array of closest distances of shape broadcast(robot_vx, data[..., 0, 1:])
+        """
+        if data is None:
+            data = self.crowd_state.data
+        px = data[..., 0, 1:] - data[..., 0, :1]
+        py = data[..., 1, 1:] - data[..., 1, :1]
+        vx = data[..., 2, 1:] - robot_vx
+        vy = data[..., 3, 1:] - robot_vy
+        ex = px + vx * self.time_step
+        ey = py + vy * self.time_step
+        return batch_point_to_segment_dist(px, py, ex, ey, 0, 0) - data[..., 4, 1:] - data[..., 4, :1]
+
+    def get_human_collisions(self):
+        """
+        Detect collisions between humans in the current step
+
+        :return: array of shape (# collisions, 2) with pairs of human indices
+        """
+        state = self.crowd_state
+        return find_colliding_pairs(state.px[1:], state.py[1:], state.radius[1:])
+
+    def get_human_actions(self):
+        """
+        Compute actions for all humans in the current step. Humans only observe the current states of the
+        other agents, so the result is cached until the environment is updated.
+
+        """
+        if self.human_actions is not None:
+            return self.human_actions
+        with profiler.section('human_actions'):
+            if self.orca_engine is not None:
+                data = self.crowd_state.data
+                self.human_actions = self.orca_engine.predict(data[:, 1:].T,
+                                                              data[:5, 0] if self.robot.visible else None)
+            else:
+                self.human_actions = []
+                observable_states = self.crowd_state.get_observable_states().array
+                human_indices = np.arange(1, len(self.humans) + 1)
+                for i, human in enumerate(self.humans):
+                    # observation for humans is always coordinates, the robot is appended after the other humans
+                    indices = human_indices[human_indices != i + 1]
+                    if self.robot.visible:
+                        indices = np.append(indices, 0)
+                    self.human_actions.append(human.act(ObservableStateList(observable_states[indices])))
+        return self.human_actions
+
+    def get_next_human_observation(self, human_actions):
+        """
+        Propagate the observable states of all humans by their actions without updating the environment
+
+        """
+        if any(human.kinematics != 'holonomic' for human in self.humans):
+            return [human.get_next_observable_state(action) for human, action in zip(self.humans, human_actions)]
+        next_states = self.crowd_state.get_observable_states(slice(1, None)).array
+        next_states[:, 2] = [action.vx for action in human_actions]
+        next_states[:, 3] = [action.vy for action in human_actions]
+        next_states[:, 0] += next_states[:, 2] * self.time_step
+        next_states[:, 1] += next_states[:, 3] * self.time_step
+        return ObservableStateList(next_states)
+
+    def update_humans(self, human_actions):
+        """
+        Perform the actions of all humans, holonomic humans are updated directly in the crowd state arrays
+
+        """
+        if any(human.kinematics != 'holonomic' for human in self.humans):
+            for human, human_action in zip(self.humans, human_actions):
+                human.step(human_action)
+            return
+        for human_action in human_actions:
+            assert isinstance(human_action, ActionXY)
+        state = self.crowd_state
+        state.vx[1:] = [human_action.vx for human_action in human_actions]
+        state.vy[1:] = [human_action.vy for human_action in human_actions]
+        state.px[1:] += state.vx[1:] * self.time_step
+        state.py[1:] += state.vy[1:] * self.time_step
+
     def step(self, action, update=True):
         """
         Compute actions for all agents, detect collision, update environment and return (ob, reward, done, info)
 
         """
-        human_actions = []
-        for human in self.humans:
-            # observation for humans is always coordinates
-            ob = [other_human.get_observable_state() for other_human in self.humans if other_human != human]
-            if self.robot.visible:
-                ob += [self.robot.get_observable_state()]
-            human_actions.append(human.act(ob))
-
-        # collision detection
-        dmin = float('inf')
-        collision = False
-        for i, human in enumerate(self.humans):
-            px = human.px - self.robot.px
-            py = human.py - self.robot.py
+        human_actions = self.get_human_actions()
+
+        with profiler.section('check'):
+            # collision detection
             if self.robot.kinematics == 'holonomic':
-                vx = human.vx - action.vx
-                vy = human.vy - action.vy
+                robot_vx = action.vx
+                robot_vy = action.vy
             else:
-                vx = human.vx - action.v * np.cos(action.r + self.robot.theta)
-                vy = human.vy - action.v * np.sin(action.r + self.robot.theta)
-            ex = px + vx * self.time_step
-            ey = py + vy * self.time_step
-            # closest distance between boundaries of two agents
-            closest_dist = point_to_segment_dist(px, py, ex, ey, 0, 0) - human.radius - self.robot.radius
-            if closest_dist < 0:
-                collision = True
-                # logging.debug("Collision: distance between robot and p{} is {:.2E}".format(i, closest_dist))
-                break
-            elif closest_dist < dmin:
-                dmin = closest_dist
-
-        # collision detection between humans
-        human_num = len(self.humans)
-        for i in range(human_num):
-            for j in range(i + 1, human_num):
-                dx = self.humans[i].px - self.humans[j].px
-                dy = self.humans[i].py - self.humans[j].py
-                dist = (dx ** 2 + dy ** 2) ** (1 / 2) - self.humans[i].radius - self.humans[j].radius
-                if dist < 0:
+                robot_vx = action.v * np.cos(action.r + self.robot.theta)
+                robot_vy = action.v * np.sin(action.r + self.robot.theta)
+            closest_dist = self.compute_closest_dist(robot_vx, robot_vy)
+            collision = bool(np.any(closest_dist < 0))
+            dmin = float(np.min(closest_dist, initial=float('inf')))
+
+            # collision detection between humans, only done when someone consumes the result
+            if logging.getLogger().isEnabledFor(logging.DEBUG):
+                for i, j in self.get_human_collisions():
                     # detect collision but don't take humans' collision into account
-                    logging.debug('Collision happens between humans in step()')
-
-        # check if reaching the goal
-        end_position = np.array(self.robot.compute_position(action, self.time_step))
-        reaching_goal = norm(end_position - np.array(self.robot.get_goal_position())) < self.robot.radius
-
-        if self.global_time >= self.time_limit - 1:
-            reward = 0
-            done = True
-            info = Timeout()
-        elif collision:
-            reward = self.collision_penalty
-            done = True
-            info = Collision()
-        elif reaching_goal:
-            reward = self.success_reward
-            done = True
-            info = ReachGoal()
-        elif dmin < self.discomfort_dist:
-            # only penalize agent for getting too close if it's visible
-            # adjust the reward based on FPS
-            reward = (dmin - self.discomfort_dist) * self.discomfort_penalty_factor * self.time_step
-            done = False
-            info = Danger(dmin)
-        else:
-            reward = 0
-            done = False
-            info = Nothing()
+                    logging.debug('Collision happens between humans %d and %d in step()', i, j)
+
+            # check if reaching the goal
+            end_position = np.array(self.robot.compute_position(action, self.time_step))
+            reaching_goal = norm(end_position - np.array(self.robot.get_goal_position())) < self.robot.radius
+
+            if self.global_time >= self.time_limit - 1:
+                reward = 0
+                done = True
+                info = Timeout()
+            elif collision:
+                reward = self.collision_penalty
+                done = True
+                info = Collision()
+            elif reaching_goal:
+                reward = self.success_reward
+                done = True
+                info = ReachGoal()
+            elif dmin < self.discomfort_dist:
+                # only penalize agent for getting too close if it's visible
+                # adjust the reward based on FPS
+                reward = (dmin - self.discomfort_dist) * self.discomfort_penalty_factor * self.time_step
+                done = False
+                info = Danger(dmin)
+            else:
+                reward = 0
+                done = False
+                info = Nothing()
 
         if update:
-            # store state, action value and attention weights
-            self.states.append([self.robot.get_full_state(), [human.get_full_state() for human in self.humans]])
-            if hasattr(self.robot.policy, 'action_values'):
-                self.action_values.append(self.robot.policy.action_values)
-            if hasattr(self.robot.policy, 'get_attention_weights'):
-                self.attention_weights.append(self.robot.policy.get_attention_weights())
-
-            # update all agents
-            self.robot.step(action)
-            for i, human_action in enumerate(human_actions):
-                self.humans[i].step(human_action)
-            self.global_time += self.time_step
-            for i, human in enumerate(self.humans):
-                # only record the first time the human reaches the goal
-                if self.human_times[i] == 0 and human.reached_destination():
-                    self.human_times[i] = self.global_time
-
-            # compute the observation
-            if self.robot.sensor == 'coordinates':
-                ob = [human.get_observable_state() for human in self.humans]
-            elif self.robot.sensor == 'RGB':
-                raise NotImplementedError
+            with profiler.section('update'):
+                # store state, action value and attention weights
+                if self.trajectory is not None:
+                    self.trajectory.append(self.crowd_state.data, getattr(self.robot.policy, 'action_values', None),
+                                           self.robot.policy.get_attention_weights()
+                                           if hasattr(self.robot.policy, 'get_attention_weights') else None)
+
+                # update all agents
+                self.robot.step(action)
+                self.update_humans(human_actions)
+                self.global_time += self.time_step
+                self.human_actions = None
+                state = self.crowd_state
+                reached = np.hypot(state.px[1:] - state.gx[1:], state.py[1:] - state.gy[1:]) < state.radius[1:]
+                for i in np.flatnonzero(reached):
+                    # only record the first time the human reaches the goal
+                    if self.human_times[i] == 0:
+                        self.human_times[i] = self.global_time
+
+                # compute the observation
+                if self.robot.sensor == 'coordinates':
+                    ob = self.crowd_state.get_observable_states(slice(1, None))
+                elif self.robot.sensor == 'RGB':
+                    raise NotImplementedError
         else:
             if self.robot.sensor == 'coordinates':
-                ob = [human.get_next_observable_state(action) for human, action in zip(self.humans, human_actions)]
+                ob = self.get_next_human_observation(human_actions)
             elif self.robot.sensor == 'RGB':
                 raise NotImplementedError
 
         return ob, reward, done, info
 
-    def render(self, mode='human', output_file=None):
+    def render(self, mode='human', output_file=None, trajectory=None):
+        """
+        Show the current state (human), the trajectories (traj) or an animation (video) of an episode
+
+        :param trajectory: recorded episode to render, defaults to the trajectory of the last episode
+        """
         from matplotlib import animation
         import matplotlib.pyplot as plt
         plt.rcParams['animation.ffmpeg_path'] = '/usr/bin/ffmpeg'
@@ -441,7 +702,20 @@ class CrowdSim(gym.Env):
                 ax.add_artist(human_circle)
             ax.add_artist(plt.Circle(self.robot.get_position(), self.robot.radius, fill=True, color='r'))
             plt.show()
-        elif mode == 'traj':
+            return
+
+        if trajectory is None:
+            trajectory = self.trajectory
+        if trajectory is None:
+            raise ValueError('No trajectory is recorded, set record_trajectory before resetting the environment')
+        states = trajectory.states
+        human_num = trajectory.agent_num - 1
+        robot_radius = float(states[0, 0, 4])
+        human_radii = states[0, 1:, 4].tolist()
+        robot_positions = states[:, 0, :2].tolist()
+        human_positions = states[:, 1:, :2].tolist()
+        attention_weights = trajectory.attention_weights
+        if mode == 'traj':
             fig, ax = plt.subplots(figsize=(7, 7))
             ax.tick_params(labelsize=16)
             ax.set_xlim(-5, 5)
@@ -449,39 +723,39 @@ class CrowdSim(gym.Env):
             ax.set_xlabel('x(m)', fontsize=16)
             ax.set_ylabel('y(m)', fontsize=16)
 
-            robot_positions = [self.states[i][0].position for i in range(len(self.states))]
-            human_positions = [[self.states[i][1][j].position for j in range(len(self.humans))]
-                               for i in range(len(self.states))]
-            for k in range(len(self.states)):
-                if k % 4 == 0 or k == len(self.states) - 1:
-                    robot = plt.Circle(robot_positions[k], self.robot.radius, fill=True, color=robot_color)
-                    humans = [plt.Circle(human_positions[k][i], self.humans[i].radius, fill=False, color=cmap(i))
-                              for i in range(len(self.humans))]
+            for k in range(len(states)):
+                if k % 4 == 0 or k == len(states) - 1:
+                    robot = plt.Circle(robot_positions[k], robot_radius, fill=True, color=robot_color)
+                    humans = [plt.Circle(human_positions[k][i], human_radii[i], fill=False, color=cmap(i))
+                              for i in range(human_num)]
                     ax.add_artist(robot)
                     for human in humans:
                         ax.add_artist(human)
                 # add time annotation
                 global_time = k * self.time_step
-                if global_time % 4 == 0 or k == len(self.states) - 1:
+                if global_time % 4 == 0 or k == len(states) - 1:
                     agents = humans + [robot]
                     times = [plt.text(agents[i].center[0] - x_offset, agents[i].center[1] - y_offset,
                                       '{:.1f}'.format(global_time),
-                                      color='black', fontsize=14) for i in range(self.human_num + 1)]
+                                      color='black', fontsize=14) for i in range(human_num + 1)]
                     for time in times:
                         ax.add_artist(time)
                 if k != 0:
-                    nav_direction = plt.Line2D((self.states[k - 1][0].px, self.states[k][0].px),
-                                               (self.states[k - 1][0].py, self.states[k][0].py),
+                    nav_direction = plt.Line2D((robot_positions[k - 1][0], robot_positions[k][0]),
+                                               (robot_positions[k - 1][1], robot_positions[k][1]),
                                                color=robot_color, ls='solid')
-                    human_directions = [plt.Line2D((self.states[k - 1][1][i].px, self.states[k][1][i].px),
-                                                   (self.states[k - 1][1][i].py, self.states[k][1][i].py),
+                    human_directions = [plt.Line2D((human_positions[k - 1][i][0], human_positions[k][i][0]),
+                                                   (human_positions[k - 1][i][1], human_positions[k][i][1]),
                                                    color=cmap(i), ls='solid')
-                                        for i in range(self.human_num)]
+                                        for i in range(human_num)]
                     ax.add_artist(nav_direction)
                     for human_direction in human_directions:
                         ax.add_artist(human_direction)
             plt.legend([robot], ['Robot'], fontsize=16)
             plt.show()
+        elif mode == 'video' and output_file is not None:
+            # videos are drawn frame by frame without an animation and piped to ffmpeg
+            TrajectoryRenderer(self.robot.kinematics, self.time_step).save_video(trajectory, output_file)
         elif mode == 'video':
             fig, ax = plt.subplots(figsize=(7, 7))
             ax.tick_params(labelsize=16)
@@ -491,19 +765,16 @@ class CrowdSim(gym.Env):
             ax.set_ylabel('y(m)', fontsize=16)
 
             # add robot and its goal
-            robot_positions = [state[0].position for state in self.states]
             goal = mlines.Line2D([0], [4], color=goal_color, marker='*', linestyle='None', markersize=15, label='Goal')
-            robot = plt.Circle(robot_positions[0], self.robot.radius, fill=True, color=robot_color)
+            robot = plt.Circle(robot_positions[0], robot_radius, fill=True, color=robot_color)
             ax.add_artist(robot)
             ax.add_artist(goal)
             plt.legend([robot, goal], ['Robot', 'Goal'], fontsize=16)
 
             # add humans and their numbers
-            human_positions = [[state[1][j].position for j in range(len(self.humans))] for state in self.states]
-            humans = [plt.Circle(human_positions[0][i], self.humans[i].radius, fill=False)
-                      for i in range(len(self.humans))]
+            humans = [plt.Circle(human_positions[0][i], human_radii[i], fill=False) for i in range(human_num)]
             human_numbers = [plt.text(humans[i].center[0] - x_offset, humans[i].center[1] - y_offset, str(i),
-                                      color='black', fontsize=12) for i in range(len(self.humans))]
+                                      color='black', fontsize=12) for i in range(human_num)]
             for i, human in enumerate(humans):
                 ax.add_artist(human)
                 ax.add_artist(human_numbers[i])
@@ -513,31 +784,23 @@ class CrowdSim(gym.Env):
             ax.add_artist(time)
 
             # compute attention scores
-            if self.attention_weights is not None:
+            if attention_weights is not None:
                 attention_scores = [
-                    plt.text(-5.5, 5 - 0.5 * i, 'Human {}: {:.2f}'.format(i + 1, self.attention_weights[0][i]),
-                             fontsize=16) for i in range(len(self.humans))]
+                    plt.text(-5.5, 5 - 0.5 * i, 'Human {}: {:.2f}'.format(i + 1, attention_weights[0][i]),
+                             fontsize=16) for i in range(human_num)]
 
             # compute orientation in each step and use arrow to show the direction
-            radius = self.robot.radius
+            radius = robot_radius
             if self.robot.kinematics == 'unicycle':
-                orientation = [((state[0].px, state[0].py), (state[0].px + radius * np.cos(state[0].theta),
-                                                             state[0].py + radius * np.sin(state[0].theta))) for state
-                               in self.states]
-                orientations = [orientation]
+                agent_states = states[:, :1].astype(np.float64)
+                theta = agent_states[:, :, 8]
             else:
-                orientations = []
-                for i in range(self.human_num + 1):
-                    orientation = []
-                    for state in self.states:
-                        if i == 0:
-                            agent_state = state[0]
-                        else:
-                            agent_state = state[1][i - 1]
-                        theta = np.arctan2(agent_state.vy, agent_state.vx)
-                        orientation.append(((agent_state.px, agent_state.py), (agent_state.px + radius * np.cos(theta),
-                                             agent_state.py + radius * np.sin(theta))))
-                    orientations.append(orientation)
+                agent_states = states.astype(np.float64)
+                theta = np.arctan2(agent_states[:, :, 3], agent_states[:, :, 2])
+            starts = agent_states[:, :, :2]
+            ends = starts + radius * np.stack([np.cos(theta), np.sin(theta)], axis=2)
+            orientations = [list(zip(map(tuple, starts[:, i].tolist()), map(tuple, ends[:, i].tolist())))
+                            for i in range(agent_states.shape[1])]
             arrows = [patches.FancyArrowPatch(*orientation[0], color=arrow_color, arrowstyle=arrow_style)
                       for orientation in orientations]
             for arrow in arrows:
@@ -558,23 +821,22 @@ class CrowdSim(gym.Env):
                                                       arrowstyle=arrow_style) for orientation in orientations]
                     for arrow in arrows:
                         ax.add_artist(arrow)
-                    if self.attention_weights is not None:
-                        human.set_color(str(self.attention_weights[frame_num][i]))
-                        attention_scores[i].set_text('human {}: {:.2f}'.format(i, self.attention_weights[frame_num][i]))
+                    if attention_weights is not None:
+                        human.set_color(str(attention_weights[frame_num][i]))
+                        attention_scores[i].set_text('human {}: {:.2f}'.format(i, attention_weights[frame_num][i]))
 
                 time.set_text('Time: {:.2f}'.format(frame_num * self.time_step))
 
             def plot_value_heatmap():
                 assert self.robot.kinematics == 'holonomic'
-                for agent in [self.states[global_step][0]] + self.states[global_step][1]:
-                    print(('{:.4f}, ' * 6 + '{:.4f}').format(agent.px, agent.py, agent.gx, agent.gy,
-                                                             agent.vx, agent.vy, agent.theta))
+                for px, py, vx, vy, _, gx, gy, _, theta in states[global_step].tolist():
+                    print(('{:.4f}, ' * 6 + '{:.4f}').format(px, py, gx, gy, vx, vy, theta))
                 # when any key is pressed draw the action value plot
                 fig, axis = plt.subplots()
                 speeds = [0] + self.robot.policy.speeds
                 rotations = self.robot.policy.rotations + [np.pi * 2]
                 r, th = np.meshgrid(speeds, rotations)
-                z = np.array(self.action_values[global_step % len(self.states)][1:])
+                z = np.array(trajectory.action_values[global_step % len(states)][1:])
                 z = (z - np.min(z)) / (np.max(z) - np.min(z))
                 z = np.reshape(z, (16, 5))
                 polar = plt.subplot(projection="polar")
@@ -591,20 +853,14 @@ class CrowdSim(gym.Env):
                 anim.running ^= True
                 if anim.running:
                     anim.event_source.stop()
-                    if hasattr(self.robot.policy, 'action_values'):
+                    if trajectory.action_values is not None:
                         plot_value_heatmap()
                 else:
                     anim.event_source.start()
 
             fig.canvas.mpl_connect('key_press_event', on_click)
-            anim = animation.FuncAnimation(fig, update, frames=len(self.states), interval=self.time_step * 1000)
+            anim = animation.FuncAnimation(fig, update, frames=len(states), interval=self.time_step * 1000)
             anim.running = True
-
-            if output_file is not None:
-                ffmpeg_writer = animation.writers['ffmpeg']
-                writer = ffmpeg_writer(fps=8, metadata=dict(artist='Me'), bitrate=1800)
-                anim.save(output_file, writer=writer)
-            else:
-                plt.show()
+            plt.show()
         else:
             raise NotImplementedError
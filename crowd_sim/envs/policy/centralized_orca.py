@@ -0,0 +1,85 @@
+import numpy as np
+import rvo2
+from crowd_sim.envs.policy.orca import ORCA
+from crowd_sim.envs.utils.action import ActionXY
+
+
+class CentralizedORCA(object):
+    def __init__(self, policy):
+        """
+        Crowd-level ORCA engine that advances all humans with one rvo2 simulator per environment.
+        With ORCA humans, each human runs its own simulator of all agents and keeps only its own velocity.
+        The new velocity of an agent only depends on its own preferred velocity and on the current states of its
+        neighbors, so one simulator that holds every human and sets every preferred velocity gives the same
+        actions in one doStep. The simulator is reused across steps and only rebuilt when the agents change.
+
+        The robot is added after the humans only if it's visible, its preferred velocity is zero because humans
+        don't know its goal.
+
+        :param policy: ORCA policy shared by the humans, its parameters are used for all of them
+        """
+        self.time_step = policy.time_step
+        self.safety_space = policy.safety_space
+        self.params = policy.neighbor_dist, policy.max_neighbors, policy.time_horizon, policy.time_horizon_obst
+        self.radius = policy.radius
+        self.max_speed = policy.max_speed
+        self.sim = None
+
+    @staticmethod
+    def can_simulate(policies):
+        """
+        Humans can be simulated together if they all use ORCA with identical parameters
+
+        """
+        def parameters(policy):
+            return (policy.time_step, policy.safety_space, policy.neighbor_dist, policy.max_neighbors,
+                    policy.time_horizon, policy.time_horizon_obst, policy.radius, policy.max_speed)
+        return len(policies) > 0 and all(type(policy) is ORCA for policy in policies) and \
+            len(set(parameters(policy) for policy in policies)) == 1
+
+    def __getstate__(self):
+        # rvo2 simulators can't be pickled, they are rebuilt at the next prediction
+        state = self.__dict__.copy()
+        state['sim'] = None
+        return state
+
+    def predict(self, human_states, robot_state=None):
+        """
+        Compute the actions of all humans in one simulation step
+
+        :param human_states: array of shape (# humans, 9) with the full states of humans
+        :param robot_state: array of shape (5,) with the observable state of the robot, None if it's invisible
+        :return: list of actions of humans
+        """
+        agent_num = len(human_states) + (0 if robot_state is None else 1)
+        if self.sim is not None and self.sim.getNumAgents() != agent_num:
+            del self.sim
+            self.sim = None
+        if self.sim is None:
+            self.sim = rvo2.PyRVOSimulator(self.time_step, *self.params, self.radius, self.max_speed)
+            for px, py, vx, vy, radius, _, _, v_pref, _ in human_states.tolist():
+                self.sim.addAgent((px, py), *self.params, radius + 0.01 + self.safety_space, v_pref, (vx, vy))
+            if robot_state is not None:
+                px, py, vx, vy, radius = robot_state.tolist()
+                self.sim.addAgent((px, py), *self.params, radius + 0.01 + self.safety_space, self.max_speed,
+                                  (vx, vy))
+        else:
+            for i, (px, py, vx, vy) in enumerate(human_states[:, :4].tolist()):
+                self.sim.setAgentPosition(i, (px, py))
+                self.sim.setAgentVelocity(i, (vx, vy))
+            if robot_state is not None:
+                px, py, vx, vy, _ = robot_state.tolist()
+                self.sim.setAgentPosition(len(human_states), (px, py))
+                self.sim.setAgentVelocity(len(human_states), (vx, vy))
+
+        # Set the preferred velocity to be a vector of unit magnitude (speed) in the direction of the goal.
+        velocity = human_states[:, 5:7] - human_states[:, :2]
+        speed = np.linalg.norm(velocity, axis=1)
+        pref_vel = velocity / np.where(speed > 1, speed, 1)[:, np.newaxis]
+        for i, pref_velocity in enumerate(pref_vel.tolist()):
+            self.sim.setAgentPrefVelocity(i, tuple(pref_velocity))
+        if robot_state is not None:
+            self.sim.setAgentPrefVelocity(len(human_states), (0, 0))
+
+        self.sim.doStep()
+        return [ActionXY(*self.sim.getAgentVelocity(i)) for i in range(len(human_states))]
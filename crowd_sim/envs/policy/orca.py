@@ -79,6 +79,12 @@ class ORCA(Policy):
     def set_phase(self, phase):
         return
 
+    def __getstate__(self):
+        # rvo2 simulators can't be pickled, they are rebuilt at the next prediction
+        state = self.__dict__.copy()
+        state['sim'] = None
+        return state
+
     def predict(self, state):
         """
         Create a rvo2 simulation at each time step and run one step
@@ -4,15 +4,40 @@ import abc
 import logging
 from crowd_sim.envs.policy.policy_factory import policy_factory
 from crowd_sim.envs.utils.action import ActionXY, ActionRot
-from crowd_sim.envs.utils.state import ObservableState, FullState
+from crowd_sim.envs.utils.state import ObservableState, FullState, CrowdState
+
+
+def agent_field(field):
+    index = CrowdState.fields.index(field)
+
+    def getter(self):
+        return float(self.crowd_state.data[index, self.index])
+
+    def setter(self, value):
+        self.crowd_state.data[index, self.index] = np.nan if value is None else value
+
+    return property(getter, setter)
 
 
 class Agent(object):
+    px = agent_field('px')
+    py = agent_field('py')
+    vx = agent_field('vx')
+    vy = agent_field('vy')
+    radius = agent_field('radius')
+    gx = agent_field('gx')
+    gy = agent_field('gy')
+    v_pref = agent_field('v_pref')
+    theta = agent_field('theta')
+
     def __init__(self, config, section):
         """
         Base class for robot and human. Have the physical attributes of an agent.
+        The physical state is kept in a CrowdState, either a private one or a shared one the agent is bound to.
 
         """
+        self.crowd_state = CrowdState(1)
+        self.index = 0
         self.visible = config.getboolean(section, 'visible')
         self.v_pref = config.getfloat(section, 'v_pref')
         self.radius = config.getfloat(section, 'radius')
@@ -28,6 +53,15 @@ class Agent(object):
         self.theta = None
         self.time_step = None
 
+    def bind(self, crowd_state, index):
+        """
+        Move the state of the agent into slot index of a shared crowd state
+
+        """
+        crowd_state.data[:, index] = self.crowd_state.data[:, self.index]
+        self.crowd_state = crowd_state
+        self.index = index
+
     def print_info(self):
         logging.info('Agent is {} and has {} kinematic constraint'.format(
             'visible' if self.visible else 'invisible', self.kinematics))
@@ -74,7 +108,7 @@ class Agent(object):
         return ObservableState(next_px, next_py, next_vx, next_vy, self.radius)
 
     def get_full_state(self):
-        return FullState(self.px, self.py, self.vx, self.vy, self.radius, self.gx, self.gy, self.v_pref, self.theta)
+        return self.crowd_state.get_full_state(self.index)
 
     def get_position(self):
         return self.px, self.py
@@ -0,0 +1,139 @@
+import os
+import json
+import time
+import logging
+
+
+class Section(object):
+    __slots__ = ('profiler', 'name', 'start')
+
+    def __init__(self, profiler, name):
+        self.profiler = profiler
+        self.name = name
+        self.start = None
+
+    def __enter__(self):
+        self.profiler.stack.append(self.name)
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        end = time.perf_counter()
+        profiler = self.profiler
+        path = '/'.join(profiler.stack)
+        profiler.stack.pop()
+        timer = profiler.timers.get(path)
+        if timer is None:
+            profiler.timers[path] = [1, end - self.start]
+        else:
+            timer[0] += 1
+            timer[1] += end - self.start
+        if profiler.trace_events is not None and len(profiler.trace_events) < profiler.max_trace_events:
+            profiler.trace_events.append({'name': self.name, 'cat': path, 'ph': 'X', 'ts': self.start * 1e6,
+                                          'dur': (end - self.start) * 1e6, 'pid': os.getpid(), 'tid': 0})
+
+
+class NullSection(object):
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+
+null_section = NullSection()
+
+
+class Profiler(object):
+    def __init__(self):
+        """
+        Hierarchical timers and counters shared by the simulator, the policies and the training loop.
+        A section is timed under the path of the sections it is nested in, e.g. act/predict/value_network, and
+        the number of calls and the total time of every path are accumulated until they are reported.
+        Sections can also be recorded as events in the Chrome trace format (chrome://tracing or Perfetto).
+
+        When the profiler is disabled, a section is one attribute check returning a shared no-op context manager.
+
+        """
+        self.enabled = False
+        self.stack = []
+        self.timers = {}
+        self.counters = {}
+        self.trace_events = None
+        self.max_trace_events = 10 ** 6
+        self.last_report = time.perf_counter()
+
+    def enable(self, trace=False):
+        self.enabled = True
+        if trace and self.trace_events is None:
+            self.trace_events = []
+        self.last_report = time.perf_counter()
+
+    def disable(self):
+        self.enabled = False
+        self.trace_events = None
+
+    def section(self, name):
+        if not self.enabled:
+            return null_section
+        return Section(self, name)
+
+    def count(self, name, value=1):
+        if self.enabled:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def reset(self, trace_events=True):
+        self.timers = {}
+        self.counters = {}
+        if trace_events and self.trace_events is not None:
+            self.trace_events = []
+        self.last_report = time.perf_counter()
+
+    def get_state(self):
+        return self.timers, self.counters, self.trace_events
+
+    def merge(self, state):
+        """
+        Add the timers, counters and trace events of another profiler, e.g. of a worker process.
+        Its sections are nested in the sections that are currently open.
+
+        """
+        timers, counters, trace_events = state
+        prefix = ''.join(name + '/' for name in self.stack)
+        for path, (calls, total) in timers.items():
+            timer = self.timers.setdefault(prefix + path, [0, 0])
+            timer[0] += calls
+            timer[1] += total
+        for name, value in counters.items():
+            self.counters[name] = self.counters.get(name, 0) + value
+        if self.trace_events is not None and trace_events is not None:
+            self.trace_events += trace_events[:self.max_trace_events - len(self.trace_events)]
+
+    def report(self, title):
+        """
+        Log the timers and counters accumulated since the last report and reset them, the share of every section is
+        relative to the wall time since the last report, so sections of parallel workers can exceed it
+
+        """
+        if not self.enabled:
+            return
+        elapsed = time.perf_counter() - self.last_report
+        sections = ['{} {:.3f}s/{} ({:.0%})'.format(path, total, calls, total / elapsed)
+                    for path, (calls, total) in sorted(self.timers.items())]
+        logging.info('%s took %.2fs: %s', title, elapsed, ', '.join(sections))
+        if self.counters:
+            logging.info('%s counters: %s', title, ', '.join('{} {}'.format(name, value) for name, value
+                                                               in sorted(self.counters.items())))
+        self.reset(trace_events=False)
+
+    def save_trace(self, output_file):
+        if self.trace_events is None:
+            raise ValueError('Trace events are not recorded')
+        with open(output_file, 'w') as f:
+            json.dump({'traceEvents': self.trace_events, 'displayTimeUnit': 'ms'}, f)
+
+
+# profiler of the current process, see Profiler.section
+profiler = Profiler()
@@ -0,0 +1,172 @@
+import os
+import subprocess
+import multiprocessing
+import numpy as np
+import matplotlib
+import matplotlib.image
+import matplotlib.lines as mlines
+from matplotlib import patches
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.figure import Figure
+from crowd_sim.envs.utils.trajectory import TrajectoryArchive
+
+
+class TrajectoryRenderer(object):
+    def __init__(self, kinematics='holonomic', time_step=0.25, fps=8, dpi=100):
+        """
+        Headless renderer of recorded trajectories that draws the same frames as CrowdSim.render('video').
+        The static part of the figure (axes, goal and legend) is drawn once per episode and restored for every
+        frame, only the reused artists of agents, arrows and texts are redrawn on top of it. Frames are written as
+        png images or piped to ffmpeg as raw video, without matplotlib animations.
+
+        :param kinematics: kinematics of the robot, the arrow of a unicycle robot shows its orientation
+        :param time_step: time between two recorded steps
+        :param fps: frames per second of videos
+        :param dpi: resolution of the frames
+        """
+        self.kinematics = kinematics
+        self.time_step = time_step
+        self.fps = fps
+        self.dpi = dpi
+
+    def frames(self, trajectory):
+        """
+        Draw the frames of one trajectory
+
+        :return: generator of rgba arrays of shape (height, width, 4), the array is reused by the next frame
+        """
+        x_offset = 0.11
+        y_offset = 0.11
+        robot_color = 'yellow'
+        goal_color = 'red'
+        arrow_color = 'red'
+        arrow_style = patches.ArrowStyle("->", head_length=4, head_width=2)
+
+        states = np.asarray(trajectory.states, dtype=np.float64)
+        attention_weights = trajectory.attention_weights
+        human_num = trajectory.agent_num - 1
+        radius = states[0, 0, 4]
+
+        fig = Figure(figsize=(7, 7), dpi=self.dpi)
+        canvas = FigureCanvasAgg(fig)
+        ax = fig.add_subplot(1, 1, 1)
+        ax.tick_params(labelsize=16)
+        ax.set_xlim(-6, 6)
+        ax.set_ylim(-6, 6)
+        ax.set_xlabel('x(m)', fontsize=16)
+        ax.set_ylabel('y(m)', fontsize=16)
+
+        # animated artists are skipped by a full draw and drawn on top of the background in every frame
+        goal = mlines.Line2D([states[0, 0, 5]], [states[0, 0, 6]], color=goal_color, marker='*', linestyle='None',
+                             markersize=15, label='Goal')
+        robot = patches.Circle(states[0, 0, :2], radius, fill=True, color=robot_color, animated=True)
+        ax.add_artist(robot)
+        ax.add_artist(goal)
+        ax.legend([robot, goal], ['Robot', 'Goal'], fontsize=16)
+        humans = [patches.Circle(states[0, i + 1, :2], states[0, i + 1, 4], fill=False, animated=True)
+                  for i in range(human_num)]
+        human_numbers = [ax.text(0, 0, str(i), color='black', fontsize=12, animated=True) for i in range(human_num)]
+        for human in humans:
+            ax.add_artist(human)
+        time = ax.text(-1, 5, '', fontsize=16, animated=True)
+        attention_scores = [ax.text(-5.5, 5 - 0.5 * i, '', fontsize=16, animated=True) for i in range(human_num)] \
+            if attention_weights is not None else []
+
+        if self.kinematics == 'unicycle':
+            starts = states[:, :1, :2]
+            theta = states[:, :1, 8]
+        else:
+            starts = states[:, :, :2]
+            theta = np.arctan2(states[:, :, 3], states[:, :, 2])
+        ends = starts + radius * np.stack([np.cos(theta), np.sin(theta)], axis=2)
+        arrows = [patches.FancyArrowPatch(tuple(starts[0, i]), tuple(ends[0, i]), color=arrow_color,
+                                          arrowstyle=arrow_style, animated=True) for i in range(starts.shape[1])]
+        for arrow in arrows:
+            ax.add_artist(arrow)
+
+        canvas.draw()
+        background = canvas.copy_from_bbox(fig.bbox)
+        dynamic_artists = [robot] + humans + human_numbers + arrows + [time] + attention_scores
+        for frame_num in range(len(states)):
+            canvas.restore_region(background)
+            robot.center = states[frame_num, 0, :2]
+            for i, human in enumerate(humans):
+                human.center = states[frame_num, i + 1, :2]
+                human_numbers[i].set_position((human.center[0] - x_offset, human.center[1] - y_offset))
+                if attention_weights is not None and not np.isnan(attention_weights[frame_num][i]):
+                    human.set_color(str(attention_weights[frame_num][i]))
+                    attention_scores[i].set_text('human {}: {:.2f}'.format(i, attention_weights[frame_num][i]))
+            for i, arrow in enumerate(arrows):
+                arrow.set_positions(tuple(starts[frame_num, i]), tuple(ends[frame_num, i]))
+            time.set_text('Time: {:.2f}'.format(frame_num * self.time_step))
+            for artist in dynamic_artists:
+                ax.draw_artist(artist)
+            yield np.asarray(canvas.buffer_rgba())
+
+    def save_video(self, trajectory, output_file):
+        """
+        Encode the frames of a trajectory with ffmpeg, frames are piped as raw rgba images
+
+        """
+        process = None
+        try:
+            for frame in self.frames(trajectory):
+                if process is None:
+                    height, width = frame.shape[:2]
+                    command = [matplotlib.rcParams['animation.ffmpeg_path'], '-y', '-loglevel', 'error',
+                               '-f', 'rawvideo', '-pix_fmt', 'rgba', '-s', '{}x{}'.format(width, height),
+                               '-r', str(self.fps), '-i', '-']
+                    if not output_file.endswith('.gif'):
+                        command += ['-pix_fmt', 'yuv420p', '-b:v', '1800k']
+                    process = subprocess.Popen(command + [output_file], stdin=subprocess.PIPE)
+                process.stdin.write(frame.tobytes())
+        finally:
+            if process is not None:
+                process.stdin.close()
+                if process.wait() != 0:
+                    raise RuntimeError('ffmpeg failed to write {}'.format(output_file))
+
+    def save_images(self, trajectory, output_dir):
+        """
+        Write the frames of a trajectory as a png image sequence
+
+        """
+        os.makedirs(output_dir, exist_ok=True)
+        for frame_num, frame in enumerate(self.frames(trajectory)):
+            matplotlib.image.imsave(os.path.join(output_dir, 'frame_{:04d}.png'.format(frame_num)), frame)
+
+
+def render_episodes(archive_dir, indices, output_dir, kinematics='holonomic', time_step=0.25, image_sequence=False,
+                    num_workers=None):
+    """
+    Render episodes of a trajectory archive in a pool of worker processes, one episode per task
+
+    :param archive_dir: directory of a TrajectoryArchive
+    :param indices: indices of the episodes in the archive
+    :param output_dir: videos episode_<index>.mp4 or image sequences episode_<index>/ are written into it
+    :param image_sequence: write png images instead of videos
+    :param num_workers: number of processes, defaults to the number of cpus
+    :return: list of written files or directories
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    tasks = [(archive_dir, index, os.path.join(output_dir, 'episode_{}'.format(index) +
+                                               ('' if image_sequence else '.mp4')),
+              kinematics, time_step, image_sequence) for index in indices]
+    if not tasks:
+        return []
+    num_workers = min(num_workers if num_workers is not None else multiprocessing.cpu_count(), len(tasks))
+    if num_workers < 2:
+        return [render_episode(task) for task in tasks]
+    with multiprocessing.Pool(num_workers) as pool:
+        return pool.map(render_episode, tasks, chunksize=1)
+
+
+def render_episode(task):
+    archive_dir, index, output, kinematics, time_step, image_sequence = task
+    trajectory = TrajectoryArchive(archive_dir)[index]
+    renderer = TrajectoryRenderer(kinematics, time_step)
+    if image_sequence:
+        renderer.save_images(trajectory, output)
+    else:
+        renderer.save_video(trajectory, output)
+    return output
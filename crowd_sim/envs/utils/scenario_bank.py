@@ -0,0 +1,104 @@
+import io
+import os
+import hashlib
+import logging
+import numpy as np
+
+
+class ScenarioBank(object):
+    # phases whose cases are stored, training cases are unbounded and always generated
+    phases = ['val', 'test']
+    # columns of the index and of the human rows
+    index_fields = ['phase', 'case', 'offset', 'count', 'human_num']
+    human_fields = ['px', 'py', 'gx', 'gy', 'radius', 'v_pref']
+
+    def __init__(self, bank_file):
+        """
+        Humans of the val and test cases, generated once by build_scenario_bank and read back as memory maps.
+        The file holds the number of cases, one int64 index row per case and the float64 rows of all humans, so
+        resetting the environment to a stored case creates the humans without seeding and rejection sampling.
+
+        :param bank_file: file written by build_scenario_bank
+        """
+        self.bank_file = bank_file
+        case_num = int(np.fromfile(bank_file, dtype=np.int64, count=1)[0])
+        index_offset = np.dtype(np.int64).itemsize
+        self.index = np.memmap(bank_file, dtype=np.int64, mode='r', offset=index_offset,
+                               shape=(case_num, len(self.index_fields)))
+        human_offset = index_offset + self.index.nbytes
+        human_rows = (os.path.getsize(bank_file) - human_offset) // (np.dtype(np.float64).itemsize *
+                                                                      len(self.human_fields))
+        self.humans = np.memmap(bank_file, dtype=np.float64, mode='r', offset=human_offset,
+                                shape=(human_rows, len(self.human_fields)))
+        self.cases = {(self.phases[phase], case): (offset, count, human_num)
+                      for phase, case, offset, count, human_num in self.index.tolist()}
+
+    def __getstate__(self):
+        # memory maps are reopened by worker processes instead of being copied into the pickle
+        return {'bank_file': self.bank_file}
+
+    def __setstate__(self, state):
+        self.__init__(state['bank_file'])
+
+    def __len__(self):
+        return len(self.cases)
+
+    def get_case(self, phase, case):
+        """
+        :return: array of shape (# humans, 6) with the start, goal, radius and preferred speed of every human and the
+        number of humans drawn by the scenario, or None if the case isn't stored
+        """
+        if (phase, case) not in self.cases:
+            return None
+        offset, count, human_num = self.cases[(phase, case)]
+        return self.humans[offset: offset + count], human_num
+
+    @staticmethod
+    def get_key(env):
+        """
+        Hash of everything the val and test cases are generated from: the env config, the simulation parameters
+        that can be changed after configuration and whether the policy of the robot is trained with several humans
+
+        """
+        config = io.StringIO()
+        env.config.write(config)
+        multiagent_training = bool(env.robot.policy.multiagent_training)
+        parameters = [config.getvalue(), multiagent_training, env.train_val_sim if multiagent_training else
+                      'circle_crossing', env.test_sim, env.circle_radius, env.square_width]
+        return hashlib.sha1(repr(parameters).encode()).hexdigest()[:16]
+
+    @staticmethod
+    def get_file(directory, env):
+        return os.path.join(directory, 'scenarios_{}.bin'.format(ScenarioBank.get_key(env)))
+
+
+def build_scenario_bank(env, directory):
+    """
+    Generate all val and test cases of an environment with a robot and its policy by resetting it to every case, the
+    cases are generated in the order of a training run, validation first
+
+    :return: path of the written bank file
+    """
+    os.makedirs(directory, exist_ok=True)
+    bank_file = ScenarioBank.get_file(directory, env)
+    scenario_bank, env.scenario_bank = env.scenario_bank, None
+    index = []
+    humans = []
+    offset = 0
+    for phase_index, phase in enumerate(ScenarioBank.phases):
+        for case in range(env.case_size[phase]):
+            env.reset(phase, case)
+            rule = env.test_sim if phase == 'test' else env.train_val_sim
+            # the mixed scenario draws its number of humans and adds a placeholder human when it draws none
+            human_num = env.human_num if rule == 'mixed' else len(env.humans)
+            index.append([phase_index, case, offset, len(env.humans), human_num])
+            humans += [[human.px, human.py, human.gx, human.gy, human.radius, human.v_pref] for human in env.humans]
+            offset += len(env.humans)
+    env.scenario_bank = scenario_bank
+
+    with open(bank_file, 'wb') as f:
+        f.write(np.array([len(index)], dtype=np.int64).tobytes())
+        f.write(np.array(index, dtype=np.int64).tobytes())
+        f.write(np.array(humans, dtype=np.float64).tobytes())
+    logging.info('Wrote %d val and test cases with %d humans to %s', len(index), offset, bank_file)
+    return bank_file
@@ -1,3 +1,6 @@
+import numpy as np
+
+
 class FullState(object):
     def __init__(self, px, py, vx, vy, radius, gx, gy, v_pref, theta):
         self.px = px
@@ -40,11 +43,112 @@ class ObservableState(object):
         return ' '.join([str(x) for x in [self.px, self.py, self.vx, self.vy, self.radius]])
 
 
+class ObservableStateList(object):
+    def __init__(self, array):
+        """
+        Read-only sequence of observable states backed by an array of shape (# agents, 5).
+        ObservableState objects are only created when single elements are accessed.
+
+        """
+        self.array = array
+
+    def __len__(self):
+        return self.array.shape[0]
+
+    def __getitem__(self, item):
+        if isinstance(item, slice):
+            return ObservableStateList(self.array[item])
+        return ObservableState(*self.array[item].tolist())
+
+    def __iter__(self):
+        for row in self.array.tolist():
+            yield ObservableState(*row)
+
+
 class JointState(object):
     def __init__(self, self_state, human_states):
         assert isinstance(self_state, FullState)
-        for human_state in human_states:
-            assert isinstance(human_state, ObservableState)
+        if not isinstance(human_states, ObservableStateList):
+            for human_state in human_states:
+                assert isinstance(human_state, ObservableState)
 
         self.self_state = self_state
         self.human_states = human_states
+
+    def self_state_array(self):
+        return full_state_array([self.self_state])[0]
+
+    def human_states_array(self):
+        return observable_state_array(self.human_states)
+
+
+def full_state_array(states):
+    """
+    Stack full states into an array of shape (# states, 9)
+
+    """
+    return np.array([(s.px, s.py, s.vx, s.vy, s.radius, s.gx, s.gy, s.v_pref, s.theta) for s in states],
+                    dtype=np.float64).reshape((-1, 9))
+
+
+def observable_state_array(states):
+    """
+    Stack observable states into an array of shape (# states, 5), array backed states are returned as they are
+
+    """
+    if isinstance(states, ObservableStateList):
+        return states.array
+    return np.array([(s.px, s.py, s.vx, s.vy, s.radius) for s in states], dtype=np.float64).reshape((-1, 5))
+
+
+def state_field(index):
+    def getter(self):
+        return self.data[index]
+
+    def setter(self, value):
+        self.data[index] = value
+
+    return property(getter, setter)
+
+
+class CrowdState(object):
+    fields = ['px', 'py', 'vx', 'vy', 'radius', 'gx', 'gy', 'v_pref', 'theta']
+
+    def __init__(self, agent_num, data=None):
+        """
+        Struct-of-arrays store of the full states of all agents in the crowd.
+        Each field is a contiguous row of self.data, robot is usually stored at index 0 and humans after it.
+        Agents bound to the store read and write their attributes directly from and into these arrays.
+
+        :param agent_num: number of agents
+        :param data: optional array of shape (9, agent_num) to use as storage, e.g. a view into a batch of crowds
+        """
+        if data is None:
+            data = np.full((len(self.fields), agent_num), np.nan)
+        assert data.shape == (len(self.fields), agent_num)
+        self.data = data
+
+    px = state_field(0)
+    py = state_field(1)
+    vx = state_field(2)
+    vy = state_field(3)
+    radius = state_field(4)
+    gx = state_field(5)
+    gy = state_field(6)
+    v_pref = state_field(7)
+    theta = state_field(8)
+
+    def __len__(self):
+        return self.data.shape[1]
+
+    def get_full_state(self, index):
+        return FullState(*self.data[:, index].tolist())
+
+    def get_observable_states(self, indices=slice(None)):
+        """
+        Copy the observable states of the selected agents
+
+        :param indices: index, slice or index array of agents
+        :return: ObservableStateList backed by an array of shape (# selected agents, 5)
+        """
+        return ObservableStateList(self.data[:5, indices].T.copy())
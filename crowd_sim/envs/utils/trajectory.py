@@ -0,0 +1,174 @@
+import os
+import numpy as np
+
+
+class Trajectory(object):
+    def __init__(self, agent_num, capacity=1):
+        """
+        Columnar record of one episode in pre-allocated float32 arrays.
+        States of shape (# steps, # agents, 9) hold the full states of the robot (index 0) and humans, action values
+        of shape (# steps, # actions) and attention weights of shape (# steps, # humans) are only allocated when
+        the policy provides them, missing steps are nan. Arrays grow by doubling when the capacity is exceeded.
+
+        :param agent_num: number of agents including the robot
+        :param capacity: expected number of steps
+        """
+        self.agent_num = agent_num
+        self.length = 0
+        self.state_data = np.empty((max(capacity, 1), agent_num, 9), dtype=np.float32)
+        self.action_value_data = None
+        self.attention_data = None
+
+    @property
+    def states(self):
+        return self.state_data[:self.length]
+
+    @property
+    def action_values(self):
+        return None if self.action_value_data is None else self.action_value_data[:self.length]
+
+    @property
+    def attention_weights(self):
+        return None if self.attention_data is None else self.attention_data[:self.length]
+
+    def __len__(self):
+        return self.length
+
+    def append(self, crowd_data, action_values=None, attention_weights=None):
+        """
+        Record one step
+
+        :param crowd_data: array of shape (9, # agents) with the full states of all agents, see CrowdState
+        :param action_values: values of the candidate actions of the robot
+        :param attention_weights: attention weights of the robot over the humans
+        """
+        if self.length == len(self.state_data):
+            self.state_data = self.grow(self.state_data)
+            self.action_value_data = self.grow(self.action_value_data)
+            self.attention_data = self.grow(self.attention_data)
+        self.state_data[self.length] = crowd_data.T
+        if action_values is not None:
+            if self.action_value_data is None:
+                self.action_value_data = self.allocate(len(action_values))
+            self.action_value_data[self.length] = action_values
+        if attention_weights is not None:
+            if self.attention_data is None:
+                self.attention_data = self.allocate(len(attention_weights))
+            self.attention_data[self.length] = attention_weights
+        self.length += 1
+
+    def allocate(self, width):
+        return np.full((len(self.state_data), width), np.nan, dtype=np.float32)
+
+    @staticmethod
+    def grow(data):
+        if data is None:
+            return None
+        grown = np.full((2 * len(data),) + data.shape[1:], np.nan, dtype=data.dtype)
+        grown[:len(data)] = data
+        return grown
+
+    @staticmethod
+    def from_arrays(states, action_values=None, attention_weights=None):
+        """
+        Wrap recorded arrays without copying them, e.g. arrays loaded from a file
+
+        """
+        trajectory = Trajectory.__new__(Trajectory)
+        trajectory.agent_num = states.shape[1]
+        trajectory.length = len(states)
+        trajectory.state_data = states
+        trajectory.action_value_data = action_values
+        trajectory.attention_data = attention_weights
+        return trajectory
+
+    def save(self, output_file, compressed=True):
+        arrays = {'states': self.states}
+        if self.action_values is not None:
+            arrays['action_values'] = self.action_values
+        if self.attention_weights is not None:
+            arrays['attention_weights'] = self.attention_weights
+        if compressed:
+            np.savez_compressed(output_file, **arrays)
+        else:
+            np.savez(output_file, **arrays)
+
+    @staticmethod
+    def load(input_file):
+        with np.load(input_file) as arrays:
+            return Trajectory.from_arrays(arrays['states'], arrays.get('action_values'),
+                                          arrays.get('attention_weights'))
+
+
+class TrajectoryArchive(object):
+    # columns of the index file
+    index_fields = ['state_offset', 'length', 'agent_num', 'action_value_offset', 'action_num', 'attention_offset',
+                    'attention_num']
+
+    def __init__(self, directory):
+        """
+        Append-only store of many trajectories in flat float32 files that are read back as memory maps, so
+        recorded episodes can be analyzed or rendered without loading all of them.
+        Each episode appends its rows to states.bin, action_values.bin and attention_weights.bin and one row of
+        offsets and sizes to index.bin. Episodes may have different numbers of humans.
+
+        :param directory: directory of the archive, created if it doesn't exist and appended to if it does
+        """
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        index_file = self.get_file('index')
+        if os.path.exists(index_file):
+            self.index = np.fromfile(index_file, dtype=np.int64).reshape(-1, len(self.index_fields))
+        else:
+            self.index = np.zeros((0, len(self.index_fields)), dtype=np.int64)
+
+    def get_file(self, name):
+        return os.path.join(self.directory, name + '.bin')
+
+    def get_size(self, name):
+        file = self.get_file(name)
+        return os.path.getsize(file) // np.dtype(np.float32).itemsize if os.path.exists(file) else 0
+
+    def append(self, trajectory):
+        """
+        Write one trajectory to the end of the archive
+
+        """
+        row = [self.get_size('states') // 9, len(trajectory), trajectory.agent_num, self.get_size('action_values'),
+               0, self.get_size('attention_weights'), 0]
+        with open(self.get_file('states'), 'ab') as f:
+            f.write(np.ascontiguousarray(trajectory.states, dtype=np.float32).tobytes())
+        if trajectory.action_values is not None:
+            row[4] = trajectory.action_values.shape[1]
+            with open(self.get_file('action_values'), 'ab') as f:
+                f.write(np.ascontiguousarray(trajectory.action_values, dtype=np.float32).tobytes())
+        if trajectory.attention_weights is not None:
+            row[6] = trajectory.attention_weights.shape[1]
+            with open(self.get_file('attention_weights'), 'ab') as f:
+                f.write(np.ascontiguousarray(trajectory.attention_weights, dtype=np.float32).tobytes())
+        row = np.array([row], dtype=np.int64)
+        # the index is written last, so an interrupted append leaves no partial episode behind
+        with open(self.get_file('index'), 'ab') as f:
+            f.write(row.tobytes())
+        self.index = np.concatenate([self.index, row])
+
+    def __len__(self):
+        return len(self.index)
+
+    def __getitem__(self, item):
+        """
+        Read one trajectory as memory maps of the archive files
+
+        """
+        state_offset, length, agent_num, action_value_offset, action_num, attention_offset, attention_num = \
+            self.index[item].tolist()
+
+        def read(name, offset, shape):
+            return np.memmap(self.get_file(name), dtype=np.float32, mode='r',
+                             offset=offset * np.dtype(np.float32).itemsize, shape=shape)
+
+        states = read('states', state_offset * 9, (length, agent_num, 9))
+        action_values = read('action_values', action_value_offset, (length, action_num)) if action_num else None
+        attention_weights = read('attention_weights', attention_offset, (length, attention_num)) \
+            if attention_num else None
+        return Trajectory.from_arrays(states, action_values, attention_weights)
@@ -24,3 +24,66 @@ def point_to_segment_dist(x1, y1, x2, y2, x3, y3):
     y = y1 + u * py
 
     return np.linalg.norm((x - x3, y-y3))
+
+
+def batch_point_to_segment_dist(x1, y1, x2, y2, x3, y3):
+    """
+    Vectorized version of point_to_segment_dist, all arguments are broadcast against each other
+
+    """
+    x1, y1, x2, y2, x3, y3 = np.broadcast_arrays(x1, y1, x2, y2, x3, y3)
+    px = x2 - x1
+    py = y2 - y1
+
+    norm_square = px * px + py * py
+    degenerate = norm_square == 0
+    u = ((x3 - x1) * px + (y3 - y1) * py) / np.where(degenerate, 1, norm_square)
+    u = np.clip(np.where(degenerate, 0, u), 0, 1)
+
+    # (x, y) is the closest point to (x3, y3) on the line segment
+    x = x1 + u * px
+    y = y1 + u * py
+
+    return np.sqrt((x - x3) ** 2 + (y - y3) ** 2)
+
+
+def find_colliding_pairs(px, py, radius):
+    """
+    Find all pairs of circles that overlap. Circles are hashed into a uniform grid with cells as large as the
+    largest possible collision distance, so only circles in the same or adjacent cells are compared and the cost
+    stays close to linear in the number of circles.
+
+    :return: array of shape (# pairs, 2) with i < j for each pair (i, j)
+    """
+    px, py, radius = np.asarray(px, dtype=float), np.asarray(py, dtype=float), np.asarray(radius, dtype=float)
+    num = px.shape[0]
+    if num < 2:
+        return np.empty((0, 2), dtype=int)
+    cell_size = max(2 * radius.max(), 1e-6)
+    cx = np.floor((px - px.min()) / cell_size).astype(np.int64)
+    cy = np.floor((py - py.min()) / cell_size).astype(np.int64)
+    # one extra column on each side so that neighbor keys never wrap around
+    width = cy.max() + 3
+    keys = (cx + 1) * width + cy + 1
+    order = np.argsort(keys, kind='stable')
+    sorted_keys = keys[order]
+
+    pairs = []
+    # half of the neighborhood is enough to visit each pair of cells once
+    for offset_x, offset_y in [(0, 0), (1, -1), (1, 0), (1, 1), (0, 1)]:
+        neighbor_keys = sorted_keys + offset_x * width + offset_y
+        start = np.searchsorted(sorted_keys, neighbor_keys, side='left')
+        end = np.searchsorted(sorted_keys, neighbor_keys, side='right')
+        if offset_x == 0 and offset_y == 0:
+            # only compare with the circles after itself in the same cell
+            start = np.arange(num) + 1
+        counts = np.maximum(end - start, 0)
+        first = np.repeat(np.arange(num), counts)
+        second = np.repeat(start - np.cumsum(counts) + counts, counts) + np.arange(counts.sum())
+        pairs.append(np.stack([order[first], order[second]], axis=1))
+    pairs = np.concatenate(pairs, axis=0)
+
+    i, j = pairs[:, 0], pairs[:, 1]
+    dist = np.hypot(px[i] - px[j], py[i] - py[j]) - radius[i] - radius[j]
+    pairs = np.sort(pairs[dist < 0], axis=1)
+    return pairs[np.lexsort((pairs[:, 1], pairs[:, 0]))]
@@ -0,0 +1,223 @@
+import numpy as np
+from crowd_sim.envs.utils.state import CrowdState, ObservableStateList
+from crowd_sim.envs.utils.action import ActionXY, ActionRot
+
+
+class VecCrowdSim(object):
+    def __init__(self, envs):
+        """
+        Step a batch of crowd scenarios in lock-step inside one process.
+        Every environment is a configured CrowdSim with its own robot, scenario generation and reward rules are the
+        ones of CrowdSim, while the states of all agents live in one array of shape (# envs, 9, # humans + 1)
+        so that collision checks, rewards and agent updates are computed for all environments at once.
+
+        Episodes are played from a queue of test cases, a finished environment is reset to the next case
+        automatically and becomes idle when the queue is empty. All scenarios must have the same number of humans.
+        States are not recorded for rendering.
+
+        """
+        self.envs = envs
+        self.robots = [env.robot for env in envs]
+        self.num_envs = len(envs)
+        self.time_step = envs[0].time_step
+        self.time_limit = envs[0].time_limit
+        self.case_size = envs[0].case_size
+        self.case_counter = dict(envs[0].case_counter)
+        self.data = None
+        self.phase = None
+        self.cases = None
+        self.next_case = None
+        # position in the case queue of the episode played by each environment, -1 for idle environments
+        self.episode_indices = np.full(self.num_envs, -1)
+        # global time of the last finished episode of each environment
+        self.episode_times = [None] * self.num_envs
+
+    def reset(self, phase, cases):
+        """
+        Start playing the given test cases
+
+        :param phase: train, val or test
+        :param cases: list of test cases, consumed in order by the environments as they become free
+        :return: list of observations, None for idle environments
+        """
+        self.phase = phase
+        self.cases = list(cases)
+        self.next_case = 0
+        self.episode_indices[:] = -1
+        self.episode_times = [None] * self.num_envs
+        return [self.reset_env(i) for i in range(self.num_envs)]
+
+    def reset_env(self, i):
+        self.episode_indices[i] = -1
+        if self.next_case >= len(self.cases):
+            return None
+        env = self.envs[i]
+        ob = env.reset(self.phase, self.cases[self.next_case])
+        agent_num = len(env.humans) + 1
+        if self.data is None or self.data.shape[2] != agent_num:
+            if np.any(self.episode_indices >= 0):
+                raise ValueError('VecCrowdSim requires the same number of humans in all scenarios')
+            self.data = np.full((self.num_envs, len(CrowdState.fields), agent_num), np.nan)
+        env.set_crowd_state(CrowdState(agent_num, self.data[i]))
+        self.episode_indices[i] = self.next_case
+        self.next_case += 1
+        return ob
+
+    def get_active_indices(self):
+        return np.flatnonzero(self.episode_indices >= 0)
+
+    def done(self):
+        return not np.any(self.episode_indices >= 0)
+
+    def get_human_velocities(self, active):
+        """
+        Compute human actions in all active environments
+
+        :return: arrays of human velocities of shape (# active envs, # humans), None if any human is not holonomic
+        """
+        human_actions = [self.envs[i].get_human_actions() for i in active]
+        if any(not isinstance(action, ActionXY) for actions in human_actions for action in actions):
+            return None
+        human_vx = np.array([[action.vx for action in actions] for actions in human_actions]).reshape(len(active), -1)
+        human_vy = np.array([[action.vy for action in actions] for actions in human_actions]).reshape(len(active), -1)
+        return human_vx, human_vy
+
+    def get_robot_velocities(self, active, actions, shared=False):
+        """
+        :param actions: list of robot actions of the active environments, or of candidate actions if shared
+        :param shared: evaluate every action in every active environment
+        :return: arrays of robot velocities and end positions of shape (# active envs,) or (# active envs, # actions)
+        """
+        data = self.data[active]
+        shape = (-1, 1) if shared else (-1,)
+        action_shape = (1, -1) if shared else (-1,)
+        if self.robots[0].kinematics == 'holonomic':
+            assert all(isinstance(action, ActionXY) for action in actions)
+            robot_vx = np.array([action.vx for action in actions]).reshape(action_shape)
+            robot_vy = np.array([action.vy for action in actions]).reshape(action_shape)
+            end_px = data[:, 0, 0].reshape(shape) + robot_vx * self.time_step
+            end_py = data[:, 1, 0].reshape(shape) + robot_vy * self.time_step
+        else:
+            assert all(isinstance(action, ActionRot) for action in actions)
+            robot_v = np.array([action.v for action in actions]).reshape(action_shape)
+            robot_r = np.array([action.r for action in actions]).reshape(action_shape)
+            robot_theta = robot_r + data[:, 8, 0].reshape(shape)
+            robot_vx = robot_v * np.cos(robot_theta)
+            robot_vy = robot_v * np.sin(robot_theta)
+            end_px = data[:, 0, 0].reshape(shape) + np.cos(robot_theta) * robot_v * self.time_step
+            end_py = data[:, 1, 0].reshape(shape) + np.sin(robot_theta) * robot_v * self.time_step
+        return robot_vx, robot_vy, end_px, end_py
+
+    def check(self, active, robot_vx, robot_vy, end_px, end_py):
+        """
+        Collision, goal and timeout checks of all active environments, extra trailing dimensions of the robot
+        velocities are the candidate actions
+
+        """
+        data = self.data[active]
+        shared = end_px.ndim == 2
+        # arrays are of shape (# active envs, # actions, # humans) for shared actions
+        closest_dist = self.envs[0].compute_closest_dist(robot_vx[..., None], robot_vy[..., None],
+                                                         data[:, None] if shared else data)
+        collision = np.any(closest_dist < 0, axis=-1)
+        dmin = np.min(closest_dist, axis=-1, initial=float('inf'))
+        shape = (-1, 1) if shared else (-1,)
+        reaching_goal = np.hypot(end_px - data[:, 5, 0].reshape(shape),
+                                 end_py - data[:, 6, 0].reshape(shape)) < data[:, 4, 0].reshape(shape)
+        global_times = np.array([self.envs[i].global_time for i in active])
+        timeout = np.broadcast_to((global_times >= self.time_limit - 1).reshape(shape), dmin.shape)
+        return timeout, collision, reaching_goal, dmin
+
+    def onestep_lookahead_batch(self, actions, indices=None):
+        """
+        Evaluate all candidate robot actions in active environments without updating them
+
+        :param actions: list of robot actions shared by all environments, the robots have the same kinematics
+        :param indices: indices of the active environments to evaluate, defaults to all of them
+        :return: list of next human observations and array of rewards of shape (# envs, # actions),
+        None and nan for environments that are not evaluated
+        """
+        active = self.get_active_indices() if indices is None else np.asarray(indices, dtype=int)
+        obs = [None] * self.num_envs
+        rewards = np.full((self.num_envs, len(actions)), np.nan)
+        if len(active) == 0:
+            return obs, rewards
+        human_velocities = self.get_human_velocities(active)
+        robot_velocities = self.get_robot_velocities(active, actions, shared=True)
+        rewards[active] = self.envs[0].compute_rewards(*self.check(active, *robot_velocities))[0]
+
+        if human_velocities is None:
+            for i in active:
+                obs[i] = self.envs[i].get_next_human_observation(self.envs[i].get_human_actions())
+        else:
+            human_vx, human_vy = human_velocities
+            next_states = self.data[active, :5, 1:].transpose(0, 2, 1).copy()
+            next_states[:, :, 2] = human_vx
+            next_states[:, :, 3] = human_vy
+            next_states[:, :, 0] += human_vx * self.time_step
+            next_states[:, :, 1] += human_vy * self.time_step
+            for j, i in enumerate(active):
+                obs[i] = ObservableStateList(next_states[j])
+        return obs, rewards
+
+    def step(self, actions):
+        """
+        Perform one robot action in every active environment and reset the finished ones to the next test case
+
+        :param actions: list of robot actions, None for idle environments
+        :return: lists of observations, rewards, dones and infos, None for idle environments
+        """
+        active = self.get_active_indices()
+        obs, rewards, dones, infos = [[None] * self.num_envs for _ in range(4)]
+        if len(active) == 0:
+            return obs, rewards, dones, infos
+        active_actions = [actions[i] for i in active]
+        human_velocities = self.get_human_velocities(active)
+        robot_vx, robot_vy, end_px, end_py = self.get_robot_velocities(active, active_actions)
+        checks = self.check(active, robot_vx, robot_vy, end_px, end_py)
+        active_rewards, active_dones = self.envs[0].compute_rewards(*checks)
+        active_infos = self.envs[0].get_infos(*checks)
+
+        # update robots
+        self.data[active, 0, 0] = end_px
+        self.data[active, 1, 0] = end_py
+        if self.robots[0].kinematics == 'holonomic':
+            self.data[active, 2, 0] = robot_vx
+            self.data[active, 3, 0] = robot_vy
+        else:
+            robot_v = np.array([action.v for action in active_actions])
+            theta = (self.data[active, 8, 0] + np.array([action.r for action in active_actions])) % (2 * np.pi)
+            self.data[active, 8, 0] = theta
+            self.data[active, 2, 0] = robot_v * np.cos(theta)
+            self.data[active, 3, 0] = robot_v * np.sin(theta)
+
+        # update humans
+        if human_velocities is None:
+            for i in active:
+                self.envs[i].update_humans(self.envs[i].get_human_actions())
+        else:
+            human_vx, human_vy = human_velocities
+            self.data[active, 2, 1:] = human_vx
+            self.data[active, 3, 1:] = human_vy
+            self.data[active, 0, 1:] += human_vx * self.time_step
+            self.data[active, 1, 1:] += human_vy * self.time_step
+
+        data = self.data[active]
+        reached = np.hypot(data[:, 0, 1:] - data[:, 5, 1:], data[:, 1, 1:] - data[:, 6, 1:]) < data[:, 4, 1:]
+        for j, i in enumerate(active):
+            env = self.envs[i]
+            env.global_time += env.time_step
+            env.human_actions = None
+            for k in np.flatnonzero(reached[j]):
+                if env.human_times[k] == 0:
+                    env.human_times[k] = env.global_time
+            rewards[i] = float(active_rewards[j])
+            dones[i] = bool(active_dones[j])
+            infos[i] = active_infos[j]
+            if dones[i]:
+                self.episode_times[i] = env.global_time
+                obs[i] = self.reset_env(i)
+            else:
+                obs[i] = env.crowd_state.get_observable_states(slice(1, None))
+
+        return obs, rewards, dones, infos
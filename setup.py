@@ -6,6 +6,7 @@ setup(
     version='0.0.1',
     packages=[
         'crowd_nav',
+        'crowd_nav.benchmarks',
         'crowd_nav.configs',
         'crowd_nav.policy',
         'crowd_nav.utils',
@@ -0,0 +1,83 @@
+import numpy as np
+import pytest
+import torch
+from crowd_nav.utils.memory import ReplayMemory, SumTree
+
+
+def fill_tree(capacity, rng):
+    """
+    Apply random updates with duplicate indices and zero priorities to a tree and to a plain array of priorities
+
+    """
+    tree = SumTree(capacity)
+    priorities = np.zeros(capacity)
+    for _ in range(50):
+        indices = rng.integers(capacity, size=rng.integers(1, 2 * capacity + 1))
+        values = rng.random(len(indices)) * (rng.random(len(indices)) > 0.3)
+        tree.update(indices, values)
+        # with duplicate indices the last priority of an index is kept, as with numpy assignment
+        priorities[indices] = values
+        index = int(rng.integers(capacity))
+        priority = float(rng.random())
+        tree.set(index, priority)
+        priorities[index] = priority
+    return tree, priorities
+
+
+@pytest.mark.parametrize('capacity', [1, 2, 3, 5, 7, 100, 1000])
+def test_sum_tree_total(capacity):
+    tree, priorities = fill_tree(capacity, np.random.default_rng(capacity))
+    assert tree.total() == pytest.approx(priorities.sum())
+    assert np.array_equal(tree.get(np.arange(capacity)), priorities)
+
+
+@pytest.mark.parametrize('capacity', [2, 3, 5, 7, 100, 1000])
+def test_sum_tree_find(capacity):
+    rng = np.random.default_rng(capacity)
+    tree, priorities = fill_tree(capacity, rng)
+    if priorities.sum() == 0:
+        tree.set(0, 1.0)
+        priorities[0] = 1.0
+    total = tree.total()
+    # values up to the total itself, as rounding in the sampler can produce
+    values = np.concatenate([rng.random(1000) * total, [0.0, np.nextafter(total, 0), total]])
+    indices = tree.find(values)
+    assert ((indices >= 0) & (indices < capacity)).all()
+    assert (priorities[indices] > 0).all()
+    # away from the boundaries of the ranges the slots are those of the cumulative sum
+    bounds = np.cumsum(priorities)
+    expected = np.searchsorted(bounds, values, side='right')
+    inside = np.min(np.abs(values[:, np.newaxis] - bounds[np.newaxis]), axis=1) > 1e-9
+    assert np.array_equal(indices[inside], expected[inside])
+
+
+def test_prioritized_sampling():
+    memory = ReplayMemory(50)
+    for _ in range(30):
+        memory.push((torch.zeros(3), torch.zeros(1)))
+    memory.prioritize()
+    priorities = torch.arange(30, dtype=torch.float64)
+    # duplicate indices with the same priority as they occur in a sampled batch
+    memory.update_priorities(torch.cat([torch.arange(30), torch.tensor([5, 5])]),
+                             torch.cat([priorities, priorities[[5, 5]]]))
+    counts = np.zeros(memory.capacity)
+    torch.manual_seed(0)
+    for _ in range(500):
+        indices, weights = memory.sample_prioritized(64, 0.5)
+        assert weights.max().item() == pytest.approx(1)
+        np.add.at(counts, indices.numpy(), 1)
+    # empty slots and the slot of priority 0 are never sampled
+    assert counts[30:].sum() == 0
+    assert counts[0] == 0
+    frequencies = counts[:30] / counts.sum()
+    assert np.abs(frequencies - priorities.numpy() / priorities.sum().item()).max() < 0.01
+
+
+def test_push_gets_max_priority():
+    memory = ReplayMemory(4)
+    memory.push((torch.zeros(3), torch.zeros(1)))
+    memory.prioritize()
+    memory.update_priorities(torch.tensor([0]), torch.tensor([3.0]))
+    memory.push((torch.zeros(3), torch.zeros(1)))
+    assert memory.sum_tree.get(np.arange(2)).tolist() == [3.0, 3.0]
+    assert memory.sum_tree.total() == 6.0
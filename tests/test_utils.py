@@ -0,0 +1,30 @@
+import itertools
+import numpy as np
+import pytest
+from crowd_sim.envs.utils.utils import find_colliding_pairs
+
+
+def brute_force_pairs(px, py, radius):
+    return [(i, j) for i, j in itertools.combinations(range(len(px)), 2)
+            if np.hypot(px[i] - px[j], py[i] - py[j]) - radius[i] - radius[j] < 0]
+
+
+@pytest.mark.parametrize('num', [0, 1, 2, 3, 10, 50, 300])
+@pytest.mark.parametrize('spread', [0.5, 5, 50])
+def test_find_colliding_pairs(num, spread):
+    rng = np.random.default_rng(num * 100 + int(spread))
+    px = rng.uniform(-spread, spread, num)
+    py = rng.uniform(-spread, spread, num)
+    radius = rng.uniform(0.1, 0.5, num)
+    pairs = find_colliding_pairs(px, py, radius)
+    assert pairs.shape == (len(pairs), 2)
+    assert [tuple(pair) for pair in pairs.tolist()] == brute_force_pairs(px, py, radius)
+
+
+def test_find_colliding_pairs_grid_boundaries():
+    # circles on cell boundaries, coincident circles and touching circles, which don't collide
+    px = np.array([0, 0.6, 1.2, 1.2, 0, 0.6])
+    py = np.array([0, 0, 0, 0, 0.6, 0.59])
+    radius = np.full(6, 0.3)
+    pairs = find_colliding_pairs(px, py, radius)
+    assert [tuple(pair) for pair in pairs.tolist()] == brute_force_pairs(px, py, radius)